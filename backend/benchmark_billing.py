@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Benchmark de facturación sobre una población sintética de cuentas
+Siembra N corredores con su cuenta en una base local y mide generate_monthly_charges y
+check_overdue_accounts: primero en dry-run, luego el cobro real y un segundo cobro que debe ser no-op
+
+Uso: python benchmark_billing.py [cuentas]   (por defecto 10000; pensado para 10k-100k)
+Nunca envía WhatsApp: la revisión de morosos solo corre en dry-run.
+Solo corre contra la base protegeya_benchmark y se niega a continuar si encuentra cuentas reales:
+generate_monthly_charges cobra a todas las cuentas de la base, no solo a las sintéticas.
+"""
+import asyncio
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+BENCHMARK_DB_NAME = 'protegeya_benchmark'
+
+# server.py lee estas variables al importarse; un DB_NAME exportado apuntaría el cobro real a otra base
+if os.environ.get('DB_NAME', BENCHMARK_DB_NAME) != BENCHMARK_DB_NAME:
+    sys.exit(f"DB_NAME={os.environ['DB_NAME']}: el benchmark solo corre contra {BENCHMARK_DB_NAME}")
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ['DB_NAME'] = BENCHMARK_DB_NAME
+
+from server import (
+    db, ensure_indexes, generate_monthly_charges, check_overdue_accounts, allocate_account_numbers,
+    billing_period, prepare_for_mongo, BrokerAccount, SubscriptionPlan, AccountStatus, GUATEMALA_TZ
+)
+
+# El .env de backend no sobrescribe variables ya definidas, pero se verifica la base efectiva
+if db.name != BENCHMARK_DB_NAME:
+    sys.exit(f"server.py abrió la base {db.name}: el benchmark solo corre contra {BENCHMARK_DB_NAME}")
+
+BROKER_PREFIX = "benchmark-broker-"
+PLAN_ID = "benchmark-plan"
+SEED_BATCH = 5000
+
+# Mezcla de la población: (porcentaje, estado, balance, días desde el vencimiento, cobrada este mes)
+POPULATION = [
+    (80, AccountStatus.ACTIVE, 0.0, -10, False),          # Al día, se cobra
+    (5, AccountStatus.ACTIVE, 0.0, -10, True),            # Ya cobrada este mes
+    (10, AccountStatus.ACTIVE, -500.0, 3, False),         # Vencida: entra en período de gracia
+    (5, AccountStatus.GRACE_PERIOD, -1000.0, 10, False)   # Gracia vencida: se suspende
+]
+
+def profile_for(index: int, total: int):
+    """Deterministic mix: the same N always gives the same population"""
+    position = index * 100 // total
+    accumulated = 0
+    for profile in POPULATION:
+        accumulated += profile[0]
+        if position < accumulated:
+            return profile
+    return POPULATION[-1]
+
+async def reset_population():
+    """Remove synthetic data left by previous runs"""
+    broker_filter = {"broker_id": {"$regex": f"^{BROKER_PREFIX}"}}
+    await db.broker_transactions.delete_many(broker_filter)
+    await db.broker_accounts.delete_many(broker_filter)
+    await db.brokers.delete_many({"id": {"$regex": f"^{BROKER_PREFIX}"}})
+    await db.subscription_plans.delete_many({"id": PLAN_ID})
+
+async def count_real_accounts() -> int:
+    """Accounts that were not seeded by this script; charging them would bill real brokers"""
+    return await db.broker_accounts.count_documents({"broker_id": {"$not": re.compile(f"^{BROKER_PREFIX}")}})
+
+async def seed_population(total: int):
+    now = datetime.now(GUATEMALA_TZ)
+    period = billing_period(now)
+    plan = SubscriptionPlan(id=PLAN_ID, name="Plan Benchmark", amount=500.0)
+    await db.subscription_plans.insert_one(prepare_for_mongo(plan.dict()))
+    account_numbers = await allocate_account_numbers(total)
+
+    for start in range(0, total, SEED_BATCH):
+        brokers, accounts = [], []
+        for index in range(start, min(start + SEED_BATCH, total)):
+            _, status, balance, days_overdue, charged = profile_for(index, total)
+            broker_id = f"{BROKER_PREFIX}{index:06d}"
+            brokers.append({
+                "id": broker_id, "user_id": f"{broker_id}-user", "name": f"Corredor Sintético {index}",
+                "whatsapp_number": f"502{index:08d}", "subscription_status": "Active",
+                "subscription_plan_id": PLAN_ID, "monthly_lead_quota": 0, "current_month_leads": 0
+            })
+            account = BrokerAccount(
+                broker_id=broker_id,
+                account_number=account_numbers[index],
+                current_balance=balance,
+                subscription_start_date=now - timedelta(days=90),
+                last_charge_date=now if charged else None,
+                last_charge_period=period if charged else None,
+                next_due_date=now - timedelta(days=days_overdue),
+                grace_period_end=now - timedelta(days=1) if status == AccountStatus.GRACE_PERIOD else None,
+                account_status=status
+            )
+            accounts.append(prepare_for_mongo(account.dict()))
+        await db.brokers.insert_many(brokers, ordered=False)
+        await db.broker_accounts.insert_many(accounts, ordered=False)
+
+async def timed(label: str, coro):
+    start = time.perf_counter()
+    result = await coro
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {elapsed:8.2f} s")
+    return result
+
+async def synthetic_state() -> dict:
+    """Counts that must not change during a dry run"""
+    broker_filter = {"broker_id": {"$regex": f"^{BROKER_PREFIX}"}}
+    return {
+        "transactions": await db.broker_transactions.count_documents(broker_filter),
+        "grace_period": await db.broker_accounts.count_documents({**broker_filter, "account_status": AccountStatus.GRACE_PERIOD}),
+        "suspended": await db.broker_accounts.count_documents({**broker_filter, "account_status": AccountStatus.SUSPENDED})
+    }
+
+def check(label: str, ok: bool) -> bool:
+    print(f"{'OK   ' if ok else 'FALLA'} {label}")
+    return ok
+
+async def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+    print("=" * 60)
+    print(f"BENCHMARK DE FACTURACIÓN ({total:,} cuentas sintéticas, base {db.name})")
+    print("=" * 60)
+
+    real_accounts = await count_real_accounts()
+    if real_accounts:
+        print(f"Abortado: {db.name} tiene {real_accounts:,} cuentas que no son sintéticas y se les cobraría")
+        sys.exit(2)
+
+    await ensure_indexes()
+    await reset_population()
+    await timed("Sembrado", seed_population(total))
+    before = await synthetic_state()
+
+    overdue = await timed("Morosos (dry-run)", check_overdue_accounts(dry_run=True))
+    preview = await timed("Cargos (dry-run)", generate_monthly_charges(force_manual=True, dry_run=True))
+    untouched = await synthetic_state() == before
+    first = await timed("Cargos (real)", generate_monthly_charges(force_manual=True))
+    second = await timed("Cargos (repetición)", generate_monthly_charges(force_manual=True))
+    after = await synthetic_state()
+
+    print("-" * 60)
+    print(f"Morosos: {overdue['checked']:,} revisadas, {overdue['grace_period_started']:,} a gracia, "
+          f"{overdue['suspended']:,} a suspender, {len(overdue['notifications']):,} avisos")
+    print(f"Cargos {first['period']}: {first['charged']:,} cobradas, {first['already_charged']:,} ya cobradas, "
+          f"Q{first['total_amount']:,.2f}")
+    print("-" * 60)
+    results = [
+        check("El dry-run no escribió nada", untouched),
+        check("El dry-run anticipó el cobro real", preview["charged"] == first["charged"]
+              and abs(preview["total_amount"] - first["total_amount"]) < 0.005),
+        check("La repetición no cobró de nuevo", second["charged"] == 0),
+        check("Una transacción por cuenta cobrada", after["transactions"] - before["transactions"] == first["charged"])
+    ]
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark de conversaciones de WhatsApp
+Ejecuta conversaciones guionadas contra process_whatsapp_message y reporta latencia por turno
+
+Sin red: grabar una vez con LLM_BACKEND_MODE=record (requiere OPENAI_API_KEY) y luego correr
+con LLM_BACKEND_MODE=replay (por defecto). LLM_REPLAY_LATENCY_MS fija la latencia sintética;
+si no se define se usa la latencia grabada en cada fixture.
+Nunca envía WhatsApp: los envíos salientes se reemplazan por stubs que solo cuentan las llamadas.
+Solo corre contra la base protegeya_benchmark: siembra un corredor activo que recibiría leads reales.
+"""
+import asyncio
+import os
+import sys
+import time
+
+BENCHMARK_DB_NAME = 'protegeya_benchmark'
+
+# server.py lee estas variables al importarse; un DB_NAME exportado sembraría el corredor sintético en otra base
+if os.environ.get('DB_NAME', BENCHMARK_DB_NAME) != BENCHMARK_DB_NAME:
+    sys.exit(f"DB_NAME={os.environ['DB_NAME']}: el benchmark solo corre contra {BENCHMARK_DB_NAME}")
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ['DB_NAME'] = BENCHMARK_DB_NAME
+os.environ.setdefault('LLM_BACKEND_MODE', 'replay')
+
+import server
+from server import db, process_whatsapp_message, prepare_for_mongo, Aseguradora, TasaRango, llm_stats, fast_path_stats, LLM_BACKEND_MODE
+
+# El .env de backend no sobrescribe variables ya definidas, pero se verifica la base efectiva
+if db.name != BENCHMARK_DB_NAME:
+    sys.exit(f"server.py abrió la base {db.name}: el benchmark solo corre contra {BENCHMARK_DB_NAME}")
+
+# Números fijos: el teléfono forma parte del prompt y por lo tanto del hash del fixture
+CONVERSATIONS = [
+    ["Hola", "Mi nombre es Juan Carlos Pérez", "Toyota Corolla 2020 Q150000 Mixco", "el completo de BAM"],
+    ["Buenas, quiero cotizar", "Ana Lucía Gómez", "Tengo un Honda Civic 2018, vale como 95 mil", "¿Qué incluye el seguro completo?", "RC"],
+    ["info", "me llamo Pedro Ramírez", "Mazda 3 2021 valor 180000 Villa Nueva", "¿cuál me recomiendas?", "Bantrab completo"]
+]
+
+# Envíos que el flujo hace a UltraMSG; con credenciales en .env llegarían a los números sintéticos
+outbound_calls = {"send_whatsapp_message": 0, "send_whatsapp_pdf": 0, "send_broker_lead_notification": 0}
+
+def stub_outbound_senders():
+    """Replace the UltraMSG senders with no-ops that count calls (no messages, no network time in the turns)"""
+    for name in outbound_calls:
+        async def record_call(*args, _name=name, **kwargs):
+            outbound_calls[_name] += 1
+            return True
+        setattr(server, name, record_call)
+
+def phone_for(index: int) -> str:
+    return f"5029900{index:04d}"
+
+async def reset_conversations():
+    """Remove state left by previous runs so every run replays the same prompts"""
+    phones = [phone_for(i) for i in range(len(CONVERSATIONS))]
+    await db.users.delete_many({"phone_number": {"$in": phones}})
+    await db.leads.delete_many({"phone_number": {"$in": phones}})
+    await db.interactions.delete_many({"metadata.phone_number": {"$in": phones}})
+
+async def seed_catalog():
+    """Minimal insurers and broker so quotes and selections have data to work with"""
+    if not await db.aseguradoras.count_documents({}):
+        for nombre, rc, tasa in [("BAM", 1200, 3.0), ("Bantrab", 1000, 4.0)]:
+            aseguradora = Aseguradora(nombre=nombre, rc_prima_neta=rc, completo_tasas=[TasaRango(desde=0, hasta=10_000_000, tasa=tasa)])
+            await db.aseguradoras.insert_one(prepare_for_mongo(aseguradora.dict()))
+    if not await db.brokers.count_documents({"id": "benchmark-broker"}):
+        await db.brokers.insert_one({
+            "id": "benchmark-broker", "user_id": "benchmark-broker-user", "name": "Corredor Benchmark",
+            "subscription_status": "Active", "monthly_lead_quota": 1_000_000, "current_month_leads": 0
+        })
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print("=" * 60)
+    print(f"BENCHMARK DE CONVERSACIÓN ({rounds} rondas, backend LLM: {LLM_BACKEND_MODE})")
+    print("=" * 60)
+
+    stub_outbound_senders()
+    await seed_catalog()
+    turn_ms = []
+    for _ in range(rounds):
+        await reset_conversations()
+        for index, messages in enumerate(CONVERSATIONS):
+            for message in messages:
+                start = time.perf_counter()
+                await process_whatsapp_message(phone_for(index), message)
+                turn_ms.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.1)  # Deja terminar los resúmenes en segundo plano
+
+    print(f"Turnos: {len(turn_ms)}")
+    print(f"p50: {percentile(turn_ms, 0.5):8.1f} ms")
+    print(f"p95: {percentile(turn_ms, 0.95):8.1f} ms")
+    print(f"max: {max(turn_ms):8.1f} ms")
+    print("-" * 60)
+    print(f"Fast path: {fast_path_stats['hits']}/{fast_path_stats['turns']} turnos")
+    print(f"LLM: {llm_stats['calls']} llamadas, {llm_stats['errors']} errores (sin fixture en replay), "
+          f"{llm_stats['prompt_tokens']} tokens de prompt")
+    print(f"Envíos simulados: {outbound_calls}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de generación de PDF de cotización
+Compara construir la plantilla en cada PDF contra reutilizar la plantilla del proceso
+"""
+import io
+import os
+import sys
+import time
+
+# server.py lee estas variables al importarse; el benchmark no toca la base de datos
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'protegeya_benchmark')
+
+from server import QuotePdfTemplate, get_quote_pdf_template, PDF_BRAND_LOGO_PATH
+
+SAMPLE_LEAD = {
+    "id": "3f6c1a2e-0b7d-4a55-9c1e-5d2f8b9a7c10",
+    "name": "Juan Carlos Pérez",
+    "phone_number": "50212345678",
+    "vehicle_make": "Toyota",
+    "vehicle_model": "Corolla",
+    "vehicle_year": 2020,
+    "vehicle_value": 150000.0,
+    "selected_insurer": "BANTRAB",
+    "selected_insurance_type": "FullCoverage",
+    "selected_quote_price": 1250.0,
+    "municipality": "Guatemala"
+}
+
+SAMPLE_BROKER = {
+    "name": "María López",
+    "corretaje_name": "Seguros López & Asociados",
+    "credential_id": "CR-12345",
+    "phone_number": "+502-5555-0000"
+}
+
+def run(label: str, render_one, iterations: int) -> float:
+    """Render N PDFs in memory and return CPU seconds per PDF"""
+    render_one()  # warm-up (imports, font metrics)
+    start = time.process_time()
+    for _ in range(iterations):
+        render_one()
+    per_pdf = (time.process_time() - start) / iterations
+    print(f"{label:<28} {per_pdf * 1000:8.2f} ms CPU/PDF")
+    return per_pdf
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print("=" * 60)
+    print(f"BENCHMARK PDF DE COTIZACIÓN ({iterations} iteraciones)")
+    print("=" * 60)
+
+    def rebuild_template():
+        QuotePdfTemplate(logo_path=PDF_BRAND_LOGO_PATH).render(SAMPLE_LEAD, SAMPLE_BROKER, io.BytesIO())
+
+    def cached_template():
+        get_quote_pdf_template().render(SAMPLE_LEAD, SAMPLE_BROKER, io.BytesIO())
+
+    rebuilt = run("Plantilla por PDF", rebuild_template, iterations)
+    cached = run("Plantilla en caché", cached_template, iterations)
+
+    print("-" * 60)
+    print(f"Reducción por PDF: {(rebuilt - cached) * 1000:.2f} ms ({(1 - cached / rebuilt) * 100:.1f}%)")
+
+if __name__ == "__main__":
+    main()
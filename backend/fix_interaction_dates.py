@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Script para convertir a datetime los created_at guardados como ISO string en interactions
+La rama que pedía el nombre antes de cotizar los guardaba como texto; Mongo no compara entre tipos,
+así que esos turnos quedaban fuera del historial y del resumen de conversación.
+También corrige leads.conversation_summary_through copiado de uno de esos turnos.
+Uso: python fix_interaction_dates.py [--apply]   (sin --apply solo reporta)
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from dotenv import load_dotenv
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+BATCH = 1000
+
+async def convert(collection, field: str, apply: bool) -> int:
+    """Rewrite string values of field as datetimes; returns how many documents have them"""
+    found = 0
+    operations = []
+    async for document in collection.find({field: {"$type": "string"}}, {"_id": 1, field: 1}):
+        found += 1
+        try:
+            value = datetime.fromisoformat(document[field].replace('Z', '+00:00'))
+        except ValueError:
+            print(f"   ⚠️ {collection.name} {document['_id']}: {field} no es una fecha válida ({document[field]!r})")
+            continue
+        operations.append(UpdateOne({"_id": document["_id"], field: document[field]}, {"$set": {field: value}}))
+        if apply and len(operations) >= BATCH:
+            await collection.bulk_write(operations, ordered=False)
+            operations = []
+    if apply and operations:
+        await collection.bulk_write(operations, ordered=False)
+    return found
+
+async def fix_interaction_dates(apply: bool):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+
+    print("=" * 80)
+    print(f"CORREGIR FECHAS DE INTERACCIONES ({'APLICANDO' if apply else 'SOLO REPORTE'}) - {os.environ['DB_NAME']}")
+    print("=" * 80)
+
+    interactions = await convert(db.interactions, "created_at", apply)
+    print(f"Interacciones con created_at como texto: {interactions}")
+    leads = await convert(db.leads, "conversation_summary_through", apply)
+    print(f"Leads con conversation_summary_through como texto: {leads}")
+
+    if not apply and (interactions or leads):
+        print("\nEjecuta de nuevo con --apply para corregirlas")
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(fix_interaction_dates("--apply" in sys.argv))
@@ -5,6 +5,7 @@ Ejecutar en PRODUCCIÓN
 """
 import asyncio
 import os
+from datetime import datetime, timezone
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 from pathlib import Path
@@ -101,7 +102,7 @@ async def force_reassign():
             lead_id = lead.get('id')
             result = await db.leads.update_one(
                 {"id": lead_id},
-                {"$set": {"assigned_broker_id": broker_id}}
+                {"$set": {"assigned_broker_id": broker_id, "assigned_at": datetime.now(timezone.utc)}}
             )
             
             if result.modified_count > 0:
@@ -115,7 +116,7 @@ async def force_reassign():
         lead_id = lead.get('id')
         result = await db.leads.update_one(
             {"id": lead_id},
-            {"$set": {"assigned_broker_id": broker_id}}
+            {"$set": {"assigned_broker_id": broker_id, "assigned_at": datetime.now(timezone.utc)}}
         )
         
         if result.modified_count > 0:
@@ -1,27 +1,45 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, Form, UploadFile, File, status, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
+import asyncio
+import time
+import zipfile
+import re
+import unicodedata
 from pathlib import Path
-from pydantic import BaseModel, Field, validator
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, validator, ValidationError
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
 from datetime import datetime, timezone, timedelta
 from enum import Enum
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import httpx
 import json
 import base64
+import copy
+import hashlib
+import heapq
+import random
+import io
 import jwt
 from passlib.context import CryptContext
 from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+import tiktoken
+from cachetools import LRUCache, TTLCache
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.colors import HexColor
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, PageBreak
 from reportlab.lib.units import inch
 import tempfile
 
@@ -107,6 +125,8 @@ class BrokerCreate(BaseModel):
     subscription_status: BrokerSubscriptionStatus = BrokerSubscriptionStatus.INACTIVE
     monthly_lead_quota: int = 50
     commission_percentage: float = 10.0
+    coverage_municipalities: List[str] = Field(default_factory=list)
+    routing_weight: float = 1.0
 
 class UserLogin(BaseModel):
     email: str
@@ -213,6 +233,9 @@ class BrokerProfile(BaseModel):
     subscription_plan_id: Optional[str] = None
     monthly_lead_quota: int = 50
     current_month_leads: int = 0
+    last_assigned_at: Optional[datetime] = None
+    coverage_municipalities: List[str] = Field(default_factory=list)  # Vacío = cubre todo el país
+    routing_weight: float = 1.0  # Peso relativo en el ruteo por municipio (plan, conversión)
     commission_percentage: float = 10.0
     total_closed_deals: int = 0
     total_revenue: float = 0.0
@@ -250,11 +273,16 @@ class Lead(BaseModel):
     assigned_broker_id: Optional[str] = None
     sla_first_contact_deadline: Optional[datetime] = None
     sla_reassignment_deadline: Optional[datetime] = None
+    sla_first_contact_reminded: bool = False
+    assigned_at: Optional[datetime] = None
+    reassignments: List[Dict[str, Any]] = Field(default_factory=list)  # Historial de reasignaciones por SLA
     quotes: List[Dict[str, Any]] = Field(default_factory=list)
     broker_notes: Optional[str] = None
     closed_amount: Optional[float] = None
     quote_generated: bool = False
     pdf_sent: bool = False
+    conversation_summary: str = ""  # Resumen acumulado de la conversación de WhatsApp
+    conversation_summary_through: Optional[datetime] = None  # created_at de la última interacción resumida
     created_at: datetime = Field(default_factory=lambda: datetime.now(GUATEMALA_TZ))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(GUATEMALA_TZ))
 
@@ -291,6 +319,8 @@ class SystemConfiguration(BaseModel):
     use_emergent_llm: bool = True
     whatsapp_enabled: bool = False
     ai_chat_prompt: Optional[str] = None
+    ai_model_routes: Optional[Dict[str, Dict[str, Any]]] = None  # "estado:intención" -> {model, max_tokens, temperature}
+    response_cache_generation: int = 0  # Parte de la clave del caché de respuestas; al incrementarla se invalida en todos los workers
     created_at: datetime = Field(default_factory=lambda: datetime.now(GUATEMALA_TZ))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(GUATEMALA_TZ))
 
@@ -392,6 +422,7 @@ class BrokerAccount(BaseModel):
     current_balance: float = 0.0  # Balance actual (negativo = debe, positivo = a favor)
     subscription_start_date: datetime
     last_charge_date: Optional[datetime] = None
+    last_charge_period: Optional[str] = None  # "YYYY-MM" del último cargo mensual
     next_due_date: datetime  # Próxima fecha de vencimiento
     grace_period_end: Optional[datetime] = None  # Fecha fin del período de gracia
     account_status: AccountStatus = AccountStatus.ACTIVE
@@ -409,6 +440,18 @@ class BrokerTransaction(BaseModel):
     balance_after: float  # Balance después de esta transacción
     due_date: Optional[datetime] = None  # Para cargos, fecha de vencimiento
     created_by: Optional[str] = None  # Usuario que aplicó el movimiento
+    idempotency_key: Optional[str] = None  # Cargos automáticos: "monthly-charge:{account_id}:{YYYY-MM}"
+    reverses_transaction_id: Optional[str] = None  # Asiento de reversión de una transacción anulada
+    voided_at: Optional[datetime] = None  # El ledger es append-only: anular no borra, agrega una reversión
+    voided_by: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(GUATEMALA_TZ))
+
+class LedgerSnapshot(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    account_id: str
+    as_of: datetime  # Incluye todas las transacciones con created_at <= as_of
+    balance: float
+    entries: int  # Transacciones acumuladas hasta as_of
     created_at: datetime = Field(default_factory=lambda: datetime.now(GUATEMALA_TZ))
 
 class BrokerLeadStatusUpdate(BaseModel):
@@ -417,6 +460,26 @@ class BrokerLeadStatusUpdate(BaseModel):
     notes: Optional[str] = None
     closed_amount: Optional[float] = None
 
+class NotificationStatus(str, Enum):
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+class NotificationEvent(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    event_type: str  # "lead_assigned", o resúmenes por broker: "leads_reassigned", "leads_revoked", "sla_reminder"
+    lead_id: Optional[str] = None  # Los resúmenes llevan sus leads en payload["leads"]
+    broker_id: str
+    payload: Dict[str, Any] = Field(default_factory=dict)  # Datos necesarios para el mensaje, sin releer el lead
+    status: NotificationStatus = NotificationStatus.PENDING
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=lambda: datetime.now(GUATEMALA_TZ))
+    locked_until: Optional[datetime] = None
+    last_error: Optional[str] = None
+    sent_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(GUATEMALA_TZ))
+
 class LeadInteraction(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     lead_id: str
@@ -453,6 +516,7 @@ class ConfigurationUpdate(BaseModel):
     use_emergent_llm: Optional[bool] = None
     whatsapp_enabled: Optional[bool] = None
     ai_chat_prompt: Optional[str] = None
+    ai_model_routes: Optional[Dict[str, Dict[str, Any]]] = None
 
 # Helper Functions
 def prepare_for_mongo(data):
@@ -683,70 +747,326 @@ def calcular_cuota_rc_fija(prima_neta: float, gastos_emision: float, asistencia:
     
     return cuota_mensual
 
-async def assign_broker_to_lead(lead_id: str) -> Optional[str]:
-    """Assign lead to available broker using round-robin"""
-    # Get active brokers with available quota
-    brokers = await db.brokers.find({
-        "subscription_status": BrokerSubscriptionStatus.ACTIVE,
-        "$expr": {"$lt": ["$current_month_leads", "$monthly_lead_quota"]}
-    }).to_list(length=None)
+# Filtro de brokers que aún pueden recibir leads este mes
+BROKER_HAS_QUOTA = {
+    "subscription_status": BrokerSubscriptionStatus.ACTIVE,
+    "$expr": {"$lt": ["$current_month_leads", "$monthly_lead_quota"]}
+}
+
+BROKER_HEAP_MAX_CONFLICTS = 3  # Candidatos del heap que se intentan antes de ir directo a Mongo
+BROKER_HEAP_REBUILD_MINUTES = int(os.environ.get('BROKER_HEAP_REBUILD_MINUTES', '5'))
+BROKER_HEAP_FIELDS = {
+    "_id": 0, "id": 1, "subscription_status": 1, "current_month_leads": 1, "monthly_lead_quota": 1,
+    "last_assigned_at": 1, "coverage_municipalities": 1, "routing_weight": 1
+}
+
+async def reserve_broker_slot(extra_query: Optional[dict] = None) -> Optional[dict]:
+    """
+    Atomically take one lead slot from an active broker with quota left
+    The quota check and the $inc happen in the same write, so concurrent selections cannot
+    push a broker over monthly_lead_quota; without extra_query the least-loaded broker wins
+    """
+    return await db.brokers.find_one_and_update(
+        {**BROKER_HAS_QUOTA, **(extra_query or {})},
+        {"$inc": {"current_month_leads": 1}, "$set": {"last_assigned_at": datetime.now(GUATEMALA_TZ)}},
+        sort=[("current_month_leads", 1), ("last_assigned_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def release_broker_slot(broker_id: str):
+    """Give back a slot reserved for a lead that could not be written"""
+    await db.brokers.update_one(
+        {"id": broker_id, "current_month_leads": {"$gt": 0}},
+        {"$inc": {"current_month_leads": -1}}
+    )
+    await broker_availability.refresh(broker_id)
+
+def municipality_key(municipality: Optional[str]) -> str:
+    return normalize_text(municipality or "")
+
+class BrokerAvailabilityHeap:
+    """
+    Process-local routing state for brokers that can still take leads
+    - municipality index: normalized municipality -> ids of eligible brokers covering it, for a weighted pick
+    - heap ordered by (current_month_leads, -quota headroom, last_assigned_at) for leads outside any coverage area
+    Stale heap entries are skipped lazily, so an update is one push and a pick is O(log n) with no collection
+    scan. Mongo stays the source of truth: every pick is confirmed with reserve_broker_slot and a conflict
+    refreshes that broker's entry
+    """
+    
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._entries: Dict[str, tuple] = {}  # broker_id -> clave vigente en el heap
+        self._brokers: Dict[str, dict] = {}  # broker_id -> campos de ruteo de los brokers elegibles
+        self._coverage: Dict[str, set] = {}  # municipio normalizado -> broker_ids
+        self.ready = False
+        self.stats = {"coverage_claims": 0, "heap_claims": 0, "conflicts": 0, "mongo_fallbacks": 0, "rebuilds": 0}
+    
+    @staticmethod
+    def _key(broker: dict) -> tuple:
+        last_assigned = broker.get("last_assigned_at")
+        if isinstance(last_assigned, str):
+            last_assigned = datetime.fromisoformat(last_assigned)
+        return (
+            broker.get("current_month_leads", 0),
+            broker.get("current_month_leads", 0) - broker.get("monthly_lead_quota", 0),
+            last_assigned.timestamp() if last_assigned else 0.0
+        )
     
-    if not brokers:
+    @staticmethod
+    def _eligible(broker: dict) -> bool:
+        return (broker.get("subscription_status") == BrokerSubscriptionStatus.ACTIVE
+                and broker.get("current_month_leads", 0) < broker.get("monthly_lead_quota", 0))
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def _index_coverage(self, broker: dict):
+        for municipality in broker.get("coverage_municipalities") or []:
+            self._coverage.setdefault(municipality_key(municipality), set()).add(broker["id"])
+    
+    def _unindex_coverage(self, broker_id: str):
+        previous = self._brokers.pop(broker_id, None)
+        for municipality in (previous or {}).get("coverage_municipalities") or []:
+            candidates = self._coverage.get(municipality_key(municipality))
+            if candidates is not None:
+                candidates.discard(broker_id)
+                if not candidates:
+                    del self._coverage[municipality_key(municipality)]
+    
+    def upsert(self, broker: dict):
+        """Insert or reposition a broker after any change to its load, quota, status or coverage"""
+        if not self._eligible(broker):
+            self.discard(broker["id"])
+            return
+        key = self._key(broker)
+        self._entries[broker["id"]] = key
+        heapq.heappush(self._heap, (*key, broker["id"]))
+        self._unindex_coverage(broker["id"])
+        self._brokers[broker["id"]] = {field: broker.get(field) for field in BROKER_HEAP_FIELDS if field != "_id"}
+        self._index_coverage(broker)
+    
+    def discard(self, broker_id: str):
+        self._entries.pop(broker_id, None)
+        self._unindex_coverage(broker_id)
+    
+    def covers(self, municipality: Optional[str]) -> bool:
+        """Whether some eligible broker lists the municipality in its coverage area"""
+        return municipality_key(municipality) in self._coverage
+    
+    def serves(self, broker_id: str, municipality: Optional[str]) -> bool:
+        """Nationwide brokers (empty coverage) take any lead; restricted ones only leads from their municipalities"""
+        coverage = (self._brokers.get(broker_id) or {}).get("coverage_municipalities")
+        return not coverage or broker_id in self._coverage.get(municipality_key(municipality), ())
+    
+    def coverage_query(self, municipality: Optional[str]) -> dict:
+        """Mongo filter equivalent to serves() for the sorted fallback claim"""
+        allowed = [{"coverage_municipalities": None}, {"coverage_municipalities": {"$size": 0}}]
+        if municipality:
+            allowed.append({"coverage_municipalities": municipality})
+            allowed.append({"id": {"$in": list(self._coverage.get(municipality_key(municipality), ()))}})
+        return {"$or": allowed}
+    
+    def pick_covering(self, municipality: Optional[str], exclude: set) -> Optional[str]:
+        """Weighted choice among brokers covering the municipality (routing_weight x remaining quota share)"""
+        candidates = [
+            self._brokers[broker_id] for broker_id in self._coverage.get(municipality_key(municipality), ())
+            if broker_id not in exclude
+        ]
+        if not candidates:
+            return None
+        weights = [
+            # Documentos anteriores al campo no lo tienen: mismo valor por defecto que el modelo Broker
+            max(1.0 if broker.get("routing_weight") is None else broker["routing_weight"], 0.0)
+            * (broker["monthly_lead_quota"] - broker["current_month_leads"]) / broker["monthly_lead_quota"]
+            for broker in candidates
+        ]
+        if not any(weights):
+            return None
+        return random.choices(candidates, weights=weights)[0]["id"]
+    
+    def pop(self) -> Optional[str]:
+        """Take the best candidate out of the heap, skipping superseded entries"""
+        while self._heap:
+            *key, broker_id = heapq.heappop(self._heap)
+            if self._entries.get(broker_id) == tuple(key):
+                del self._entries[broker_id]
+                return broker_id
         return None
     
-    # Simple round-robin: broker with least current leads
-    chosen_broker = min(brokers, key=lambda x: x["current_month_leads"])
+    async def rebuild(self):
+        """Reload eligible brokers from Mongo (startup and periodically, to pick up other workers' assignments)"""
+        brokers = await db.brokers.find(BROKER_HAS_QUOTA, BROKER_HEAP_FIELDS).to_list(length=None)
+        self._entries = {broker["id"]: self._key(broker) for broker in brokers}
+        self._heap = [(*key, broker_id) for broker_id, key in self._entries.items()]
+        heapq.heapify(self._heap)
+        self._brokers, self._coverage = {}, {}
+        for broker in brokers:
+            self._brokers[broker["id"]] = broker
+            self._index_coverage(broker)
+        self.ready = True
+        self.stats["rebuilds"] += 1
+        logging.info(f"Broker availability heap rebuilt with {len(self._entries)} brokers")
+    
+    async def refresh(self, broker_id: Optional[str] = None, user_id: Optional[str] = None):
+        """Re-read one broker after an admin, subscription or quota change"""
+        if not self.ready:
+            return
+        broker = await db.brokers.find_one({"id": broker_id} if broker_id else {"user_id": user_id}, BROKER_HEAP_FIELDS)
+        if broker:
+            self.upsert(broker)
+        elif broker_id:
+            self.discard(broker_id)
     
-    # Get lead details for notification
-    lead = await db.leads.find_one({"id": lead_id})
+    async def claim(self, municipality: Optional[str] = None, exclude: Optional[set] = None) -> Optional[dict]:
+        """
+        Reserve a slot for the lead: brokers covering its municipality first, then the least-loaded broker
+        from the heap, then the sorted Mongo claim if the local state keeps conflicting
+        The fallbacks only consider brokers that serve the municipality (nationwide or covering it); with none
+        available the lead stays unassigned rather than going to a broker outside its coverage area
+        exclude: broker ids that must not receive the lead (e.g. the broker it is being taken from)
+        """
+        exclude = exclude or set()
+        if self.ready and municipality:
+            tried = set(exclude)
+            for _ in range(BROKER_HEAP_MAX_CONFLICTS):
+                broker_id = self.pick_covering(municipality, tried)
+                if not broker_id:
+                    break
+                broker = await reserve_broker_slot({"id": broker_id})
+                if broker:
+                    self.upsert(broker)
+                    self.stats["coverage_claims"] += 1
+                    return broker
+                tried.add(broker_id)
+                self.stats["conflicts"] += 1
+                await self.refresh(broker_id)
+        
+        if self.ready:
+            skipped = []  # Excluidos o fuera de cobertura que se sacaron del heap y deben volver
+            try:
+                conflicts = 0
+                while conflicts < BROKER_HEAP_MAX_CONFLICTS:
+                    broker_id = self.pop()
+                    if not broker_id:
+                        break
+                    if broker_id in exclude or not self.serves(broker_id, municipality):
+                        skipped.append(broker_id)
+                        continue
+                    broker = await reserve_broker_slot({"id": broker_id})
+                    if broker:
+                        self.upsert(broker)
+                        self.stats["heap_claims"] += 1
+                        return broker
+                    # Otro worker tomó el último cupo o el broker cambió: releer su estado
+                    conflicts += 1
+                    self.stats["conflicts"] += 1
+                    await self.refresh(broker_id)
+            finally:
+                for broker_id in skipped:
+                    if broker_id in self._brokers:
+                        self.upsert(self._brokers[broker_id])
+        
+        fallback_query = self.coverage_query(municipality)
+        if exclude:
+            fallback_query["id"] = {"$nin": list(exclude)}
+        broker = await reserve_broker_slot(fallback_query)
+        if self.ready:
+            self.stats["mongo_fallbacks"] += 1
+            if broker:
+                self.upsert(broker)
+        return broker
+
+broker_availability = BrokerAvailabilityHeap()
+
+async def claim_broker_for_lead(lead_id: str, lead_fields: Optional[dict] = None, municipality: Optional[str] = None) -> Tuple[Optional[dict], Optional[dict]]:
+    """
+    Assign lead to available broker: weighted pick among brokers covering the municipality, else round-robin
+    The broker comes from the availability heap and its slot is confirmed with one conditional find_one_and_update, then the lead
+    (plus any extra lead_fields) is written in one atomic update that returns the new document;
+    the broker WhatsApp goes through a lead_assigned event handled by the notification worker
+    Returns (broker, lead after the write)
+    """
+    chosen_broker = await broker_availability.claim(municipality)
+    if not chosen_broker:
+        return None, None
     
     # Update lead with assigned broker
-    await db.leads.update_one(
+    now = datetime.now(GUATEMALA_TZ)
+    lead = await db.leads.find_one_and_update(
         {"id": lead_id},
         {
             "$set": {
+                **(lead_fields or {}),
                 "assigned_broker_id": chosen_broker["id"],
                 "status": LeadStatus.ASSIGNED_TO_BROKER,
-                "sla_first_contact_deadline": datetime.now(GUATEMALA_TZ) + timedelta(hours=2),
-                "sla_reassignment_deadline": datetime.now(GUATEMALA_TZ) + timedelta(hours=4),
-                "updated_at": datetime.now(GUATEMALA_TZ)
+                **sla_deadlines(now),
+                "updated_at": now
             }
-        }
+        },
+        return_document=ReturnDocument.AFTER
     )
+    if not lead:
+        await release_broker_slot(chosen_broker["id"])
+        return None, None
     
-    # Update broker lead count
-    await db.brokers.update_one(
-        {"id": chosen_broker["id"]},
-        {"$inc": {"current_month_leads": 1}}
+    await emit_lead_assigned(lead, chosen_broker)
+    return chosen_broker, lead
+
+async def assign_broker_to_lead(lead_id: str) -> Optional[str]:
+    """Assign lead to available broker; returns the broker id"""
+    lead = await db.leads.find_one({"id": lead_id}, {"_id": 0, "municipality": 1})
+    broker, _ = await claim_broker_for_lead(lead_id, municipality=(lead or {}).get("municipality"))
+    return broker["id"] if broker else None
+
+ACCOUNT_NUMBER_COUNTER = "account_number"
+
+async def allocate_sequence(name: str, count: int = 1) -> int:
+    """Atomically reserve `count` consecutive values of a named counter; returns the first one"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"value": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
-    
-    # Send WhatsApp notification to broker
-    await send_broker_lead_notification(chosen_broker, lead)
-    
-    return chosen_broker["id"]
+    return counter["value"] - count + 1
+
+async def sync_account_number_counter():
+    """
+    Make sure the counter is not behind account numbers created before it existed
+    The max is computed numerically (ACC-999 < ACC-1000) and applied with $max, so it is safe to run on every startup
+    """
+    result = await db.broker_accounts.aggregate([
+        {"$match": {"account_number": {"$regex": "^ACC-[0-9]+$"}}},
+        {"$group": {"_id": None, "max_number": {"$max": {"$toInt": {"$arrayElemAt": [{"$split": ["$account_number", "-"]}, 1]}}}}}
+    ]).to_list(length=1)
+    highest = (result[0]["max_number"] if result else None) or 0
+    await db.counters.update_one({"_id": ACCOUNT_NUMBER_COUNTER}, {"$max": {"value": highest}}, upsert=True)
+
+def format_account_number(number: int) -> str:
+    return f"ACC-{number:03d}"
 
 async def generate_account_number() -> str:
     """Generate unique account number for broker"""
-    # Get the last account number
-    last_account = await db.broker_accounts.find().sort([("account_number", -1)]).limit(1).to_list(1)
-    
-    if last_account:
-        last_num = int(last_account[0]["account_number"].split("-")[1])
-        new_num = last_num + 1
-    else:
-        new_num = 1
-    
-    return f"ACC-{new_num:03d}"
+    return format_account_number(await allocate_sequence(ACCOUNT_NUMBER_COUNTER))
+
+async def allocate_account_numbers(count: int) -> List[str]:
+    """Pre-allocate a block of account numbers with a single $inc (bulk onboarding)"""
+    first = await allocate_sequence(ACCOUNT_NUMBER_COUNTER, count)
+    return [format_account_number(number) for number in range(first, first + count)]
 
-async def create_broker_account(broker_id: str, subscription_plan_id: str) -> str:
-    """Create broker account when they subscribe to a plan"""
+async def create_broker_account(broker_id: str, subscription_plan_id: str, account_number: Optional[str] = None) -> str:
+    """
+    Create broker account when they subscribe to a plan
+    account_number: one taken from allocate_account_numbers when onboarding in bulk
+    """
     # Get subscription plan
     plan = await db.subscription_plans.find_one({"id": subscription_plan_id})
     if not plan:
         raise HTTPException(status_code=404, detail="Subscription plan not found")
     
     # Generate unique account number
-    account_number = await generate_account_number()
+    account_number = account_number or await generate_account_number()
     
     # Calculate next due date
     now = datetime.now(GUATEMALA_TZ)
@@ -792,129 +1112,159 @@ async def create_broker_account(broker_id: str, subscription_plan_id: str) -> st
     
     return account.id
 
-async def generate_monthly_charges(force_manual: bool = False):
+BILLING_CHUNK_SIZE = int(os.environ.get('BILLING_CHUNK_SIZE', '1000'))
+
+def billing_period(date: datetime) -> str:
+    return f"{date.year}-{date.month:02d}"
+
+def next_charge_due_date(current_date: datetime, period: str) -> datetime:
+    """Due date of a charge generated on current_date for a plan with the given period"""
+    if period == "monthly":
+        if current_date.month == 12:
+            return datetime(current_date.year + 1, 1, 1, tzinfo=GUATEMALA_TZ)
+        return datetime(current_date.year, current_date.month + 1, 1, tzinfo=GUATEMALA_TZ)
+    # Handle other periods if needed
+    return current_date + timedelta(days=30)
+
+def monthly_charge_key(account_id: str, period: str) -> str:
+    return f"monthly-charge:{account_id}:{period}"
+
+async def write_monthly_charges(charges: List[dict], current_date: datetime, period: str) -> int:
     """
-    Generate monthly charges for all active brokers
-    Args:
-        force_manual: If True, generates charges regardless of date (for manual admin trigger)
+    Apply one chunk of charges: insert_many for the transactions, one bulk_write for the accounts
+    Both writes are idempotent on their own (unique idempotency_key, account guarded on last_charge_period),
+    so a run interrupted between them is completed by the next one without charging twice
     """
-    current_date = datetime.now(GUATEMALA_TZ)
-    
-    # Only run on 1st of month (unless forced manually)
-    if not force_manual and current_date.day != 1:
-        return
-    
-    # Get all active accounts
-    accounts = await db.broker_accounts.find({"account_status": {"$ne": AccountStatus.SUSPENDED}}).to_list(length=None)
-    
-    for account_data in accounts:
-        account = BrokerAccount(**parse_from_mongo(account_data))
-        
-        # Skip if already charged this month
-        if account.last_charge_date and account.last_charge_date.month == current_date.month and account.last_charge_date.year == current_date.year:
-            continue
-        
-        # Get broker and plan info
-        broker = await db.brokers.find_one({"id": account.broker_id})
-        if not broker or not broker.get("subscription_plan_id"):
-            continue
-            
-        plan = await db.subscription_plans.find_one({"id": broker["subscription_plan_id"]})
-        if not plan:
-            continue
-        
-        # Calculate next due date based on period
-        if plan["period"] == "monthly":
-            if current_date.month == 12:
-                next_due = datetime(current_date.year + 1, 1, 1, tzinfo=GUATEMALA_TZ)
-            else:
-                next_due = datetime(current_date.year, current_date.month + 1, 1, tzinfo=GUATEMALA_TZ)
-        else:
-            # Handle other periods if needed
-            next_due = current_date + timedelta(days=30)
-        
-        # Update account balance and due date
-        new_balance = account.current_balance - plan["amount"]
-        
-        await db.broker_accounts.update_one(
-            {"id": account.id},
+    transactions = [
+        prepare_for_mongo(BrokerTransaction(
+            account_id=charge["id"],
+            broker_id=charge["broker_id"],
+            transaction_type=TransactionType.CHARGE,
+            amount=-charge["plan"]["amount"],
+            description=f"Cargo mensual - {charge['plan']['name']}",
+            balance_after=charge.get("current_balance", 0.0) - charge["plan"]["amount"],
+            due_date=next_charge_due_date(current_date, charge["plan"].get("period")),
+            idempotency_key=monthly_charge_key(charge["id"], period)
+        ).dict())
+        for charge in charges
+    ]
+    try:
+        await db.broker_transactions.insert_many(transactions, ordered=False)
+    except BulkWriteError as e:
+        # Cargos ya registrados por una corrida anterior: el índice único los descarta
+        duplicates = [error for error in e.details.get("writeErrors", []) if error.get("code") == 11000]
+        if len(duplicates) != len(e.details.get("writeErrors", [])):
+            raise
+        logging.info(f"Monthly charges {period}: {len(duplicates)} transactions already existed")
+    
+    result = await db.broker_accounts.bulk_write([
+        UpdateOne(
+            {"id": charge["id"], "last_charge_period": {"$ne": period}},
             {
+                "$inc": {"current_balance": -charge["plan"]["amount"]},
                 "$set": {
-                    "current_balance": new_balance,
                     "last_charge_date": current_date,
-                    "next_due_date": next_due,
+                    "last_charge_period": period,
+                    "next_due_date": next_charge_due_date(current_date, charge["plan"].get("period")),
                     "updated_at": current_date
                 }
             }
         )
-        
-        # Create charge transaction
-        transaction = BrokerTransaction(
-            account_id=account.id,
-            broker_id=account.broker_id,
-            transaction_type=TransactionType.CHARGE,
-            amount=-plan["amount"],
-            description=f"Cargo mensual - {plan['name']}",
-            balance_after=new_balance,
-            due_date=next_due
-        )
-        
-        transaction_dict = prepare_for_mongo(transaction.dict())
-        await db.broker_transactions.insert_one(transaction_dict)
+        for charge in charges
+    ], ordered=False)
+    return result.modified_count
 
-async def check_overdue_accounts():
-    """Check for overdue accounts and manage grace periods (runs daily)"""
+async def generate_monthly_charges(force_manual: bool = False, dry_run: bool = False) -> dict:
+    """
+    Generate monthly charges for all active brokers
+    Accounts are joined with their broker and plan in one aggregation and charged in chunks of
+    BILLING_CHUNK_SIZE; each (account, month) is charged at most once
+    Args:
+        force_manual: If True, generates charges regardless of date (for manual admin trigger)
+        dry_run: If True, returns the charges that would be applied (summary["charges"]) without writing
+    """
     current_date = datetime.now(GUATEMALA_TZ)
     
-    # Get accounts that might be overdue
-    accounts = await db.broker_accounts.find({
-        "account_status": {"$in": [AccountStatus.ACTIVE, AccountStatus.OVERDUE, AccountStatus.GRACE_PERIOD]},
-        "current_balance": {"$lt": 0}  # Has debt
-    }).to_list(length=None)
+    # Only run on 1st of month (unless forced manually)
+    if not force_manual and current_date.day != 1:
+        return {"skipped": True}
     
-    for account_data in accounts:
-        account = BrokerAccount(**parse_from_mongo(account_data))
-        
-        # Check if payment is overdue
-        # Ensure both dates are timezone-aware for comparison
-        next_due_date = account.next_due_date
-        if next_due_date.tzinfo is None:
-            next_due_date = next_due_date.replace(tzinfo=GUATEMALA_TZ)
+    period = billing_period(current_date)
+    summary = {"period": period, "dry_run": dry_run, "charged": 0, "already_charged": 0, "total_amount": 0.0}
+    if dry_run:
+        summary["charges"] = []
+    
+    async def apply_chunk(chunk: List[dict]):
+        if dry_run:
+            summary["charges"].extend(
+                {
+                    "account_id": charge["id"],
+                    "broker_id": charge["broker_id"],
+                    "plan": charge["plan"]["name"],
+                    "amount": charge["plan"]["amount"],
+                    "balance_after": charge.get("current_balance", 0.0) - charge["plan"]["amount"],
+                    "due_date": next_charge_due_date(current_date, charge["plan"].get("period")).isoformat(),
+                    "idempotency_key": monthly_charge_key(charge["id"], period)
+                }
+                for charge in chunk
+            )
+            summary["charged"] += len(chunk)
+        else:
+            summary["charged"] += await write_monthly_charges(chunk, current_date, period)
+        summary["total_amount"] += sum(item["plan"]["amount"] for item in chunk)
+    
+    cursor = db.broker_accounts.aggregate([
+        {"$match": {"account_status": {"$ne": AccountStatus.SUSPENDED}, "last_charge_period": {"$ne": period}}},
+        {"$lookup": {"from": "brokers", "localField": "broker_id", "foreignField": "id", "as": "broker"}},
+        {"$unwind": "$broker"},
+        {"$match": {"broker.subscription_plan_id": {"$nin": [None, ""]}}},
+        {"$lookup": {"from": "subscription_plans", "localField": "broker.subscription_plan_id", "foreignField": "id", "as": "plan"}},
+        {"$unwind": "$plan"},
+        {"$project": {
+            "_id": 0, "id": 1, "broker_id": 1, "current_balance": 1, "last_charge_date": 1,
+            "plan": {"name": "$plan.name", "amount": "$plan.amount", "period": "$plan.period"}
+        }}
+    ])
+    
+    chunk = []
+    async for charge in cursor:
+        # Cuentas cobradas antes de existir last_charge_period
+        last_charge = charge.get("last_charge_date")
+        if isinstance(last_charge, str):
+            last_charge = datetime.fromisoformat(last_charge)
+        if last_charge and last_charge.month == current_date.month and last_charge.year == current_date.year:
+            summary["already_charged"] += 1
+            continue
         
-        if current_date > next_due_date and account.current_balance < 0:
-            
-            if account.account_status == AccountStatus.ACTIVE:
-                # Move to overdue and start grace period
-                grace_end = current_date + timedelta(days=5)
-                
-                await db.broker_accounts.update_one(
-                    {"id": account.id},
-                    {
-                        "$set": {
-                            "account_status": AccountStatus.GRACE_PERIOD,
-                            "grace_period_end": grace_end,
-                            "updated_at": current_date
-                        }
-                    }
-                )
-                
-                # Send WhatsApp notification
-                await send_overdue_notification(account.broker_id, grace_end)
-                
-            elif account.account_status == AccountStatus.GRACE_PERIOD and current_date > account.grace_period_end:
-                # Grace period expired, suspend account
-                await suspend_broker_account(account.broker_id)
-
-async def send_overdue_notification(broker_id: str, grace_end: datetime):
-    """Send WhatsApp notification for overdue payment"""
-    broker = await db.brokers.find_one({"id": broker_id})
-    if not broker:
-        return
+        chunk.append(charge)
+        if len(chunk) >= BILLING_CHUNK_SIZE:
+            await apply_chunk(chunk)
+            chunk = []
+    if chunk:
+        await apply_chunk(chunk)
     
-    message = f"""
+    logging.info(f"Monthly charges {period}{' (dry run)' if dry_run else ''}: "
+                 f"{summary['charged']} accounts charged, Q{summary['total_amount']:,.2f}")
+    return summary
+
+OVERDUE_GRACE_DAYS = 5
+OVERDUE_NOTIFY_CONCURRENCY = int(os.environ.get('OVERDUE_NOTIFY_CONCURRENCY', '10'))
+
+def as_guatemala_datetime(value) -> Optional[datetime]:
+    """Normalize a stored date (ISO string or BSON datetime, which Mongo returns naive in UTC)"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(GUATEMALA_TZ)
+
+def overdue_notification_message(broker_name: str, grace_end: datetime) -> str:
+    return f"""
 🚨 *ProtegeYa - Pago Vencido*
 
-Estimado {broker['name']},
+Estimado {broker_name},
 
 Su pago mensual está vencido. Tiene hasta el {grace_end.strftime('%d/%m/%Y')} para regularizar su situación.
 
@@ -922,43 +1272,12 @@ Después de esta fecha, su cuenta será suspendida automáticamente.
 
 Para más información, contacte al administrador.
     """.strip()
-    
-    await send_whatsapp_message(broker["whatsapp_number"], message)
 
-async def suspend_broker_account(broker_id: str):
-    """Suspend broker account and deactivate user"""
-    # Update account status
-    await db.broker_accounts.update_one(
-        {"broker_id": broker_id},
-        {
-            "$set": {
-                "account_status": AccountStatus.SUSPENDED,
-                "updated_at": datetime.now(GUATEMALA_TZ)
-            }
-        }
-    )
-    
-    # Deactivate broker
-    await db.brokers.update_one(
-        {"id": broker_id},
-        {"$set": {"subscription_status": BrokerSubscriptionStatus.INACTIVE}}
-    )
-    
-    # Deactivate user
-    broker = await db.brokers.find_one({"id": broker_id})
-    if broker and broker.get("user_id"):
-        await db.auth_users.update_one(
-            {"id": broker["user_id"]},
-            {"$set": {"active": False}}
-        )
-    
-    # Send suspension notification
-    broker_data = await db.brokers.find_one({"id": broker_id})
-    if broker_data:
-        message = f"""
+def suspension_notification_message(broker_name: str) -> str:
+    return f"""
 ❌ *ProtegeYa - Cuenta Suspendida*
 
-Estimado {broker_data['name']},
+Estimado {broker_name},
 
 Su cuenta ha sido suspendida por falta de pago.
 
@@ -966,23 +1285,301 @@ Para reactivar su cuenta, debe regularizar su situación de pago.
 
 Contacte al administrador para más información.
         """.strip()
+
+async def send_whatsapp_batch(messages: List[Tuple[str, str]], concurrency: int = OVERDUE_NOTIFY_CONCURRENCY) -> int:
+    """Send (phone, text) pairs with at most `concurrency` requests in flight; returns how many were accepted"""
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def send_one(phone: str, text: str) -> bool:
+        async with semaphore:
+            try:
+                return await send_whatsapp_message(phone, text)
+            except Exception as e:
+                logging.error(f"Error sending WhatsApp to {phone}: {e}")
+                return False
+    
+    results = await asyncio.gather(*(send_one(phone, text) for phone, text in messages))
+    return sum(1 for sent in results if sent)
+
+async def suspend_broker_accounts(brokers: List[dict], now: datetime):
+    """Deactivate the brokers and their users for suspended accounts (one write per collection)"""
+    broker_ids = [broker["id"] for broker in brokers]
+    await db.brokers.update_many(
+        {"id": {"$in": broker_ids}},
+        {"$set": {"subscription_status": BrokerSubscriptionStatus.INACTIVE, "updated_at": now}}
+    )
+    user_ids = [broker["user_id"] for broker in brokers if broker.get("user_id")]
+    if user_ids:
+        await db.auth_users.update_many({"id": {"$in": user_ids}}, {"$set": {"active": False}})
+    for broker_id in broker_ids:
+        broker_availability.discard(broker_id)
+
+async def check_overdue_accounts(dry_run: bool = False) -> dict:
+    """
+    Check for overdue accounts and manage grace periods (runs daily)
+    Accounts and their brokers are read in one aggregation, transitions are computed in one pass and
+    written with bulk_write; WhatsApp notices go out afterwards through a bounded-concurrency sender
+    Args:
+        dry_run: If True, returns the transitions and notices (summary["transitions"], summary["notifications"])
+            without writing or sending anything
+    """
+    current_date = datetime.now(GUATEMALA_TZ)
+    
+    # Get accounts that might be overdue, with the broker fields the notices need
+    accounts = await db.broker_accounts.aggregate([
+        {"$match": {
+            "account_status": {"$in": [AccountStatus.ACTIVE, AccountStatus.OVERDUE, AccountStatus.GRACE_PERIOD]},
+            "current_balance": {"$lt": 0}  # Has debt
+        }},
+        {"$lookup": {"from": "brokers", "localField": "broker_id", "foreignField": "id", "as": "broker"}},
+        {"$unwind": {"path": "$broker", "preserveNullAndEmptyArrays": True}},
+        {"$project": {
+            "_id": 0, "id": 1, "broker_id": 1, "account_status": 1, "next_due_date": 1, "grace_period_end": 1,
+            "broker": {"id": "$broker.id", "name": "$broker.name", "whatsapp_number": "$broker.whatsapp_number", "user_id": "$broker.user_id"}
+        }}
+    ]).to_list(length=None)
+    
+    # Marca de esta corrida en cada transición, para saber después cuáles aplicaron realmente
+    run_id = str(uuid.uuid4())
+    operations = []
+    messages: List[Tuple[str, str, str]] = []  # (account_id, teléfono, texto)
+    suspended_brokers: List[Tuple[str, dict]] = []  # (account_id, broker)
+    planned = []
+    grace_end = current_date + timedelta(days=OVERDUE_GRACE_DAYS)
+    for account in accounts:
+        broker = account.get("broker") or {}
+        next_due_date = as_guatemala_datetime(account.get("next_due_date"))
+        if not next_due_date or current_date <= next_due_date:
+            continue
         
-        await send_whatsapp_message(broker_data["whatsapp_number"], message)
+        if account["account_status"] == AccountStatus.ACTIVE:
+            # Move to overdue and start grace period
+            operations.append(UpdateOne(
+                {"id": account["id"], "account_status": AccountStatus.ACTIVE},
+                {"$set": {"account_status": AccountStatus.GRACE_PERIOD, "grace_period_end": grace_end,
+                          "updated_at": current_date, "status_run_id": run_id}}
+            ))
+            planned.append({"account_id": account["id"], "broker_id": account["broker_id"],
+                            "from": AccountStatus.ACTIVE, "to": AccountStatus.GRACE_PERIOD})
+            if broker.get("whatsapp_number"):
+                messages.append((account["id"], broker["whatsapp_number"], overdue_notification_message(broker.get("name", ""), grace_end)))
+        
+        elif account["account_status"] == AccountStatus.GRACE_PERIOD:
+            account_grace_end = as_guatemala_datetime(account.get("grace_period_end"))
+            if account_grace_end and current_date > account_grace_end:
+                # Grace period expired, suspend account
+                operations.append(UpdateOne(
+                    {"id": account["id"], "account_status": AccountStatus.GRACE_PERIOD},
+                    {"$set": {"account_status": AccountStatus.SUSPENDED, "updated_at": current_date, "status_run_id": run_id}}
+                ))
+                planned.append({"account_id": account["id"], "broker_id": account["broker_id"],
+                                "from": AccountStatus.GRACE_PERIOD, "to": AccountStatus.SUSPENDED})
+                if broker.get("id"):
+                    suspended_brokers.append((account["id"], broker))
+                    if broker.get("whatsapp_number"):
+                        messages.append((account["id"], broker["whatsapp_number"], suspension_notification_message(broker.get("name", ""))))
+    
+    def count_transitions(items: List[dict]) -> dict:
+        return {
+            "grace_period_started": sum(1 for item in items if item["to"] == AccountStatus.GRACE_PERIOD),
+            "suspended": sum(1 for item in items if item["to"] == AccountStatus.SUSPENDED)
+        }
+    
+    if dry_run:
+        summary = {
+            "checked": len(accounts),
+            "dry_run": True,
+            **count_transitions(planned),
+            "notifications_sent": 0,
+            "notifications_failed": 0,
+            "transitions": planned,
+            "notifications": [{"phone": phone, "message": text} for _, phone, text in messages]
+        }
+        logging.info(f"Overdue check (dry run): {len(accounts)} checked, {count_transitions(planned)}, {len(messages)} notices")
+        return summary
+    
+    applied = set()
+    if operations:
+        result = await db.broker_accounts.bulk_write(operations, ordered=False)
+        applied = {item["account_id"] for item in planned}
+        if result.modified_count < len(operations):
+            # Otra corrida o un pago cambió la cuenta entre la lectura y el update guardado: esas no se tocan
+            changed = await db.broker_accounts.find(
+                {"id": {"$in": list(applied)}, "status_run_id": run_id}, {"_id": 0, "id": 1}
+            ).to_list(length=None)
+            applied = {account["id"] for account in changed}
+    
+    to_suspend = [broker for account_id, broker in suspended_brokers if account_id in applied]
+    if to_suspend:
+        await suspend_broker_accounts(to_suspend, current_date)
+    notices = [(phone, text) for account_id, phone, text in messages if account_id in applied]
+    sent = await send_whatsapp_batch(notices) if notices else 0
+    
+    summary = {
+        "checked": len(accounts),
+        "dry_run": False,
+        **count_transitions([item for item in planned if item["account_id"] in applied]),
+        "lost_races": len(planned) - len(applied),
+        "notifications_sent": sent,
+        "notifications_failed": len(notices) - sent
+    }
+    logging.info(f"Overdue check: {summary}")
+    return summary
+
+# ========== LEDGER ==========
+
+# broker_transactions es el ledger: solo se agregan asientos (las anulaciones agregan una reversión),
+# así que la suma de amount por cuenta es el balance y un snapshot nunca queda invalidado
+LEDGER_SNAPSHOT_LAG_SECONDS = 60  # Margen para inserts en vuelo con created_at anterior al corte
+LEDGER_JOB_LOCK_SECONDS = 1800
+LEDGER_BALANCE_TOLERANCE = 0.005
+
+# Transacciones visibles en historiales y reportes (sin anuladas ni sus reversiones)
+VISIBLE_TRANSACTIONS = {"voided_at": None, "reverses_transaction_id": None}
+
+def ledger_key(date: datetime) -> str:
+    """created_at is stored as a Guatemala-time ISO string, so range filters compare strings in that form"""
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=GUATEMALA_TZ)
+    return date.astimezone(GUATEMALA_TZ).isoformat()
+
+async def ledger_deltas(start_key: str, end_key: str, account_ids: Optional[List[str]] = None) -> Dict[str, dict]:
+    """Sum and count of ledger entries per account with start < created_at <= end"""
+    match = {"created_at": {"$gt": start_key, "$lte": end_key}}
+    if account_ids is not None:
+        match["account_id"] = {"$in": account_ids}
+    rows = await db.broker_transactions.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$account_id", "amount": {"$sum": "$amount"}, "entries": {"$sum": 1}}}
+    ]).to_list(length=None)
+    return {row["_id"]: row for row in rows}
+
+async def take_ledger_snapshots(as_of: Optional[datetime] = None) -> dict:
+    """
+    Snapshot the balance of every account with ledger activity since the previous run
+    Accounts without activity keep their last snapshot, which is still their balance at the previous cut,
+    so one aggregation over the new entries plus the touched accounts' last snapshots is enough
+    """
+    as_of = as_of or datetime.now(GUATEMALA_TZ) - timedelta(seconds=LEDGER_SNAPSHOT_LAG_SECONDS)
+    as_of_key = ledger_key(as_of)
+    last_run = await db.ledger_snapshot_runs.find_one({}, {"_id": 0}, sort=[("as_of", -1)])
+    start_key = last_run["as_of"] if last_run else ""
+    if start_key >= as_of_key:
+        return {"as_of": as_of_key, "snapshots": 0}
+    
+    deltas = await ledger_deltas(start_key, as_of_key)
+    previous = {}
+    if deltas:
+        rows = await db.ledger_snapshots.aggregate([
+            {"$match": {"account_id": {"$in": list(deltas)}}},
+            {"$sort": {"as_of": -1}},
+            {"$group": {"_id": "$account_id", "balance": {"$first": "$balance"}, "entries": {"$first": "$entries"}}}
+        ]).to_list(length=None)
+        previous = {row["_id"]: row for row in rows}
+        
+        snapshots = [
+            prepare_for_mongo(LedgerSnapshot(
+                account_id=account_id,
+                as_of=as_of,
+                balance=round(previous.get(account_id, {}).get("balance", 0.0) + delta["amount"], 2),
+                entries=previous.get(account_id, {}).get("entries", 0) + delta["entries"]
+            ).dict())
+            for account_id, delta in deltas.items()
+        ]
+        for start in range(0, len(snapshots), BILLING_CHUNK_SIZE):
+            await db.ledger_snapshots.insert_many(snapshots[start:start + BILLING_CHUNK_SIZE])
+    
+    await db.ledger_snapshot_runs.insert_one({"as_of": as_of_key, "snapshots": len(deltas), "created_at": datetime.now(GUATEMALA_TZ).isoformat()})
+    logging.info(f"Ledger snapshots as of {as_of_key}: {len(deltas)} accounts")
+    return {"as_of": as_of_key, "snapshots": len(deltas)}
+
+async def account_balance_at(account_id: str, at: datetime) -> dict:
+    """Balance at a point in time: nearest snapshot at or before `at` plus the entries after it"""
+    at_key = ledger_key(at)
+    snapshot = await db.ledger_snapshots.find_one(
+        {"account_id": account_id, "as_of": {"$lte": at_key}}, {"_id": 0}, sort=[("as_of", -1)]
+    )
+    start_key = snapshot["as_of"] if snapshot else ""
+    delta = (await ledger_deltas(start_key, at_key, [account_id])).get(account_id, {"amount": 0.0, "entries": 0})
+    return {
+        "account_id": account_id,
+        "at": at_key,
+        "balance": round((snapshot["balance"] if snapshot else 0.0) + delta["amount"], 2),
+        "snapshot_as_of": snapshot["as_of"] if snapshot else None,
+        "entries_after_snapshot": delta["entries"]
+    }
 
-async def generate_quote_pdf(lead_data: dict, broker_data: dict) -> str:
-    """Generate PDF quote and return file path"""
+async def reconcile_ledger_balances() -> dict:
+    """
+    Compare every account's current_balance with the sum of its ledger in one aggregation and flag mismatches
+    Starts from broker_accounts so an account with a balance but no ledger entries (e.g. transactions
+    hard-deleted before the ledger became append-only) is reported with a ledger balance of 0
+    """
+    mismatches = await db.broker_accounts.aggregate([
+        # Usa el índice (account_id, created_at, id) de broker_transactions
+        {"$lookup": {"from": "broker_transactions", "localField": "id", "foreignField": "account_id", "as": "ledger"}},
+        {"$project": {
+            "_id": 0, "account_id": "$id", "broker_id": 1, "account_number": 1,
+            "recorded_balance": {"$ifNull": ["$current_balance", 0.0]},
+            "ledger_balance": {"$sum": "$ledger.amount"}, "entries": {"$size": "$ledger"}
+        }},
+        {"$addFields": {"difference": {"$subtract": ["$recorded_balance", "$ledger_balance"]}}},
+        {"$match": {"$or": [
+            {"difference": {"$gt": LEDGER_BALANCE_TOLERANCE}},
+            {"difference": {"$lt": -LEDGER_BALANCE_TOLERANCE}}
+        ]}}
+    ]).to_list(length=None)
+    
+    report = {
+        "id": str(uuid.uuid4()),
+        "run_at": datetime.now(GUATEMALA_TZ).isoformat(),
+        "accounts_checked": await db.broker_accounts.count_documents({}),
+        "mismatches": [{**item, "difference": round(item["difference"], 2)} for item in mismatches]
+    }
+    await db.ledger_reconciliations.insert_one(dict(report))
+    for item in report["mismatches"]:
+        logging.warning(f"Ledger mismatch on account {item['account_number']}: recorded {item['recorded_balance']}, ledger {item['ledger_balance']}")
+    return report
+
+async def ledger_maintenance_job() -> dict:
+    """Nightly: snapshot balances, then reconcile current_balance against the ledger (one worker at a time)"""
+    if not await acquire_job_lock("ledger_maintenance", LEDGER_JOB_LOCK_SECONDS):
+        return {"skipped": True}
     try:
-        # Create temporary file
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        pdf_path = temp_file.name
-        temp_file.close()
-        
-        # Create PDF document
-        doc = SimpleDocTemplate(pdf_path, pagesize=letter)
+        snapshots = await take_ledger_snapshots()
+        reconciliation = await reconcile_ledger_balances()
+        return {
+            "snapshots": snapshots["snapshots"],
+            "accounts_checked": reconciliation["accounts_checked"],
+            "mismatches": len(reconciliation["mismatches"])
+        }
+    finally:
+        await release_job_lock("ledger_maintenance")
+
+# ========== PDF TEMPLATE ==========
+
+PDF_BRAND_LOGO_PATH = os.environ.get('PDF_BRAND_LOGO_PATH')
+
+PDF_DISCLAIMER_TEXT = """
+        <b>AVISO IMPORTANTE:</b><br/>
+        ProtegeYa es un comparador y generador de leads. No es aseguradora ni corredor. 
+        Los precios mostrados son indicativos y deben ser confirmados con un corredor autorizado.
+        <br/><br/>
+        Para proceder con la contratación, el corredor asignado se pondrá en contacto contigo 
+        en las próximas horas para finalizar el proceso y confirmar los detalles de tu póliza.
+        """
+
+class QuotePdfTemplate:
+    """
+    Plantilla del PDF de cotización construida una sola vez por proceso.
+    Mantiene estilos, estilos de tabla, encabezado, aviso legal y logo;
+    cada PDF solo llena las celdas variables (cliente, vehículo, cotización y corredor).
+    """
+
+    def __init__(self, logo_path: Optional[str] = None):
         styles = getSampleStyleSheet()
         
-        # Custom styles
-        title_style = ParagraphStyle(
+        self.title_style = ParagraphStyle(
             'CustomTitle',
             parent=styles['Heading1'],
             fontSize=24,
@@ -991,7 +1588,7 @@ async def generate_quote_pdf(lead_data: dict, broker_data: dict) -> str:
             alignment=1  # Center alignment
         )
         
-        subtitle_style = ParagraphStyle(
+        self.subtitle_style = ParagraphStyle(
             'CustomSubtitle',
             parent=styles['Heading2'],
             fontSize=16,
@@ -999,125 +1596,179 @@ async def generate_quote_pdf(lead_data: dict, broker_data: dict) -> str:
             textColor=HexColor('#0F766E')
         )
         
-        # Build PDF content
+        self.disclaimer_style = ParagraphStyle(
+            'Disclaimer',
+            parent=styles['Normal'],
+            fontSize=10,
+            textColor=HexColor('#6B7280'),
+            borderWidth=1,
+            borderColor=HexColor('#D1D5DB'),
+            borderPadding=10,
+            backColor=HexColor('#F9FAFB')
+        )
+        
+        # Las cuatro tablas comparten formato, solo cambia el color de la columna de etiquetas
+        self.client_table_style = self._table_style('#F0FDFA')
+        self.vehicle_table_style = self.client_table_style
+        self.quote_table_style = self._table_style('#FEF3C7')
+        self.broker_table_style = self._table_style('#EFF6FF')
+        
+        # Flowables estáticos (se parsean una vez y se copian en cada PDF)
+        self.header = [
+            Paragraph("ProtegeYa", self.title_style),
+            Paragraph("Cotización de Seguro Vehicular", self.subtitle_style)
+        ]
+        self.section_titles = {
+            "client": Paragraph("Información del Cliente", self.subtitle_style),
+            "vehicle": Paragraph("Información del Vehículo", self.subtitle_style),
+            "quote": Paragraph("Cotización Seleccionada", self.subtitle_style),
+            "broker": Paragraph("Corredor Asignado", self.subtitle_style)
+        }
+        self.disclaimer = Paragraph(PDF_DISCLAIMER_TEXT, self.disclaimer_style)
+        
+        # Logo opcional: se lee del disco una sola vez
+        self.logo_bytes = None
+        if logo_path:
+            try:
+                with open(logo_path, 'rb') as logo_file:
+                    self.logo_bytes = logo_file.read()
+            except OSError as e:
+                logging.warning(f"Could not load PDF brand logo {logo_path}: {e}")
+
+    @staticmethod
+    def _table_style(label_background: str) -> TableStyle:
+        return TableStyle([
+            ('BACKGROUND', (0, 0), (0, -1), HexColor(label_background)),
+            ('TEXTCOLOR', (0, 0), (-1, -1), HexColor('#0F172A')),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 11),
+            ('GRID', (0, 0), (-1, -1), 1, HexColor('#E5E7EB'))
+        ])
+
+    def _section(self, key: str, rows: List[List[str]], table_style: TableStyle) -> list:
+        table = Table(rows, colWidths=[2*inch, 3*inch])
+        table.setStyle(table_style)
+        return [copy.copy(self.section_titles[key]), table]
+
+    def build_story(self, lead_data: dict, broker_data: dict) -> list:
+        """Build the flowables for one quote, reusing every static element"""
         story = []
         
         # Header
-        story.append(Paragraph("ProtegeYa", title_style))
-        story.append(Paragraph("Cotización de Seguro Vehicular", subtitle_style))
+        if self.logo_bytes:
+            story.append(Image(io.BytesIO(self.logo_bytes), width=1.5*inch, height=0.75*inch, kind='proportional'))
+        story.extend(copy.copy(flowable) for flowable in self.header)
         story.append(Spacer(1, 20))
         
         # Client Info
-        story.append(Paragraph("Información del Cliente", subtitle_style))
         client_data = [
             ['Nombre:', lead_data.get('name', 'No especificado')],
             ['Teléfono:', lead_data.get('phone_number', 'No especificado')],
             ['Fecha:', datetime.now(GUATEMALA_TZ).strftime('%d/%m/%Y')],
             ['ID de Cotización:', lead_data.get('id', '')[:8] + '...']
         ]
-        
-        client_table = Table(client_data, colWidths=[2*inch, 3*inch])
-        client_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#F0FDFA')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), HexColor('#0F172A')),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 11),
-            ('GRID', (0, 0), (-1, -1), 1, HexColor('#E5E7EB'))
-        ]))
-        story.append(client_table)
+        story.extend(self._section("client", client_data, self.client_table_style))
         story.append(Spacer(1, 20))
         
         # Vehicle Info
-        story.append(Paragraph("Información del Vehículo", subtitle_style))
         vehicle_data = [
             ['Marca:', lead_data.get('vehicle_make', 'No especificado')],
             ['Modelo:', lead_data.get('vehicle_model', 'No especificado')],
             ['Año:', str(lead_data.get('vehicle_year', 'No especificado'))],
             ['Valor:', f"Q{lead_data.get('vehicle_value', 0):,.2f}" if lead_data.get('vehicle_value') else 'No especificado']
         ]
-        
-        vehicle_table = Table(vehicle_data, colWidths=[2*inch, 3*inch])
-        vehicle_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#F0FDFA')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), HexColor('#0F172A')),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 11),
-            ('GRID', (0, 0), (-1, -1), 1, HexColor('#E5E7EB'))
-        ]))
-        story.append(vehicle_table)
+        story.extend(self._section("vehicle", vehicle_data, self.vehicle_table_style))
         story.append(Spacer(1, 20))
         
         # Quote Info
-        story.append(Paragraph("Cotización Seleccionada", subtitle_style))
         insurance_type_text = "Seguro Completo" if lead_data.get('selected_insurance_type') == 'FullCoverage' else "Responsabilidad Civil"
-        
         quote_data = [
             ['Aseguradora:', lead_data.get('selected_insurer', 'No especificada')],
             ['Tipo de Seguro:', insurance_type_text],
             ['Prima Mensual:', f"Q{lead_data.get('selected_quote_price', 0):,.2f}" if lead_data.get('selected_quote_price') else 'No especificada'],
             ['Municipio:', lead_data.get('municipality', 'Guatemala')]
         ]
-        
-        quote_table = Table(quote_data, colWidths=[2*inch, 3*inch])
-        quote_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#FEF3C7')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), HexColor('#0F172A')),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 11),
-            ('GRID', (0, 0), (-1, -1), 1, HexColor('#E5E7EB'))
-        ]))
-        story.append(quote_table)
+        story.extend(self._section("quote", quote_data, self.quote_table_style))
         story.append(Spacer(1, 20))
         
         # Broker Info
-        story.append(Paragraph("Corredor Asignado", subtitle_style))
         broker_data_table = [
             ['Nombre:', broker_data.get('name', 'No asignado')],
             ['Corretaje:', broker_data.get('corretaje_name', 'No especificado')],
             ['Credencial:', broker_data.get('credential_id', 'No especificada')],
             ['Teléfono:', broker_data.get('phone_number', 'No especificado')]
         ]
-        
-        broker_table = Table(broker_data_table, colWidths=[2*inch, 3*inch])
-        broker_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), HexColor('#EFF6FF')),
-            ('TEXTCOLOR', (0, 0), (-1, -1), HexColor('#0F172A')),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 11),
-            ('GRID', (0, 0), (-1, -1), 1, HexColor('#E5E7EB'))
-        ]))
-        story.append(broker_table)
+        story.extend(self._section("broker", broker_data_table, self.broker_table_style))
         story.append(Spacer(1, 30))
         
         # Disclaimer
-        disclaimer_text = """
-        <b>AVISO IMPORTANTE:</b><br/>
-        ProtegeYa es un comparador y generador de leads. No es aseguradora ni corredor. 
-        Los precios mostrados son indicativos y deben ser confirmados con un corredor autorizado.
-        <br/><br/>
-        Para proceder con la contratación, el corredor asignado se pondrá en contacto contigo 
-        en las próximas horas para finalizar el proceso y confirmar los detalles de tu póliza.
-        """
+        story.append(copy.copy(self.disclaimer))
         
-        disclaimer_style = ParagraphStyle(
-            'Disclaimer',
-            parent=styles['Normal'],
-            fontSize=10,
-            textColor=HexColor('#6B7280'),
-            borderWidth=1,
-            borderColor=HexColor('#D1D5DB'),
-            borderPadding=10,
-            backColor=HexColor('#F9FAFB')
-        )
+        return story
+
+    def render(self, lead_data: dict, broker_data: dict, target) -> None:
+        """Render one quote into target (a file path or a binary file-like object)"""
+        doc = SimpleDocTemplate(target, pagesize=letter)
+        doc.build(self.build_story(lead_data, broker_data))
+
+_quote_pdf_template: Optional[QuotePdfTemplate] = None
+
+def get_quote_pdf_template() -> QuotePdfTemplate:
+    """Return the process-wide PDF template, building it on first use"""
+    global _quote_pdf_template
+    if _quote_pdf_template is None:
+        _quote_pdf_template = QuotePdfTemplate(logo_path=PDF_BRAND_LOGO_PATH)
+    return _quote_pdf_template
+
+# ========== PDF CACHE ==========
+
+QUOTE_PDF_CACHE_SIZE = int(os.environ.get('QUOTE_PDF_CACHE_SIZE', '256'))
+ULTRAMSG_PDF_MEDIA_REUSE = os.environ.get('ULTRAMSG_PDF_MEDIA_REUSE', 'false').lower() == 'true'
+
+# Campos que aparecen en el PDF; cualquier cambio en ellos produce otro PDF
+QUOTE_PDF_LEAD_FIELDS = [
+    "id", "name", "phone_number", "vehicle_make", "vehicle_model", "vehicle_year", "vehicle_value",
+    "selected_insurer", "selected_insurance_type", "selected_quote_price", "municipality"
+]
+QUOTE_PDF_BROKER_FIELDS = ["name", "corretaje_name", "credential_id", "phone_number"]
+
+# content hash -> {"pdf_bytes": bytes, "media_url": Optional[str]}
+quote_pdf_cache = LRUCache(maxsize=QUOTE_PDF_CACHE_SIZE)
+
+def quote_pdf_cache_key(lead_data: dict, broker_data: dict) -> str:
+    """Content hash over every input rendered into the quote PDF (including the printed date)"""
+    content = {
+        "lead": {field: lead_data.get(field) for field in QUOTE_PDF_LEAD_FIELDS},
+        "broker": {field: broker_data.get(field) for field in QUOTE_PDF_BROKER_FIELDS},
+        "date": datetime.now(GUATEMALA_TZ).strftime('%d/%m/%Y')
+    }
+    canonical = json.dumps(content, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def render_quote_pdf_bytes(lead_data: dict, broker_data: dict) -> bytes:
+    """Render a quote PDF in memory"""
+    buffer = io.BytesIO()
+    get_quote_pdf_template().render(lead_data, broker_data, buffer)
+    return buffer.getvalue()
+
+async def generate_quote_pdf(lead_data: dict, broker_data: dict) -> str:
+    """Generate PDF quote and return file path (repeat selections reuse the cached bytes)"""
+    try:
+        cache_key = quote_pdf_cache_key(lead_data, broker_data)
+        cached = quote_pdf_cache.get(cache_key)
         
-        story.append(Paragraph(disclaimer_text, disclaimer_style))
+        if cached:
+            logging.info(f"PDF cache hit: {cache_key[:12]}")
+        else:
+            cached = {"pdf_bytes": render_quote_pdf_bytes(lead_data, broker_data), "media_url": None}
+            quote_pdf_cache[cache_key] = cached
         
-        # Build PDF
-        doc.build(story)
+        # Create temporary file
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+        pdf_path = temp_file.name
+        temp_file.write(cached["pdf_bytes"])
+        temp_file.close()
         
         logging.info(f"PDF generated successfully: {pdf_path}")
         return pdf_path
@@ -1126,6 +1777,171 @@ async def generate_quote_pdf(lead_data: dict, broker_data: dict) -> str:
         logging.error(f"Error generating PDF: {e}")
         return None
 
+# ========== PORTFOLIO EXPORT ==========
+
+PDF_EXPORT_WORKERS = int(os.environ.get('PDF_EXPORT_WORKERS', '4'))
+PDF_EXPORT_WINDOW = PDF_EXPORT_WORKERS * 2  # PDFs en vuelo por exportación (acota memoria)
+# Tope del PDF único: se arma completo antes del primer byte (~10 ms por hoja) y reportlab guarda cada página
+# hasta el final, así que memoria y espera crecen con los leads. Para más, el ZIP se envía entrada por entrada
+PDF_EXPORT_MAX_LEADS = int(os.environ.get('PDF_EXPORT_MAX_LEADS', '200'))
+
+pdf_export_executor = ThreadPoolExecutor(max_workers=PDF_EXPORT_WORKERS, thread_name_prefix="pdf-export")
+
+class _ZipStreamSink:
+    """Write-only sink that lets zipfile stream entries without seeking"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+async def iter_export_leads(query: dict):
+    """Stream leads matching query with their broker, oldest first, without loading the whole result"""
+    brokers_by_id = {}
+    cursor = db.leads.find(query).sort("created_at", 1).batch_size(100)
+    
+    async for lead in cursor:
+        broker_id = lead.get("assigned_broker_id")
+        if broker_id and broker_id not in brokers_by_id:
+            brokers_by_id[broker_id] = await db.brokers.find_one({"id": broker_id}) or {}
+        yield lead, brokers_by_id.get(broker_id, {})
+
+async def iter_rendered_lead_pdfs(query: dict):
+    """
+    Render lead quote sheets in the worker pool, yielding (lead, pdf_bytes, error) in cursor order
+    A lead that fails to render yields pdf_bytes=None and the error instead of aborting the export
+    """
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    
+    async def settle(lead: dict, future):
+        try:
+            return lead, await future, None
+        except Exception as e:
+            logging.error(f"Error rendering export PDF for lead {lead.get('id')}: {e}")
+            return lead, None, e
+    
+    async for lead, broker in iter_export_leads(query):
+        pending.append((lead, loop.run_in_executor(pdf_export_executor, render_quote_pdf_bytes, lead, broker)))
+        if len(pending) >= PDF_EXPORT_WINDOW:
+            yield await settle(*pending.popleft())
+    
+    while pending:
+        yield await settle(*pending.popleft())
+
+def export_errors_text(errors: List[str]) -> str:
+    return "No se pudieron generar estas cotizaciones:\n\n" + "\n".join(errors) + "\n"
+
+async def stream_leads_zip(query: dict):
+    """
+    Stream a ZIP with one quote PDF per lead, flushing each entry as soon as it is rendered
+    Leads that fail to render (or an export cut short by a database error) are listed in ERRORS.txt,
+    and the archive is always closed so the client never receives a truncated ZIP
+    """
+    sink = _ZipStreamSink()
+    errors = []
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        try:
+            async for lead, pdf_bytes, error in iter_rendered_lead_pdfs(query):
+                if error is not None:
+                    errors.append(f"{lead.get('id', 'lead')}: {type(error).__name__}: {error}")
+                    continue
+                archive.writestr(f"cotizacion_{lead.get('id', 'lead')}.pdf", pdf_bytes)
+                yield sink.drain()
+        except Exception as e:
+            logging.error(f"Portfolio ZIP export interrupted: {e}")
+            errors.append(f"Exportación interrumpida: {type(e).__name__}: {e}")
+        if errors:
+            archive.writestr("ERRORS.txt", export_errors_text(errors))
+    yield sink.drain()
+
+class _PortfolioStory(list):
+    """
+    Flowable list for the single-PDF export that pulls the next lead's quote sheet whenever the layout
+    runs low, so only a few sheets are held in memory instead of the whole portfolio
+    """
+    LOOKAHEAD = 64  # Flowables en cola: más de una hoja completa, para keepWithNext
+    
+    def __init__(self, next_entry):
+        super().__init__()
+        self._next_entry = next_entry
+        self._template = get_quote_pdf_template()
+        self._exhausted = False
+        self.sheets = 0
+        self.errors: List[str] = []
+    
+    def _fill(self):
+        while not self._exhausted and list.__len__(self) < self.LOOKAHEAD:
+            entry = self._next_entry()
+            if entry is None:
+                self._exhausted = True
+                break
+            lead, broker = entry
+            try:
+                sheet = self._template.build_story(lead, broker)
+            except Exception as e:
+                logging.error(f"Error building export sheet for lead {lead.get('id')}: {e}")
+                self.errors.append(f"{lead.get('id', 'lead')}: {type(e).__name__}: {e}")
+                continue
+            if self.sheets:
+                self.append(PageBreak())
+            self.extend(sheet)
+            self.sheets += 1
+    
+    def __len__(self) -> int:
+        self._fill()
+        return list.__len__(self)
+
+def build_portfolio_pdf(next_entry, target) -> None:
+    """
+    Lay out quote sheets as consecutive pages of a single PDF document
+    next_entry: blocking callable returning the next (lead, broker) pair, or None when there are no more
+    """
+    story = _PortfolioStory(next_entry)
+    if not len(story):
+        return
+    SimpleDocTemplate(target, pagesize=letter).build(story)
+    if story.errors:
+        logging.warning(f"Portfolio PDF skipped {len(story.errors)} leads: {story.errors[:5]}")
+
+async def stream_leads_pdf(query: dict, chunk_size: int = 64 * 1024):
+    """
+    Single PDF with one quote sheet per lead, sent in chunks once the whole document is rendered
+    The layout runs in the export pool and pulls leads from the cursor as it goes, so only a few sheets'
+    flowables are held at a time; the finished pages still accumulate until reportlab saves the document,
+    so time to first byte and memory grow with the lead count (bounded by PDF_EXPORT_MAX_LEADS)
+    """
+    loop = asyncio.get_running_loop()
+    entries = iter_export_leads(query)
+    
+    async def next_entry():
+        try:
+            return await entries.__anext__()
+        except StopAsyncIteration:
+            return None
+    
+    def pull_entry():
+        return asyncio.run_coroutine_threadsafe(next_entry(), loop).result()
+    
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+        await loop.run_in_executor(pdf_export_executor, build_portfolio_pdf, pull_entry, spool)
+        spool.seek(0)
+        while True:
+            chunk = spool.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
 async def generate_automatic_quote(vehicle_data: dict, lead_id: str = None) -> str:
     """Generate automatic quote and return formatted summary"""
     try:
@@ -1176,8 +1992,1176 @@ async def generate_automatic_quote(vehicle_data: dict, lead_id: str = None) -> s
         logging.error(f"Error generating automatic quote: {e}")
         return "Hubo un error generando las cotizaciones. Un corredor se pondrá en contacto para ayudarte."
 
-async def process_whatsapp_message(phone_number: str, message: str) -> str:
-    """Process incoming WhatsApp message using AI"""
+# ========== LLM CLIENT ==========
+
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '8'))  # Llamadas simultáneas a OpenAI por proceso
+LLM_CALL_DEADLINE_SECONDS = float(os.environ.get('LLM_CALL_DEADLINE_SECONDS', '20'))  # Incluye la espera por el semáforo
+LLM_HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', 'false').lower() == 'true'
+LLM_HEDGE_MIN_SAMPLES = 20  # Latencias necesarias antes de calcular el p95 para el hedge
+LLM_BREAKER_WINDOW = int(os.environ.get('LLM_BREAKER_WINDOW', '20'))
+LLM_BREAKER_MIN_CALLS = 10
+LLM_BREAKER_ERROR_RATE = float(os.environ.get('LLM_BREAKER_ERROR_RATE', '0.5'))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', '30'))
+
+class LLMUnavailableError(Exception):
+    """Raised when an LLM call is rejected, times out or fails"""
+
+class LLMCircuitBreaker:
+    """
+    Opens after too many failures in the recent window; lets a single trial call through after the cooldown
+    allow() hands out a ticket (epoch, is_trial) that the caller passes back to record(). The epoch changes on
+    every open/close, so outcomes of calls started before a transition (in flight when the breaker tripped,
+    or started before it closed again) are counted as stale instead of closing or re-arming the breaker
+    """
+    
+    def __init__(self, window: int, min_calls: int, error_rate: float, cooldown: float):
+        self.outcomes = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.epoch = 0
+        self.stale_outcomes = 0
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.cooldown else "half_open"
+    
+    def allow(self) -> Optional[Tuple[int, bool]]:
+        """Ticket for one call, or None if the call must be rejected"""
+        state = self.state
+        if state == "closed":
+            return (self.epoch, False)
+        if state == "open" or self.trial_in_flight:
+            return None
+        self.trial_in_flight = True
+        return (self.epoch, True)
+    
+    def _transition(self, opened: bool):
+        self.epoch += 1
+        self.opened_at = time.monotonic() if opened else None
+        self.outcomes.clear()
+    
+    def record(self, ticket: Tuple[int, bool], ok: bool) -> None:
+        epoch, is_trial = ticket
+        if epoch != self.epoch:
+            self.stale_outcomes += 1
+            return
+        
+        if is_trial:
+            # Resultado de la llamada de prueba en half-open
+            self.trial_in_flight = False
+            self._transition(opened=not ok)
+            if ok:
+                logging.info("LLM circuit breaker closed")
+            return
+        
+        self.outcomes.append(ok)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.error_rate:
+            logging.warning(f"LLM circuit breaker opened ({failures}/{len(self.outcomes)} recent calls failed)")
+            self._transition(opened=True)
+    
+    def release(self, ticket: Tuple[int, bool]) -> None:
+        """Give back a ticket whose call was cancelled without an outcome (frees the trial slot)"""
+        epoch, is_trial = ticket
+        if is_trial and epoch == self.epoch:
+            self.trial_in_flight = False
+
+LLM_BACKEND_MODE = os.environ.get('LLM_BACKEND_MODE', 'live').lower()  # live | record | replay
+LLM_FIXTURES_DIR = Path(os.environ.get('LLM_FIXTURES_DIR', str(ROOT_DIR / 'llm_fixtures')))
+LLM_REPLAY_LATENCY_MS = os.environ.get('LLM_REPLAY_LATENCY_MS')  # Vacío = latencia grabada en el fixture
+
+def llm_prompt_hash(kwargs: dict) -> str:
+    """Stable hash of a chat.completions request (model, messages, tools, sampling params)"""
+    canonical = json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class LLMFixtureStore:
+    """One JSON file per prompt hash: request, completion and the latency observed when recorded"""
+    
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.loaded = {}
+    
+    def path(self, prompt_hash: str) -> Path:
+        return self.directory / f"{prompt_hash}.json"
+    
+    def save(self, prompt_hash: str, request: dict, completion: ChatCompletion, latency_ms: float) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fixture = {
+            "request": request,
+            "completion": completion.model_dump(mode="json"),
+            "latency_ms": round(latency_ms, 1),
+            "recorded_at": datetime.now(GUATEMALA_TZ).isoformat()
+        }
+        self.path(prompt_hash).write_text(json.dumps(fixture, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
+        self.loaded[prompt_hash] = fixture
+    
+    def load(self, prompt_hash: str) -> Optional[dict]:
+        if prompt_hash not in self.loaded:
+            path = self.path(prompt_hash)
+            if not path.exists():
+                return None
+            self.loaded[prompt_hash] = json.loads(path.read_text(encoding="utf-8"))
+        return self.loaded[prompt_hash]
+
+class LiveLLMBackend:
+    """Calls OpenAI directly"""
+    
+    async def create(self, **kwargs) -> ChatCompletion:
+        return await openai_client.chat.completions.create(**kwargs)
+
+class RecordingLLMBackend(LiveLLMBackend):
+    """Calls OpenAI and stores every request/completion pair in the fixture store"""
+    
+    def __init__(self, store: LLMFixtureStore):
+        self.store = store
+    
+    async def create(self, **kwargs) -> ChatCompletion:
+        started = time.perf_counter()
+        completion = await super().create(**kwargs)
+        self.store.save(llm_prompt_hash(kwargs), kwargs, completion, (time.perf_counter() - started) * 1000)
+        return completion
+
+class ReplayLLMBackend:
+    """Serves recorded completions by prompt hash with synthetic latency; no network access"""
+    
+    def __init__(self, store: LLMFixtureStore, latency_ms: Optional[float] = None):
+        self.store = store
+        self.latency_ms = latency_ms
+    
+    async def create(self, **kwargs) -> ChatCompletion:
+        prompt_hash = llm_prompt_hash(kwargs)
+        fixture = self.store.load(prompt_hash)
+        if not fixture:
+            raise LookupError(f"No LLM fixture for prompt hash {prompt_hash[:12]} in {self.store.directory}")
+        latency_ms = self.latency_ms if self.latency_ms is not None else fixture.get("latency_ms", 0)
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        return ChatCompletion.model_validate(fixture["completion"])
+
+def build_llm_backend():
+    """Backend for LLM_BACKEND_MODE"""
+    store = LLMFixtureStore(LLM_FIXTURES_DIR)
+    if LLM_BACKEND_MODE == "replay":
+        return ReplayLLMBackend(store, float(LLM_REPLAY_LATENCY_MS) if LLM_REPLAY_LATENCY_MS else None)
+    if LLM_BACKEND_MODE == "record":
+        return RecordingLLMBackend(store)
+    if LLM_BACKEND_MODE != "live":
+        logging.warning(f"Unknown LLM_BACKEND_MODE '{LLM_BACKEND_MODE}', using live")
+    return LiveLLMBackend()
+
+def llm_configured() -> bool:
+    """Whether LLM calls can be served (replay needs no API key)"""
+    return isinstance(llm_backend, ReplayLLMBackend) or openai_client is not None
+
+llm_backend = build_llm_backend()
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+llm_breaker = LLMCircuitBreaker(LLM_BREAKER_WINDOW, LLM_BREAKER_MIN_CALLS, LLM_BREAKER_ERROR_RATE, LLM_BREAKER_COOLDOWN_SECONDS)
+llm_latencies_ms = deque(maxlen=500)
+
+# Métricas del cliente LLM (expuestas en /api/admin/ai/metrics)
+llm_stats = {
+    "calls": 0, "errors": 0, "timeouts": 0, "breaker_rejections": 0,
+    "hedged": 0, "hedge_wins": 0, "prompt_tokens": 0, "completion_tokens": 0,
+    "in_flight": 0,  # Llamadas dentro del semáforo en este momento
+    "legacy_commands": 0  # Comandos en texto de prompts personalizados anteriores a las herramientas
+}
+
+def llm_latency_percentile(q: float) -> Optional[float]:
+    """Latency percentile (ms) over recent successful calls"""
+    if not llm_latencies_ms:
+        return None
+    ordered = sorted(llm_latencies_ms)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def _limited_completion(kwargs: dict):
+    async with llm_semaphore:
+        llm_stats["in_flight"] += 1
+        try:
+            return await llm_backend.create(**kwargs)
+        finally:
+            llm_stats["in_flight"] -= 1
+
+async def _hedged_completion(kwargs: dict):
+    """Primary request plus, if it outlives the p95, a duplicate; the first success wins"""
+    primary = asyncio.ensure_future(_limited_completion(kwargs))
+    hedge = None
+    try:
+        hedge_after = llm_latency_percentile(0.95) if LLM_HEDGE_ENABLED and len(llm_latencies_ms) >= LLM_HEDGE_MIN_SAMPLES else None
+        if hedge_after is None:
+            return await primary
+        
+        done, _ = await asyncio.wait({primary}, timeout=hedge_after / 1000)
+        # Sin cupo libre en el semáforo el hedge solo agregaría carga
+        if done or llm_semaphore.locked():
+            return await primary
+        
+        llm_stats["hedged"] += 1
+        hedge = asyncio.ensure_future(_limited_completion(kwargs))
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        llm_stats["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in (primary, hedge):
+            if task and not task.done():
+                task.cancel()
+
+async def llm_chat_completion(**kwargs):
+    """
+    chat.completions.create behind a process-wide concurrency cap, a per-call deadline,
+    optional hedging and a circuit breaker
+    Raises LLMUnavailableError on rejection, timeout or API error
+    """
+    if not llm_configured():
+        raise LLMUnavailableError("OpenAI client not configured")
+    ticket = llm_breaker.allow()
+    if ticket is None:
+        llm_stats["breaker_rejections"] += 1
+        raise LLMUnavailableError("circuit breaker open")
+    
+    llm_stats["calls"] += 1
+    started = time.perf_counter()
+    try:
+        completion = await asyncio.wait_for(_hedged_completion(kwargs), timeout=LLM_CALL_DEADLINE_SECONDS)
+    except asyncio.TimeoutError:
+        llm_stats["timeouts"] += 1
+        llm_breaker.record(ticket, False)
+        raise LLMUnavailableError(f"deadline of {LLM_CALL_DEADLINE_SECONDS}s exceeded")
+    except asyncio.CancelledError:
+        llm_breaker.release(ticket)
+        raise
+    except Exception as e:
+        llm_stats["errors"] += 1
+        llm_breaker.record(ticket, False)
+        raise LLMUnavailableError(str(e)) from e
+    
+    latency_ms = (time.perf_counter() - started) * 1000
+    llm_latencies_ms.append(latency_ms)
+    llm_breaker.record(ticket, True)
+    if completion.usage:
+        llm_stats["prompt_tokens"] += completion.usage.prompt_tokens or 0
+        llm_stats["completion_tokens"] += completion.usage.completion_tokens or 0
+    logging.info(f"LLM call {kwargs.get('model')} in {latency_ms:.0f} ms")
+    return completion
+
+def degraded_reply(lead: Optional[dict]) -> str:
+    """Deterministic reply while the LLM is unavailable; asks for input the fast path can parse"""
+    if not lead or not lead.get("name"):
+        return "¡Hola! Soy el asistente de ProtegeYa 🇬🇹 Para ayudarte con tu cotización, escríbeme tu nombre completo (ej: Mi nombre es Juan Pérez)."
+    if lead.get("status") == LeadStatus.QUOTED_NO_PREFERENCE and lead.get("quotes"):
+        # Aseguradora y tipo: un tipo a secas con varias aseguradoras cotizadas no lo resuelve el fast path
+        insurer = next((q["insurer_name"] for q in lead["quotes"] if q.get("insurer_name")), "BAM")
+        return f"Para continuar, escríbeme la aseguradora y el tipo de seguro que te interesa, por ejemplo: '{insurer} completo' o '{insurer} RC'."
+    if not lead.get("quote_generated"):
+        return f"Gracias, {lead['name']}. Envíame los datos de tu vehículo en un solo mensaje: marca, modelo, año, valor y municipio (ej: Toyota Corolla 2020 Q150000 Mixco)."
+    return "Recibimos tu mensaje. Tu corredor asignado se pondrá en contacto contigo pronto. 🙏"
+
+# ========== AI TOOLS ==========
+
+# Argumentos de las herramientas que el modelo puede invocar (validados con Pydantic)
+class CapturarNombreArgs(BaseModel):
+    full_name: str = Field(..., min_length=2, description="Nombre completo del usuario")
+
+class GenerarCotizacionArgs(BaseModel):
+    make: str = Field(..., min_length=1, description="Marca del vehículo")
+    model: str = Field(..., min_length=1, description="Modelo del vehículo")
+    year: int = Field(..., ge=1950, le=2100, description="Año del vehículo")
+    value: float = Field(..., gt=0, description="Valor del vehículo en quetzales")
+    municipality: str = Field("Guatemala", description="Municipio donde circula el vehículo")
+
+class SeleccionarAseguradoraArgs(BaseModel):
+    insurer: str = Field(..., min_length=1, description="Nombre de la aseguradora tal como aparece en la cotización")
+    insurance_type: InsuranceType = Field(..., description="FullCoverage (seguro completo) o ThirdParty (responsabilidad civil)")
+    monthly_price: float = Field(..., ge=0, description="Prima mensual de la opción elegida en quetzales")
+
+AI_TOOL_MODELS = {
+    "CAPTURAR_NOMBRE": CapturarNombreArgs,
+    "GENERAR_COTIZACION": GenerarCotizacionArgs,
+    "SELECCIONAR_ASEGURADORA": SeleccionarAseguradoraArgs
+}
+
+AI_TOOL_DESCRIPTIONS = {
+    "CAPTURAR_NOMBRE": "Registra el nombre completo del usuario cuando lo proporciona.",
+    "GENERAR_COTIZACION": "Genera cotizaciones cuando ya se conoce el nombre y los datos completos del vehículo.",
+    "SELECCIONAR_ASEGURADORA": "Registra la aseguradora y el tipo de seguro que el usuario eligió de las cotizaciones mostradas."
+}
+
+AI_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": AI_TOOL_DESCRIPTIONS[name],
+            "parameters": model.model_json_schema()
+        }
+    }
+    for name, model in AI_TOOL_MODELS.items()
+]
+
+def ai_tool_name(action: BaseModel) -> str:
+    """Tool name for a parsed action"""
+    return next(name for name, model in AI_TOOL_MODELS.items() if isinstance(action, model))
+
+def parse_tool_call(tool_call) -> Optional[BaseModel]:
+    """Validate a tool call from the LLM into its argument model; None if unknown or malformed"""
+    model = AI_TOOL_MODELS.get(tool_call.function.name)
+    if not model:
+        logging.warning(f"AI called unknown tool: {tool_call.function.name}")
+        return None
+    try:
+        return model.model_validate_json(tool_call.function.arguments or "{}")
+    except ValidationError as e:
+        logging.warning(f"Invalid arguments for {tool_call.function.name}: {tool_call.function.arguments} ({e.error_count()} errors)")
+        return None
+
+# Prompts personalizados escritos antes de las herramientas piden comandos en el texto ("CAPTURAR_NOMBRE:Juan Pérez").
+# Migración: reemplazar esas instrucciones por "llama CAPTURAR_NOMBRE" (ver DEFAULT_SYSTEM_PROMPT); mientras tanto el
+# comando se interpreta como la herramienta y se quita de la respuesta, para que nunca llegue al cliente
+LEGACY_COMMAND_PATTERN = re.compile(r"[\"'`]?\b(CAPTURAR_NOMBRE|GENERAR?_COTIZACION|SELECCIONAR_ASEGURADORA)\s*:[^\n]*")
+
+def legacy_prompt_commands(prompt: Optional[str]) -> List[str]:
+    """Legacy text commands an ai_chat_prompt still asks the model to write"""
+    return sorted({match.group(1).replace("GENERA_", "GENERAR_") for match in LEGACY_COMMAND_PATTERN.finditer(prompt or "")})
+
+def legacy_insurance_type(label: str) -> InsuranceType:
+    """Type label of an old command ("Seguro Completo", "RC", "FullCoverage") as an InsuranceType"""
+    normalized = f" {normalize_text(label)} "
+    for type_key, patterns in SELECTION_TYPE_PATTERNS:
+        if normalize_text(type_key) in normalized or any(f" {pattern} " in normalized for pattern in patterns):
+            return InsuranceType(type_key)
+    raise ValueError(f"unknown insurance type '{label}'")
+
+def parse_legacy_command(name: str, arguments: str) -> Optional[BaseModel]:
+    """Old "COMANDO:arg1,arg2" text into the same argument model as the tool call; None if malformed"""
+    arguments = arguments.strip().strip("\"'`").strip()
+    parts = [part.strip() for part in arguments.split(",")]
+    try:
+        if name == "CAPTURAR_NOMBRE":
+            return CapturarNombreArgs(full_name=arguments)
+        if name == "GENERAR_COTIZACION":
+            vehicle = {
+                "make": parts[0], "model": parts[1], "year": int(parts[2]),
+                "value": float(re.sub(r"[^\d.]", "", parts[3]))
+            }
+            if len(parts) > 4 and parts[4]:
+                vehicle["municipality"] = parts[4]
+            return GenerarCotizacionArgs(**vehicle)
+        return SeleccionarAseguradoraArgs(
+            insurer=parts[0],
+            insurance_type=legacy_insurance_type(parts[1]),
+            # El precio puede traer separador de miles ("Q1,250.00"), que también es el separador de argumentos
+            monthly_price=float(re.search(r"\d+(?:\.\d+)?", "".join(parts[2:])).group())
+        )
+    except (IndexError, ValueError, AttributeError, ValidationError) as e:
+        logging.warning(f"Invalid legacy command {name}:{arguments} ({e})")
+        return None
+
+def extract_legacy_commands(text: str) -> Tuple[str, Optional[BaseModel]]:
+    """Strip legacy text commands from a reply; returns the clean text and the first command's action"""
+    matches = list(LEGACY_COMMAND_PATTERN.finditer(text))
+    if not matches:
+        return text, None
+    llm_stats["legacy_commands"] += len(matches)
+    first = matches[0]
+    name = first.group(1).replace("GENERA_", "GENERAR_")
+    action = parse_legacy_command(name, first.group(0).split(":", 1)[1])
+    cleaned = re.sub(r"[ \t]+\n", "\n", LEGACY_COMMAND_PATTERN.sub("", text))
+    cleaned = re.sub(r"\n{3,}", "\n\n", cleaned).strip()
+    return cleaned, action
+
+# ========== FAST-PATH PARSER ==========
+
+# Marcas reconocidas por el parser determinístico (las compuestas primero)
+KNOWN_VEHICLE_MAKES = [
+    "Mercedes Benz", "Land Rover", "Alfa Romeo", "Great Wall",
+    "Toyota", "Honda", "Nissan", "Mazda", "Mitsubishi", "Suzuki", "Subaru", "Isuzu", "Hyundai", "Kia",
+    "Chevrolet", "Ford", "Dodge", "Jeep", "Ram", "GMC", "Cadillac", "Chrysler", "Volkswagen", "VW",
+    "Audi", "BMW", "Mercedes", "Volvo", "Peugeot", "Renault", "Fiat", "Mini", "Lexus", "Infiniti",
+    "Acura", "Porsche", "Tesla", "JAC", "Geely", "Chery", "BYD", "MG", "Changan", "Haval", "Yamaha"
+]
+
+SELECTION_TYPE_PATTERNS = [
+    ("FullCoverage", ["seguro completo", "cobertura completa", "el completo", "completo", "integral"]),
+    ("ThirdParty", ["responsabilidad civil", "solo rc", "el rc", "rc"])
+]
+
+# Palabras que pueden acompañar una selección sin volverla ambigua
+SELECTION_FILLER_WORDS = {
+    "el", "la", "de", "del", "con", "quiero", "me", "interesa", "elijo", "escojo", "prefiero",
+    "seguro", "opcion", "por", "favor", "porfa", "gracias", "ok", "si", "y", "tipo", "a", "en"
+}
+
+NAME_PREFIXES = ["mi nombre es", "me llamo", "soy"]
+
+NAME_STOP_WORDS = {
+    "hola", "buenas", "buenos", "dias", "tardes", "noches", "info", "informacion", "cotizar", "cotizacion",
+    "ayuda", "seguro", "seguros", "quiero", "precio", "gracias", "completo", "rc", "carro", "auto", "moto",
+    # Afirmaciones y respuestas cortas que llegan con mayúscula inicial ("Si Claro", "Está Bien")
+    "si", "no", "claro", "bien", "esta", "ok", "okey", "vale", "dale", "listo", "perfecto", "excelente",
+    "bueno", "correcto", "exacto", "gusto", "mucho", "favor", "porfavor", "que", "saludos", "adios"
+}
+
+# Tras "soy"/"me llamo" estas palabras indican otra cosa que un nombre ("soy de Mixco", "soy el dueño")
+NAME_LEADING_PARTICLES = {"de", "del", "la", "el", "en", "los", "las", "un", "una"}
+
+# Métricas del parser (expuestas en /api/admin/ai/metrics)
+fast_path_stats = {"turns": 0, "hits": 0, "by_action": {"CAPTURAR_NOMBRE": 0, "GENERAR_COTIZACION": 0, "SELECCIONAR_ASEGURADORA": 0}}
+
+def normalize_text(text: str) -> str:
+    """Lowercase, strip accents and collapse punctuation to single spaces"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+# Municipios reconocidos por el parser (clave normalizada -> nombre a guardar); los municipios que cubre
+# algún broker también se aceptan. Cualquier otro texto después del valor se deja al LLM
+GUATEMALA_MUNICIPALITIES = {
+    municipality_key(name): name for name in [
+        # Departamento de Guatemala
+        "Guatemala", "Santa Catarina Pinula", "San José Pinula", "San José del Golfo", "Palencia", "Chinautla",
+        "San Pedro Ayampuc", "Mixco", "San Pedro Sacatepéquez", "San Juan Sacatepéquez", "San Raymundo",
+        "Chuarrancho", "Fraijanes", "Amatitlán", "Villa Nueva", "Villa Canales", "San Miguel Petapa",
+        # Sacatepéquez
+        "Antigua Guatemala", "Jocotenango", "Pastores", "Sumpango", "Santo Domingo Xenacoj", "Santiago Sacatepéquez",
+        "San Bartolomé Milpas Altas", "San Lucas Sacatepéquez", "Santa Lucía Milpas Altas", "Magdalena Milpas Altas",
+        "Santa María de Jesús", "Ciudad Vieja", "San Miguel Dueñas", "Alotenango", "San Antonio Aguas Calientes",
+        "Santa Catarina Barahona",
+        # Cabeceras y municipios con más movimiento del resto del país
+        "Chimaltenango", "Tecpán Guatemala", "Patzicía", "El Tejar", "Escuintla", "Santa Lucía Cotzumalguapa",
+        "San José", "Palín", "Masagua", "Tiquisate", "La Democracia", "Nueva Concepción", "Puerto Barrios",
+        "Morales", "Cobán", "San Pedro Carchá", "Tactic", "San Cristóbal Verapaz", "Salamá", "Rabinal",
+        "Guastatoya", "Sanarate", "Zacapa", "Gualán", "Teculután", "Río Hondo", "Estanzuela", "Chiquimula",
+        "Esquipulas", "Ipala", "Jalapa", "Monjas", "Jutiapa", "Asunción Mita", "El Progreso", "Cuilapa",
+        "Barberena", "Chiquimulilla", "Taxisco", "Quetzaltenango", "Salcajá", "Coatepeque",
+        "San Juan Ostuncalco", "Huehuetenango", "Chiantla", "San Marcos",
+        "Malacatán", "Retalhuleu", "Champerico", "Mazatenango", "Cuyotenango", "Totonicapán", "Momostenango",
+        "San Francisco El Alto", "Sololá", "Panajachel", "Santiago Atitlán", "Santa Cruz del Quiché",
+        "Chichicastenango", "Flores", "San Benito", "Santa Ana", "Poptún", "Sayaxché", "La Libertad"
+    ]
+}
+MUNICIPALITY_ALIASES = {"xela": "Quetzaltenango", "antigua": "Antigua Guatemala", "capital": "Guatemala",
+                        "ciudad de guatemala": "Guatemala"}
+
+def known_municipality(text: str) -> Optional[str]:
+    """Canonical name if text is a municipality we know (fixed list or a broker coverage area)"""
+    key = municipality_key(text)
+    if key in MUNICIPALITY_ALIASES:
+        return MUNICIPALITY_ALIASES[key]
+    if key in GUATEMALA_MUNICIPALITIES:
+        return GUATEMALA_MUNICIPALITIES[key]
+    if broker_availability.covers(key):
+        return text.strip().title()
+    return None
+
+def parse_name_turn(message: str) -> Optional[str]:
+    """Recognize a plain name reply ("Juan Pérez", "me llamo Ana López"); anything doubtful goes to the LLM"""
+    text = message.strip().rstrip(".!")
+    normalized = normalize_text(text)
+    for prefix in NAME_PREFIXES:
+        if normalized.startswith(prefix + " "):
+            text = text.split(None, len(prefix.split()))[-1]
+            if normalize_text(text.split()[0]) in NAME_LEADING_PARTICLES:
+                return None
+            break
+    else:
+        # Sin prefijo exigimos el formato de nombre propio (cada palabra en mayúscula)
+        if not all(word[0].isupper() for word in text.split()):
+            return None
+    
+    words = text.split()
+    if not 2 <= len(words) <= 4:
+        return None
+    if not all(re.fullmatch(r"[^\W\d_]+(?:['-][^\W\d_]+)*", word) for word in words):
+        return None
+    
+    vocabulary = NAME_STOP_WORDS | {normalize_text(make) for make in KNOWN_VEHICLE_MAKES}
+    if any(normalize_text(word) in vocabulary for word in words):
+        return None
+    
+    return " ".join(word[0].upper() + word[1:] for word in words)
+
+def parse_vehicle_turn(message: str) -> Optional[Dict[str, Any]]:
+    """Recognize "<marca> <modelo> <año> Q<valor> [municipio]" in a single message"""
+    text = " ".join(message.replace(",", "").split())
+    
+    make = next(
+        (m for m in KNOWN_VEHICLE_MAKES if normalize_text(text).startswith(normalize_text(m) + " ")),
+        None
+    )
+    if not make:
+        return None
+    
+    match = re.fullmatch(
+        r"(?P<model>.+?)\s+(?P<year>19[5-9]\d|20[0-4]\d)\s+(?:(?:vale|valor|de|en|por)\s+)*"
+        r"Q?\.?\s?(?P<value>\d{4,9}(?:\.\d{1,2})?)(?:\s+(?:en\s+)?(?P<municipality>[^\W\d_][^\d]*))?",
+        text[len(make):].strip(),
+        flags=re.IGNORECASE
+    )
+    if not match:
+        return None
+    
+    model = match.group("model").strip()
+    if len(model.split()) > 3:
+        return None
+    
+    municipality = "Guatemala"
+    if match.group("municipality"):
+        # Texto libre después del valor ("quiero cotizar") no es un municipio: que lo interprete el LLM
+        municipality = known_municipality(match.group("municipality"))
+        if not municipality:
+            return None
+    
+    return {
+        "make": make,
+        "model": model,
+        "year": int(match.group("year")),
+        "value": float(match.group("value")),
+        "municipality": municipality
+    }
+
+def parse_selection_turn(message: str, quotes: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Recognize "Completo", "RC", "BAM RC", "el completo de BAM" against the lead's quotes"""
+    normalized = f" {normalize_text(message)} "
+    
+    insurance_type = None
+    for type_key, patterns in SELECTION_TYPE_PATTERNS:
+        for pattern in patterns:
+            if f" {pattern} " in normalized:
+                insurance_type = type_key
+                normalized = normalized.replace(f" {pattern} ", " ")
+                break
+        if insurance_type:
+            break
+    if not insurance_type:
+        return None
+    
+    insurers = {normalize_text(q.get("insurer_name", "")): q.get("insurer_name") for q in quotes if q.get("insurer_name")}
+    mentioned = [name for key, name in insurers.items() if key and f" {key} " in normalized]
+    if len(mentioned) > 1:
+        return None
+    for key in insurers:
+        if key:
+            normalized = normalized.replace(f" {key} ", " ")
+    
+    # Cualquier palabra desconocida vuelve ambigua la selección -> LLM
+    if any(word not in SELECTION_FILLER_WORDS for word in normalized.split()):
+        return None
+    
+    candidates = [
+        q for q in quotes
+        if q.get("insurance_type") == insurance_type and (not mentioned or q.get("insurer_name") == mentioned[0])
+    ]
+    # "Completo" a secas con varias aseguradoras cotizadas no dice cuál: no se elige por el usuario
+    if len(candidates) != 1:
+        return None
+    
+    chosen = candidates[0]
+    return {
+        "insurer": chosen["insurer_name"],
+        "insurance_type": insurance_type,
+        "price": float(chosen["monthly_premium"])
+    }
+
+def parse_structured_turn(message: str, lead: Optional[dict]) -> Optional[BaseModel]:
+    """
+    Deterministic pre-parser for trivially structured turns
+    Returns the same tool arguments the AI would produce, or None to fall back to the LLM
+    """
+    if not lead:
+        return None
+    
+    if not lead.get("name"):
+        name = parse_name_turn(message)
+        return CapturarNombreArgs(full_name=name) if name else None
+    
+    quotes = lead.get("quotes") or []
+    if lead.get("status") == LeadStatus.QUOTED_NO_PREFERENCE and quotes:
+        selection = parse_selection_turn(message, quotes)
+        if selection:
+            return SeleccionarAseguradoraArgs(
+                insurer=selection["insurer"],
+                insurance_type=selection["insurance_type"],
+                monthly_price=selection["price"]
+            )
+    
+    vehicle = parse_vehicle_turn(message)
+    if vehicle:
+        return GenerarCotizacionArgs(**vehicle)
+    
+    return None
+
+def record_fast_path(action: Optional[BaseModel]) -> None:
+    """Update fast-path hit-rate counters"""
+    fast_path_stats["turns"] += 1
+    if action:
+        fast_path_stats["hits"] += 1
+        name = ai_tool_name(action)
+        fast_path_stats["by_action"][name] = fast_path_stats["by_action"].get(name, 0) + 1
+
+# ========== MODEL ROUTING ==========
+
+class AIModelRoute(BaseModel):
+    model: str = Field(..., min_length=1)
+    max_tokens: int = Field(500, ge=16, le=4096)
+    temperature: float = Field(0.7, ge=0, le=2)
+
+# Claves "estado:intención"; "*" vale para cualquier estado. Se sobreescriben por clave desde SystemConfiguration.ai_model_routes
+DEFAULT_AI_MODEL_ROUTES = {
+    "PendingData:collect": {"model": "gpt-4o-mini", "max_tokens": 250, "temperature": 0.5},
+    "PendingData:question": {"model": "gpt-4o-mini", "max_tokens": 400, "temperature": 0.7},
+    "QuotedNoPreference:select": {"model": "gpt-4o", "max_tokens": 300, "temperature": 0.3},
+    "*:question": {"model": "gpt-4o-mini", "max_tokens": 400, "temperature": 0.7},
+    "default": {"model": "gpt-4o", "max_tokens": 500, "temperature": 0.7}
+}
+
+QUESTION_WORDS = {"que", "cuanto", "cuanta", "cuantos", "como", "cual", "cuales", "cuando", "donde", "porque", "puedo", "incluye", "cubre"}
+
+# Métricas de enrutamiento (expuestas en /api/admin/ai/metrics)
+model_route_stats = {}
+
+def detect_intent(message: str, lead: Optional[dict]) -> str:
+    """
+    Cheap intent guess for model routing
+    select: mentions an insurer or coverage type after quoting (the fast path could not resolve it)
+    question: asks something; collect: anything else (data, greetings)
+    """
+    normalized = f" {normalize_text(message)} "
+    if lead and lead.get("quotes"):
+        insurers = {normalize_text(q.get("insurer_name", "")) for q in lead["quotes"]}
+        type_words = {pattern for _, patterns in SELECTION_TYPE_PATTERNS for pattern in patterns}
+        if any(f" {word} " in normalized for word in insurers | type_words if word):
+            return "select"
+    if "?" in message or (normalized.split() and normalized.split()[0] in QUESTION_WORDS):
+        return "question"
+    return "collect"
+
+def select_model_route(lead: Optional[dict], message: str, config: dict) -> Tuple[str, AIModelRoute]:
+    """Pick the model for this turn from lead status and intent; returns (route key, route)"""
+    status = getattr(lead.get("status"), "value", lead.get("status")) if lead else LeadStatus.PENDING_DATA.value
+    intent = detect_intent(message, lead)
+    routes = {**DEFAULT_AI_MODEL_ROUTES, **(config.get("ai_model_routes") or {})}
+    
+    for key in (f"{status}:{intent}", f"*:{intent}", "default"):
+        if key in routes:
+            try:
+                route = AIModelRoute(**routes[key])
+            except (ValidationError, TypeError) as e:
+                logging.error(f"Invalid AI model route '{key}', falling back: {e}")
+                continue
+            model_route_stats[key] = model_route_stats.get(key, 0) + 1
+            return key, route
+    return "default", AIModelRoute(**DEFAULT_AI_MODEL_ROUTES["default"])
+
+# ========== RESPONSE CACHE ==========
+
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '3600'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '512'))
+RESPONSE_CACHE_MAX_WORDS = 6  # Solo saludos y preguntas cortas; mensajes largos suelen traer datos personales
+
+# Respuestas del LLM para turnos sin estado (usuario nuevo, sin datos ni historial), por proceso
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SECONDS)
+response_cache_stats = {"hits": 0, "misses": 0, "stores": 0, "purges": 0}
+
+async def stateless_cache_key(message: str, lead: Optional[dict], phone_number: str, config: dict) -> Optional[str]:
+    """
+    Cache key for a first-contact turn, or None when the reply may depend on conversation state
+    The active ai_chat_prompt and the response_cache_generation are part of the key, so editing the
+    prompt or purging through the admin endpoint invalidates every worker's entries
+    """
+    normalized = normalize_text(message)
+    if not normalized or len(normalized.split()) > RESPONSE_CACHE_MAX_WORDS:
+        return None
+    if lead and (
+        lead.get("name") or lead.get("vehicle_make") or lead.get("quotes")
+        or lead.get("status") not in (LeadStatus.PENDING_DATA, LeadStatus.PENDING_DATA.value)
+    ):
+        return None
+    if await db.interactions.find_one({"metadata.phone_number": phone_number}, {"_id": 1}):
+        return None
+    
+    return f"{system_prompt_version(config)}:{config.get('response_cache_generation', 0)}:new:{normalized}"
+
+def purge_response_cache() -> int:
+    """Drop every cached reply; returns how many entries were removed"""
+    removed = len(response_cache)
+    response_cache.clear()
+    response_cache_stats["purges"] += 1
+    return removed
+
+# ========== SYSTEM PROMPT ==========
+
+DEFAULT_SYSTEM_PROMPT = """Eres el asistente de seguros vehiculares de ProtegeYa, Guatemala 🇬🇹.
+ProtegeYa es un comparador y generador de leads, no aseguradora ni corredor. Los precios son indicativos.
+
+PROCESO:
+1. Si no conoces el nombre completo del usuario, pídelo antes de cotizar. Cuando lo dé, llama CAPTURAR_NOMBRE.
+2. Recopila marca, modelo, año, valor en quetzales y municipio (Guatemala si no lo indica). Con el nombre y los datos completos, llama GENERAR_COTIZACION.
+3. Cuando elija una de las cotizaciones, llama SELECCIONAR_ASEGURADORA con su prima mensual. Si solo menciona el tipo (completo/integral o RC), usa la opción más económica de ese tipo.
+
+Usa el contexto: no vuelvas a pedir datos que ya tienes ni reinicies la conversación. Responde en español guatemalteco, amigable y conciso."""
+
+CUSTOM_PROMPT_TOOLS_NOTE = "Usa las herramientas disponibles para registrar el nombre, generar la cotización y registrar la selección. No escribas comandos en el texto."
+
+# Prompt de sistema ya armado (y sus tokens) por versión de configuración
+system_prompt_cache = LRUCache(maxsize=8)
+
+def system_prompt_version(config: dict) -> str:
+    """Version of the prompt-relevant configuration: a hash of ai_chat_prompt, so any edit yields a new version"""
+    return hashlib.sha256((config.get("ai_chat_prompt") or "").encode("utf-8")).hexdigest()[:16]
+
+def get_system_prompt(config: dict) -> Tuple[str, int, str]:
+    """
+    Final system message for a configuration, built and token-counted once per version
+    Returns (system_message, system_tokens, version). The message is byte-identical across
+    turns so provider-side prefix caching applies; per-turn data goes in the user message
+    """
+    version = system_prompt_version(config)
+    cached = system_prompt_cache.get(version)
+    if cached:
+        return cached
+    
+    custom_prompt = config.get("ai_chat_prompt", "")
+    system_message = f"{custom_prompt}\n\n{CUSTOM_PROMPT_TOOLS_NOTE}" if custom_prompt else DEFAULT_SYSTEM_PROMPT
+    cached = (system_message, count_tokens(system_message), version)
+    system_prompt_cache[version] = cached
+    logging.info(f"Built system prompt version {version} ({cached[1]} tokens)")
+    return cached
+
+# ========== CONVERSATION CONTEXT ==========
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '700'))  # Tokens máximos del mensaje de contexto
+CONTEXT_HISTORY_LIMIT = int(os.environ.get('CONTEXT_HISTORY_LIMIT', '12'))  # Turnos crudos leídos por solicitud
+CONTEXT_SUMMARY_AFTER = int(os.environ.get('CONTEXT_SUMMARY_AFTER', '6'))  # Turnos sin resumir antes de plegarlos
+CONTEXT_SUMMARY_KEEP_RAW = 2  # Turnos recientes que nunca se pliegan al resumen
+CONTEXT_SUMMARY_MODEL = os.environ.get('CONTEXT_SUMMARY_MODEL', 'gpt-4o-mini')
+CONTEXT_SUMMARY_MAX_CHARS = 800
+CONTEXT_TURN_MAX_CHARS = 280
+
+CONTEXT_SUMMARY_PROMPT = """Resume en español, en máximo 4 frases, lo que el cliente de ProtegeYa ha dicho y pedido.
+Conserva datos, dudas y preferencias relevantes para cotizar su seguro vehicular. No inventes datos."""
+
+# Métricas de tokens por turno (expuestas en /api/admin/ai/metrics)
+ai_token_stats = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "context_tokens": 0, "latency_ms": 0.0}
+
+_token_encoder = None
+
+def count_tokens(text: str) -> int:
+    """Token count for gpt-4o; falls back to a chars/4 estimate if the encoding cannot be loaded"""
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            _token_encoder = tiktoken.encoding_for_model("gpt-4o")
+        except Exception as e:
+            logging.warning(f"tiktoken encoding unavailable, estimating tokens: {e}")
+            _token_encoder = False
+    if _token_encoder:
+        return len(_token_encoder.encode(text))
+    return len(text) // 4 + 1
+
+def compact_turn_text(text: str) -> str:
+    """Strip emojis/markdown from a past message and cap its length"""
+    if "Cotizaciones disponibles" in text:
+        return "[envió la lista de cotizaciones]"
+    cleaned = "".join(ch for ch in text if unicodedata.category(ch) != "So").replace("*", "")
+    cleaned = " ".join(cleaned.split())
+    if len(cleaned) > CONTEXT_TURN_MAX_CHARS:
+        cleaned = cleaned[:CONTEXT_TURN_MAX_CHARS - 1] + "…"
+    return cleaned
+
+def format_turn(interaction: dict) -> str:
+    """One past interaction as compact transcript lines"""
+    user_msg = compact_turn_text(interaction.get("content", ""))
+    ai_response = compact_turn_text(interaction.get("metadata", {}).get("response", ""))
+    return f"Usuario: {user_msg}\nAsistente: {ai_response}"
+
+def lead_facts(lead: dict) -> List[str]:
+    """Structured facts about the lead, one short line each"""
+    facts = [
+        f"Nombre: {lead.get('name') or 'No especificado'}",
+        f"Estado: {getattr(lead.get('status'), 'value', lead.get('status')) or 'sin estado'}"
+    ]
+    if lead.get("vehicle_make"):
+        vehicle = f"{lead.get('vehicle_make')} {lead.get('vehicle_model')} {lead.get('vehicle_year')}"
+        if lead.get("vehicle_value"):
+            vehicle += f", Q{lead['vehicle_value']:,.0f}"
+        facts.append(f"Vehículo: {vehicle}, {lead.get('municipality') or 'Guatemala'}")
+    if lead.get("quotes"):
+        options = "; ".join(
+            f"{q['insurer_name']} {q['insurance_type']} Q{q['monthly_premium']:.2f}"
+            for q in lead["quotes"]
+        )
+        facts.append(f"Cotizaciones mostradas: {options}")
+    if lead.get("selected_insurer"):
+        facts.append(f"Selección: {lead['selected_insurer']} {lead.get('selected_insurance_type') or ''} Q{lead.get('selected_quote_price') or 0:.2f}")
+    return facts
+
+def build_conversation_context(phone_number: str, lead: Optional[dict], history: List[dict], message: str) -> Tuple[str, int, int]:
+    """
+    Token-budgeted context: lead facts and rolling summary always, then the newest
+    raw turns that still fit in CONTEXT_TOKEN_BUDGET
+    Returns (context, context_tokens, raw_turns_included)
+    """
+    sections = [f"Usuario actual: {phone_number}"]
+    if lead:
+        sections.append("Datos del lead:\n" + "\n".join(f"- {fact}" for fact in lead_facts(lead)))
+        if lead.get("conversation_summary"):
+            sections.append(f"Resumen de la conversación: {lead['conversation_summary']}")
+    
+    used = count_tokens("\n\n".join(sections)) + count_tokens(message)
+    turns = []
+    for interaction in history:  # Más reciente primero
+        turn = format_turn(interaction)
+        turn_tokens = count_tokens(turn)
+        if used + turn_tokens > CONTEXT_TOKEN_BUDGET:
+            break
+        turns.append(turn)
+        used += turn_tokens
+    
+    if turns:
+        sections.append("Conversación reciente:\n" + "\n".join(reversed(turns)))
+    return "\n\n".join(sections), used, len(turns)
+
+def record_ai_usage(usage: Dict[str, Any]) -> None:
+    """Accumulate per-turn token and latency counters"""
+    ai_token_stats["calls"] += 1
+    for key in ("prompt_tokens", "completion_tokens", "context_tokens", "latency_ms"):
+        ai_token_stats[key] += usage.get(key) or 0
+
+async def roll_conversation_summary(lead_id: str, phone_number: str) -> None:
+    """Fold older raw turns into the lead's rolling summary once enough have accumulated"""
+    if not llm_configured():
+        return
+    try:
+        lead = await db.leads.find_one({"id": lead_id}, {"conversation_summary": 1, "conversation_summary_through": 1})
+        if not lead:
+            return
+        
+        summarized_through = lead.get("conversation_summary_through")
+        query = {"metadata.phone_number": phone_number}
+        if summarized_through:
+            query["created_at"] = {"$gt": summarized_through}
+        pending = await db.interactions.find(query).sort("created_at", 1).to_list(length=CONTEXT_SUMMARY_AFTER * 2)
+        if len(pending) < CONTEXT_SUMMARY_AFTER:
+            return
+        
+        to_fold = pending[:-CONTEXT_SUMMARY_KEEP_RAW]
+        transcript = "\n".join(format_turn(interaction) for interaction in to_fold)
+        completion = await llm_chat_completion(
+            model=CONTEXT_SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": CONTEXT_SUMMARY_PROMPT},
+                {"role": "user", "content": f"Resumen previo: {lead.get('conversation_summary') or 'ninguno'}\n\nConversación:\n{transcript}"}
+            ],
+            temperature=0,
+            max_tokens=150
+        )
+        summary = (completion.choices[0].message.content or "").strip()[:CONTEXT_SUMMARY_MAX_CHARS]
+        if not summary:
+            return
+        
+        # Filtro por el corte anterior: si otro worker ya plegó estos turnos, no se pisa su resumen
+        await db.leads.update_one(
+            {"id": lead_id, "conversation_summary_through": summarized_through},
+            {"$set": {
+                "conversation_summary": summary,
+                "conversation_summary_through": to_fold[-1]["created_at"]
+            }}
+        )
+        logging.info(f"Rolled {len(to_fold)} turns into conversation summary for lead {lead_id}")
+    except Exception as e:
+        logging.error(f"Error rolling conversation summary for lead {lead_id}: {e}")
+
+async def generate_ai_response(user: UserProfile, current_lead: Optional[dict], phone_number: str, message: str, config: dict) -> Optional[Tuple[str, Optional[BaseModel], Dict[str, Any]]]:
+    """Ask the LLM for the next reply, optional tool action and token usage; None on API error"""
+    # Raw turns not yet folded into the rolling summary, newest first
+    history_query = {"metadata.phone_number": phone_number}
+    if current_lead and current_lead.get("conversation_summary_through"):
+        history_query["created_at"] = {"$gt": current_lead["conversation_summary_through"]}
+    conversation_history = await db.interactions.find(history_query).sort(
+        "created_at", -1
+    ).limit(CONTEXT_HISTORY_LIMIT).to_list(length=CONTEXT_HISTORY_LIMIT)
+    
+    system_message, system_tokens, prompt_version = get_system_prompt(config)
+    
+    # Initialize AI chat with conversation history
+    # Build messages array for OpenAI
+    messages = [{"role": "system", "content": system_message}]
+    
+    context, context_tokens, history_turns = build_conversation_context(phone_number, current_lead, conversation_history, message)
+    
+    user_content = f"Contexto: {context}\n\nMensaje del usuario: {message}"
+    messages.append({"role": "user", "content": user_content})
+    
+    logging.info(f"Sending to AI - Context ({context_tokens} tokens, {history_turns} raw turns): {context}")
+    logging.info(f"User message: {message}")
+    
+    route_key, route = select_model_route(current_lead, message, config)
+    logging.info(f"AI route {route_key} -> {route.model} (max_tokens={route.max_tokens})")
+    
+    # Call OpenAI API
+    try:
+        started = time.perf_counter()
+        completion = await llm_chat_completion(
+            model=route.model,
+            messages=messages,
+            temperature=route.temperature,
+            max_tokens=route.max_tokens,
+            tools=AI_TOOLS,
+            tool_choice="auto",
+            prompt_cache_key=f"protegeya-chat-{prompt_version}"
+        )
+        usage = {
+            "prompt_tokens": completion.usage.prompt_tokens if completion.usage else None,
+            "completion_tokens": completion.usage.completion_tokens if completion.usage else None,
+            "cached_tokens": getattr(getattr(completion.usage, "prompt_tokens_details", None), "cached_tokens", None),
+            "system_tokens": system_tokens,
+            "context_tokens": context_tokens,
+            "history_turns": history_turns,
+            "route": route_key,
+            "model": route.model,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        record_ai_usage(usage)
+        
+        ai_message = completion.choices[0].message
+        action = parse_tool_call(ai_message.tool_calls[0]) if ai_message.tool_calls else None
+        content, legacy_action = extract_legacy_commands((ai_message.content or "").strip())
+        return content, action or legacy_action, usage
+    except Exception as e:
+        logging.error(f"OpenAI API error: {e}")
+        return None
+
+# ========== SELECTION PIPELINE ==========
+
+class StageExecutor:
+    """
+    Runs async stages as soon as their dependencies finish and records per-stage timing
+    A stage receives its dependencies' results as positional arguments; if a dependency
+    fails, the stage is skipped and re-raises that error
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.tasks = {}
+        self.timings = {}
+    
+    def add(self, name: str, fn, deps: List[str] = ()):
+        async def run():
+            try:
+                args = [await self.tasks[dep] for dep in deps]
+            except Exception:
+                self.timings[name] = {"status": "skipped"}
+                raise
+            stage_start = time.perf_counter()
+            status = "error"
+            try:
+                result = await fn(*args)
+                status = "ok"
+                return result
+            finally:
+                self.timings[name] = {
+                    "status": status,
+                    "start_ms": round((stage_start - self.started) * 1000, 1),
+                    "duration_ms": round((time.perf_counter() - stage_start) * 1000, 1)
+                }
+        self.tasks[name] = asyncio.ensure_future(run())
+    
+    async def result(self, name: str):
+        return await self.tasks[name]
+    
+    async def finish(self) -> Dict[str, Dict[str, Any]]:
+        """Wait for every stage, then log and aggregate the timings"""
+        outcomes = await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        for stage, outcome in zip(self.tasks, outcomes):
+            if isinstance(outcome, Exception) and self.timings.get(stage, {}).get("status") == "error":
+                logging.error(f"{self.name} stage {stage} failed: {outcome}")
+        record_stage_timings(self.timings)
+        total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        logging.info(f"{self.name} finished in {total_ms} ms: {self.timings}")
+        return self.timings
+
+# Métricas por etapa (expuestas en /api/admin/ai/metrics)
+selection_stage_stats = {}
+
+# Referencias a tareas en segundo plano para que no se recolecten antes de terminar
+background_jobs = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_jobs.add(task)
+    task.add_done_callback(background_jobs.discard)
+    return task
+
+def record_stage_timings(timings: Dict[str, Dict[str, Any]]) -> None:
+    for stage, timing in timings.items():
+        stats = selection_stage_stats.setdefault(stage, {"runs": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["runs"] += 1
+        if timing.get("status") != "ok":
+            stats["errors"] += 1
+            continue
+        stats["total_ms"] += timing["duration_ms"]
+        stats["max_ms"] = max(stats["max_ms"], timing["duration_ms"])
+
+def insurance_type_label(insurance_type: str) -> str:
+    return "Seguro Completo" if insurance_type == "FullCoverage" else "Responsabilidad Civil"
+
+async def run_selection_pipeline(current_lead: dict, selection: SeleccionarAseguradoraArgs, phone_number: str) -> Tuple[str, bool]:
+    """
+    Insurer selection as a stage graph:
+      save_selection (+ broker assignment, one write) -> broker -> reply
+                                                             -> render_pdf -> send_pdf (after reply, so the PDF arrives second)
+    Waits only for the customer reply; the PDF keeps running in the background and the broker
+    notification goes through the notification worker
+    Returns (reply text, whether it was already sent)
+    """
+    lead_id = current_lead["id"]
+    selected_insurer = selection.insurer.strip()
+    insurance_type = selection.insurance_type.value
+    selected_price = selection.monthly_price
+    logging.info(f"Selected: {selected_insurer}, Type: {insurance_type}, Price: {selected_price}")
+    
+    async def save_selection():
+        selection_fields = {
+            "selected_insurer": selected_insurer,
+            "selected_insurance_type": insurance_type,
+            "selected_quote_price": selected_price,
+            "status": LeadStatus.ASSIGNED_TO_BROKER,
+            "broker_status": BrokerLeadStatus.INTERESTED,
+            "updated_at": datetime.now(GUATEMALA_TZ)
+        }
+        
+        # Actualizar también la última cotización en el historial
+        quotations = current_lead.get("quotations", [])
+        if quotations:
+            quotations[-1]["selected_insurer"] = selected_insurer
+            quotations[-1]["selected_type"] = insurance_type
+            quotations[-1]["selected_price"] = selected_price
+            quotations[-1]["selected_at"] = datetime.now(GUATEMALA_TZ).isoformat()
+            selection_fields["quotations"] = quotations
+        
+        # Only assign new broker if not already assigned (for multiple quotes from same lead);
+        # the selection is saved in the same write as the assignment
+        if not current_lead.get("assigned_broker_id"):
+            try:
+                broker, updated_lead = await claim_broker_for_lead(lead_id, selection_fields, current_lead.get("municipality"))
+                if updated_lead:
+                    logging.info(f"NEW broker assigned to lead {lead_id}: {broker['id']}")
+                    return updated_lead, broker
+            except Exception as e:
+                logging.error(f"Error assigning broker: {e}")
+        else:
+            logging.info(f"Lead already has broker {current_lead['assigned_broker_id']}, maintaining assignment")
+        
+        updated_lead = await db.leads.find_one_and_update(
+            {"id": lead_id},
+            {"$set": selection_fields},
+            return_document=ReturnDocument.AFTER
+        )
+        return updated_lead, None
+    
+    async def load_broker(saved):
+        updated_lead, broker = saved
+        if broker:
+            return broker
+        if not updated_lead or not updated_lead.get("assigned_broker_id"):
+            logging.warning("No broker was assigned to lead")
+            return {}
+        broker = await db.brokers.find_one({"id": updated_lead["assigned_broker_id"]})
+        if not broker:
+            logging.warning(f"Broker not found for ID: {updated_lead['assigned_broker_id']}")
+        return broker or {}
+    
+    def broker_info(broker_data):
+        info = f"👤 {broker_data.get('name', 'tu corredor asignado')}"
+        if broker_data.get("credential_id"):
+            info += f"\n🪪 Agente Autorizado: {broker_data['credential_id']}"
+        return info
+    
+    def confirmation(broker_data):
+        return f"¡Perfecto! 🎉\n\nTu selección quedó registrada:\n\n🏢 {selected_insurer}\n💰 Q{selected_price:,.2f} mensual\n📋 {insurance_type_label(insurance_type)}\n\n📞 Tu corredor asignado:\n{broker_info(broker_data)}\n\n📄 En un momento te envío tu cotización en PDF. Tu corredor se pondrá en contacto contigo en las próximas horas.\n\n✅ ¡Gracias por elegir ProtegeYa!"
+    
+    async def reply(broker_data):
+        return await send_whatsapp_message(phone_number, confirmation(broker_data))
+    
+    async def render_pdf(saved, broker_data):
+        return await generate_quote_pdf(saved[0], broker_data)
+    
+    async def send_pdf(saved, broker_data, pdf_path, _reply_sent):
+        updated_lead = saved[0]
+        if pdf_path:
+            caption = f"📄 ¡Tu cotización está lista!\n\n🏢 {selected_insurer}\n💰 Q{selected_price:,.2f}/mes\n📋 {insurance_type_label(insurance_type)}\n\n{broker_info(broker_data)}\n\n¡Tu corredor se pondrá en contacto contigo pronto!"
+            pdf_sent = await send_whatsapp_pdf(
+                phone_number, pdf_path, caption,
+                cache_key=quote_pdf_cache_key(updated_lead, broker_data)
+            )
+            if pdf_sent:
+                await db.leads.update_one(
+                    {"id": lead_id},
+                    {"$set": {"pdf_sent": True, "updated_at": datetime.now(GUATEMALA_TZ)}}
+                )
+                logging.info("PDF sent successfully and lead updated")
+                return True
+        logging.error(f"PDF for lead {lead_id} could not be generated or sent")
+        await send_whatsapp_message(phone_number, "No pude enviarte el PDF en este momento 🙏 Tu corredor te hará llegar la cotización completa.")
+        return False
+    
+    pipeline = StageExecutor(f"Selection pipeline for lead {lead_id}")
+    pipeline.add("save_selection", save_selection)
+    pipeline.add("broker", load_broker, deps=["save_selection"])
+    pipeline.add("reply", reply, deps=["broker"])
+    pipeline.add("render_pdf", render_pdf, deps=["save_selection", "broker"])
+    pipeline.add("send_pdf", send_pdf, deps=["save_selection", "broker", "render_pdf", "reply"])
+    
+    try:
+        broker_data = await pipeline.result("broker")
+        response = confirmation(broker_data)
+        try:
+            reply_sent = await pipeline.result("reply")
+        except Exception as e:
+            logging.error(f"Error sending selection reply: {e}")
+            reply_sent = False
+    finally:
+        spawn_background(pipeline.finish())
+    return response, reply_sent
+
+async def store_interaction(lead: Optional[dict], user_id: str, phone_number: str, message: str, response: str, ai_usage: Optional[Dict[str, Any]]) -> None:
+    """
+    Log one WhatsApp turn
+    created_at is always stored as a BSON datetime: the conversation_summary_through filters compare with $gt,
+    and Mongo never matches across types, so an ISO-string turn would be left out of history and summaries
+    """
+    interaction = LeadInteraction(
+        lead_id=lead["id"] if lead else "none",
+        interaction_type="whatsapp_message",
+        content=message,
+        metadata={
+            "response": response,
+            "phone_number": phone_number,
+            "user_id": user_id,
+            "timestamp": datetime.now(GUATEMALA_TZ).isoformat(),
+            "ai_usage": ai_usage
+        }
+    )
+    interaction_dict = prepare_for_mongo(interaction.dict())
+    interaction_dict["created_at"] = interaction.created_at
+    await db.interactions.insert_one(interaction_dict)
+
+async def process_whatsapp_message(phone_number: str, message: str) -> Optional[str]:
+    """Process incoming WhatsApp message using AI; returns the reply to send, or None if it was already sent"""
     try:
         user = await get_or_create_user(phone_number)
         
@@ -1186,11 +3170,6 @@ async def process_whatsapp_message(phone_number: str, message: str) -> str:
         if not config:
             config = {}
         
-        api_key = OPENAI_API_KEY
-        
-        if not api_key or not openai_client:
-            return "El sistema de chat no está configurado. Contacte al administrador."
-        
         # Get user's current lead if exists (check for any active lead, not just specific statuses)
         current_lead = await db.leads.find_one({
             "user_id": user.id,
@@ -1235,160 +3214,46 @@ async def process_whatsapp_message(phone_number: str, message: str) -> str:
             
             logging.info(f"✅ Lead created successfully: {new_lead.id} for {phone_number}")
         
-        # Get conversation history for context
-        conversation_history = await db.interactions.find({
-            "metadata.phone_number": phone_number
-        }).sort("created_at", -1).limit(5).to_list(length=5)
-        
-        # Build conversation context
-        conversation_context = ""
-        if conversation_history:
-            for interaction in reversed(conversation_history):  # Reverse to get chronological order
-                user_msg = interaction.get("content", "")
-                ai_response = interaction.get("metadata", {}).get("response", "")
-                conversation_context += f"Usuario: {user_msg}\nAsistente: {ai_response}\n\n"
-        
-        # Get custom AI prompt from configuration or use default with quote functionality
-        custom_prompt = config.get("ai_chat_prompt", "")
-        if custom_prompt:
-            system_message = custom_prompt
+        # Fast path: los turnos estructurados se resuelven sin llamar al LLM
+        action = parse_structured_turn(message, current_lead)
+        record_fast_path(action)
+        ai_usage = None
+        reply_sent = False
+        
+        if action:
+            logging.info(f"Fast-path parsed turn: {ai_tool_name(action)} {action.dict()}")
+            response = ""
         else:
-            system_message = """Eres un asistente especializado en seguros vehiculares de ProtegeYa, Guatemala.
-
-ROLE: Experto en recolección de datos vehiculares y generación de cotizaciones.
-
-IMPORTANTE: ProtegeYa es un comparador y generador de leads. No es aseguradora ni corredor. Los precios son indicativos.
-
-CONTEXTO DE CONVERSACIÓN:
-- Mantén el contexto de toda la conversación anterior
-- Si ya tienes el nombre del usuario, NO vuelvas a preguntarlo  
-- Si ya tienes datos del vehículo, úsalos para generar cotización
-- Progresa lógicamente en la conversación
-
-PROCESO PASO A PASO (OBLIGATORIO):
-
-1. CAPTURAR NOMBRE (OBLIGATORIO ANTES DE COTIZAR):
-   Si no conoces el nombre → Pregunta: "¡Hola! Soy el asistente de ProtegeYa 🇬🇹 Para poder ayudarte con una cotización, primero necesito saber tu nombre completo."
-   Cuando respondan su nombre → GENERAR EXACTAMENTE: "CAPTURAR_NOMBRE:[nombre_completo]"
-   ⚠️ CRÍTICO: NO puedes generar cotización sin tener el nombre del usuario primero
-   Si el usuario pide cotizar sin dar nombre → Responde: "Claro, con gusto te ayudo. Pero primero necesito tu nombre completo para poder procesar tu cotización."
-   
-2. RECOPILAR DATOS DEL VEHÍCULO (solo después de tener el nombre):
-   Necesitas: marca, modelo, año, valor en GTQ, municipio
-   Pregunta uno por uno si no están completos.
-   Si el usuario da todo junto (ej: "Toyota Corolla 2020 Q150000") → Úsalo
-   
-3. GENERAR COTIZACIÓN (cuando tengas NOMBRE + datos del vehículo):
-   ⚠️ SOLO si ya tienes el nombre del usuario Y los datos completos del vehículo
-   CUANDO tengas marca + modelo + año + valor → GENERAR EXACTAMENTE:
-   "GENERAR_COTIZACION:[marca],[modelo],[año],[valor],[municipio]"
-   
-4. PROCESAR SELECCIÓN:
-   Después de mostrar cotizaciones, cuando escojan → GENERAR EXACTAMENTE:
-   "SELECCIONAR_ASEGURADORA:[nombre_aseguradora],[tipo_seguro],[precio_mensual]"
-   
-   REGLAS DE SELECCIÓN:
-   - Si mencionan SOLO el tipo (Ej: "Completo" o "RC"): Busca la opción MÁS ECONÓMICA de ese tipo
-   - Si mencionan aseguradora + tipo (Ej: "BANTRAB Completo", "el completo de BAM", "BAM RC"): Busca esa combinación exacta
-   - Variaciones aceptadas para tipo completo: "completo", "seguro completo", "cobertura completa", "integral", "el completo"
-   - Variaciones aceptadas para RC: "RC", "responsabilidad civil", "solo RC", "el RC"
-   - Reconocer patrones: "el [tipo] de [aseguradora]", "[aseguradora] [tipo]", "[tipo] de [aseguradora]"
-
-EJEMPLOS EXACTOS DE RESPUESTA:
-- Usuario: "Mi nombre es Juan Carlos Pérez" → "CAPTURAR_NOMBRE:Juan Carlos Pérez"
-- Usuario: "Toyota Corolla 2020 vale 150000" → "GENERAR_COTIZACION:Toyota,Corolla,2020,150000,Guatemala"
-- Usuario: "Me interesa BANTRAB completo" → "SELECCIONAR_ASEGURADORA:BANTRAB,Seguro Completo,1250.00"
-- Usuario: "el completo de BAM" → "SELECCIONAR_ASEGURADORA:BAM,Seguro Completo,[precio de BAM completo]"
-- Usuario: "quiero el RC de BANTRAB" → "SELECCIONAR_ASEGURADORA:BANTRAB,Responsabilidad Civil,[precio de BANTRAB RC]"
-- Usuario: "BAM integral" → "SELECCIONAR_ASEGURADORA:BAM,Seguro Completo,[precio de BAM completo]"
-- Usuario: "Completo" (solo tipo) → "SELECCIONAR_ASEGURADORA:[Aseguradora más barata],Seguro Completo,[precio]"
-- Usuario: "RC" (solo tipo) → "SELECCIONAR_ASEGURADORA:[Aseguradora más barata],Responsabilidad Civil,[precio]"
-
-INSTRUCCIONES CRÍTICAS:
-- SIEMPRE generar los comandos EXACTOS cuando corresponda
-- NO reiniciar la conversación si ya tienes datos
-- Usar formato guatemalteco amigable
-- Ser conciso pero completo"""
-        
-        # Add special commands to any custom prompt
-        if custom_prompt and "CAPTURAR_NOMBRE" not in custom_prompt:
-            system_message += "\n\nCOMANDOS ESPECIALES REQUERIDOS:"
-            system_message += "\n- Para capturar nombre: 'CAPTURAR_NOMBRE:{nombre_completo}'"
-            system_message += "\n- Para generar cotización: 'GENERAR_COTIZACION:{marca},{modelo},{año},{valor},{municipio}'"
-            system_message += "\n- Para seleccionar aseguradora: 'SELECCIONAR_ASEGURADORA:{aseguradora},{tipo},{precio}'"
-        
-        # Initialize AI chat with conversation history
-        # Build messages array for OpenAI
-        messages = [{"role": "system", "content": system_message}]
-        
-        # Add context about current lead and conversation
-        context = f"Usuario actual: {user.phone_number}"
-        if current_lead:
-            lead_data = current_lead
-            context += f"\nLead ID: {lead_data.get('id', 'N/A')}"
-            context += f"\nEstado: {lead_data.get('status', 'sin estado')}"
-            context += f"\nNombre del usuario: {lead_data.get('name', 'No especificado')}"
-            if lead_data.get('vehicle_make'):
-                context += f"\nVehículo actual: {lead_data.get('vehicle_make')} {lead_data.get('vehicle_model')} {lead_data.get('vehicle_year')}"
-            if lead_data.get('quote_generated'):
-                context += f"\nCotización ya generada: Sí"
-        
-        # Include conversation history in context
-        if conversation_context:
-            context += f"\n\nConversación previa:\n{conversation_context}"
-        
-        user_content = f"Contexto: {context}\n\nMensaje del usuario: {message}"
-        messages.append({"role": "user", "content": user_content})
-        
-        logging.info(f"Sending to AI - Context: {context}")
-        logging.info(f"User message: {message}")
-        
-        # Call OpenAI API
-        try:
-            completion = await openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=500
-            )
-            response = completion.choices[0].message.content
-        except Exception as e:
-            logging.error(f"OpenAI API error: {e}")
-            return "Disculpa, hubo un error procesando tu mensaje. Por favor intenta de nuevo."
-        
-        logging.info(f"AI Response: {response}")
-        
-        # DETECCIÓN INTELIGENTE DE NOMBRE (si no hay comando explícito)
-        # Si el lead no tiene nombre Y el mensaje del usuario parece ser un nombre
-        if current_lead and not current_lead.get("name"):
-            # Verificar si el mensaje es corto (2-4 palabras) y parece un nombre
-            words = message.strip().split()
-            if 2 <= len(words) <= 4 and all(word[0].isupper() for word in words if word):
-                # Parece un nombre
-                potential_name = message.strip()
-                logging.info(f"Auto-detected potential name: {potential_name}")
+            cache_key = await stateless_cache_key(message, current_lead, phone_number, config)
+            cached_response = response_cache.get(cache_key) if cache_key else None
+            
+            if cached_response:
+                response_cache_stats["hits"] += 1
+                logging.info(f"Response cache hit: {cache_key}")
+                response = cached_response
+            else:
+                if not llm_configured():
+                    return "El sistema de chat no está configurado. Contacte al administrador."
                 
-                # Actualizar usuario y lead
-                await db.users.update_one(
-                    {"id": user.id},
-                    {"$set": {"name": potential_name, "updated_at": datetime.now(GUATEMALA_TZ)}}
-                )
-                await db.leads.update_one(
-                    {"id": current_lead["id"]},
-                    {"$set": {"name": potential_name, "updated_at": datetime.now(GUATEMALA_TZ)}}
-                )
-                logging.info(f"Name auto-captured: {potential_name}")
+                ai_result = await generate_ai_response(user, current_lead, phone_number, message, config)
+                if ai_result is None:
+                    return degraded_reply(current_lead)
+                response, action, ai_usage = ai_result
                 
-                # Refrescar current_lead
-                current_lead = await db.leads.find_one({"id": current_lead["id"]})
+                if cache_key:
+                    response_cache_stats["misses"] += 1
+                    # Solo respuestas de texto puro; un turno con herramienta cambia el estado del lead
+                    if response and not action:
+                        response_cache[cache_key] = response
+                        response_cache_stats["stores"] += 1
+        
+        logging.info(f"AI Response: {response} | Tool: {ai_tool_name(action) if action else None}")
         
         # Check if AI wants to capture user name
-        if "CAPTURAR_NOMBRE:" in response:
+        if isinstance(action, CapturarNombreArgs):
             try:
                 logging.info("Processing name capture...")
-                # Extract name from AI response
-                name_data = response.split("CAPTURAR_NOMBRE:")[1].split("\n")[0]
-                user_name = name_data.strip()
+                user_name = action.full_name.strip()
                 
                 logging.info(f"Attempting to save name '{user_name}' for user.id={user.id}, phone={phone_number}")
                 
@@ -1415,9 +3280,8 @@ INSTRUCCIONES CRÍTICAS:
                     logging.warning(f"No current_lead to update with name for {phone_number}")
                 
                 logging.info(f"User name captured and saved: {user_name} for {phone_number}")
-                response = response.replace(f"CAPTURAR_NOMBRE:{user_name}", "").strip()
                 
-                # Si la respuesta quedó vacía después de remover el comando, generar mensaje de seguimiento
+                # Si el modelo no acompañó la herramienta con texto, generar mensaje de seguimiento
                 if not response:
                     response = f"¡Perfecto, {user_name}! 🎉 Ya tengo tu nombre registrado.\n\nAhora necesito los datos de tu vehículo para generar la cotización:\n• Marca (ej: Toyota, Honda)\n• Modelo (ej: Corolla, Civic)\n• Año\n• Valor aproximado en Quetzales\n• Municipio donde circula\n\n¿Me los puedes proporcionar?"
                 
@@ -1425,9 +3289,7 @@ INSTRUCCIONES CRÍTICAS:
                 logging.error(f"Error capturing user name: {e}")
         
         # Check if AI wants to generate a quote
-        response =
-        response.replace("GENERA_COTIZACION:", "GENERAR_COTIZACION:")
-        if "GENERAR_COTIZACION:" in response:
+        elif isinstance(action, GenerarCotizacionArgs):
             try:
                 logging.info("Processing quote generation...")
                 
@@ -1469,19 +3331,8 @@ INSTRUCCIONES CRÍTICAS:
                 # Si no hay nombre en ningún lado, pedirlo
                 if not user_name_for_quote:
                     logging.warning("Attempted to generate quote without user name")
-                    response = response.replace("GENERAR_COTIZACION:", "")
-                    response += "\n\n⚠️ Necesito tu nombre completo antes de generar la cotización. ¿Cuál es tu nombre?"
-                    # Store interaction
-                    interaction = {
-                        "lead_id": current_lead.get("id") if current_lead else None,
-                        "content": message,
-                        "metadata": {
-                            "phone_number": phone_number,
-                            "response": response
-                        },
-                        "created_at": datetime.now(GUATEMALA_TZ)
-                    }
-                    await db.interactions.insert_one(prepare_for_mongo(interaction))
+                    response = f"{response}\n\n⚠️ Necesito tu nombre completo antes de generar la cotización. ¿Cuál es tu nombre?".strip()
+                    await store_interaction(current_lead, user.id, phone_number, message, response, ai_usage)
                     return response
                 
                 # Sincronizar nombre al lead si no lo tiene
@@ -1493,267 +3344,90 @@ INSTRUCCIONES CRÍTICAS:
                     current_lead["name"] = user_name_for_quote
                     logging.info(f"Synced name to lead before quote: {user_name_for_quote}")
                 
-                # Extract vehicle data from AI response
-                quote_data = response.split("GENERAR_COTIZACION:")[1].split("\n")[0]
-                parts = quote_data.split(",")
+                vehicle_data = action.dict()
                 
-                logging.info(f"Quote data parts: {parts}")
+                logging.info(f"Extracted vehicle data: {vehicle_data}")
                 
-                if len(parts) >= 4:
-                    vehicle_data = {
-                        "make": parts[0].strip(),
-                        "model": parts[1].strip(), 
-                        "year": parts[2].strip(),
-                        "value": parts[3].strip(),
-                        "municipality": parts[4].strip() if len(parts) > 4 else "Guatemala"
+                # Update lead with vehicle data
+                if current_lead:
+                    # Crear objeto de cotización para el historial
+                    new_quotation = {
+                        "vehicle_make": vehicle_data["make"],
+                        "vehicle_model": vehicle_data["model"],
+                        "vehicle_year": vehicle_data["year"],
+                        "vehicle_value": vehicle_data["value"],
+                        "municipality": vehicle_data["municipality"],
+                        "quoted_at": datetime.now(GUATEMALA_TZ).isoformat(),
+                        "selected_insurer": "",
+                        "selected_type": "",
+                        "selected_price": None
                     }
                     
-                    logging.info(f"Extracted vehicle data: {vehicle_data}")
+                    # Si es la primera cotización, actualizar campos principales
+                    # Si no, solo agregar al historial
+                    is_first_quote = not current_lead.get("quote_generated", False)
                     
-                    # Update lead with vehicle data
-                    if current_lead:
-                        # Crear objeto de cotización para el historial
-                        new_quotation = {
+                    update_data = {
+                        "status": LeadStatus.QUOTED_NO_PREFERENCE,
+                        "quote_generated": True,
+                        "updated_at": datetime.now(GUATEMALA_TZ)
+                    }
+                    
+                    # Solo actualizar campos principales si es la primera cotización
+                    if is_first_quote:
+                        update_data.update({
                             "vehicle_make": vehicle_data["make"],
                             "vehicle_model": vehicle_data["model"],
-                            "vehicle_year": int(vehicle_data["year"]),
-                            "vehicle_value": float(vehicle_data["value"]),
-                            "municipality": vehicle_data["municipality"],
-                            "quoted_at": datetime.now(GUATEMALA_TZ).isoformat(),
-                            "selected_insurer": "",
-                            "selected_type": "",
-                            "selected_price": None
-                        }
-                        
-                        # Si es la primera cotización, actualizar campos principales
-                        # Si no, solo agregar al historial
-                        is_first_quote = not current_lead.get("quote_generated", False)
-                        
-                        update_data = {
-                            "status": LeadStatus.QUOTED_NO_PREFERENCE,
-                            "quote_generated": True,
-                            "updated_at": datetime.now(GUATEMALA_TZ)
-                        }
-                        
-                        # Solo actualizar campos principales si es la primera cotización
-                        if is_first_quote:
-                            update_data.update({
-                                "vehicle_make": vehicle_data["make"],
-                                "vehicle_model": vehicle_data["model"],
-                                "vehicle_year": int(vehicle_data["year"]),
-                                "vehicle_value": float(vehicle_data["value"]),
-                                "municipality": vehicle_data["municipality"]
-                            })
-                        
-                        await db.leads.update_one(
-                            {"id": current_lead["id"]},
-                            {
-                                "$set": update_data,
-                                "$push": {"quotations": new_quotation}
-                            }
-                        )
-                        logging.info(f"Updated lead with vehicle data (quote #{len(current_lead.get('quotations', [])) + 1}): {current_lead['id']}")
-                    
-                    # Generate and return quote
-                    lead_id = current_lead["id"] if current_lead else None
-                    quote_response = await generate_automatic_quote(vehicle_data, lead_id)
-                    response = quote_response
-                    logging.info("Quote generation completed")
+                            "vehicle_year": vehicle_data["year"],
+                            "vehicle_value": vehicle_data["value"],
+                            "municipality": vehicle_data["municipality"]
+                        })
                     
+                    await db.leads.update_one(
+                        {"id": current_lead["id"]},
+                        {
+                            "$set": update_data,
+                            "$push": {"quotations": new_quotation}
+                        }
+                    )
+                    logging.info(f"Updated lead with vehicle data (quote #{len(current_lead.get('quotations', [])) + 1}): {current_lead['id']}")
+                
+                # Generate and return quote
+                lead_id = current_lead["id"] if current_lead else None
+                quote_response = await generate_automatic_quote(vehicle_data, lead_id)
+                response = quote_response
+                logging.info("Quote generation completed")
+                
             except Exception as e:
                 logging.error(f"Error processing quote generation: {e}")
                 response = "Tengo los datos de tu vehículo. Un corredor se pondrá en contacto contigo pronto para completar la cotización."
         
         # Check if AI wants to select insurer and generate PDF
-        elif "SELECCIONAR_ASEGURADORA:" in response:
+        elif isinstance(action, SeleccionarAseguradoraArgs):
             try:
                 logging.info(f"Processing insurer selection for {phone_number}")
                 
-                # Extract selection data
-                selection_data = response.split("SELECCIONAR_ASEGURADORA:")[1].split("\n")[0]
-                parts = selection_data.split(",")
-                
-                logging.info(f"Selection data parts: {parts}")
-                
-                if len(parts) >= 3 and current_lead:
-                    selected_insurer = parts[0].strip()
-                    selected_type = parts[1].strip()
-                    import re
-
-                    price_match = re.search(r"\d+(?: \.\d+)?", parts[2])
-                    
-                    if price_match:
-                        selected_price = float(price_match.group())
-                    
-                    else:
-                         logging.error(f"Could not parse price from: {repr(parts[2])}")
-                         selected_price = 0.0
-                    
-                    # Determine insurance type
-                    insurance_type = "FullCoverage" if any(word in selected_type.lower() for word in ["completo", "full", "total"]) else "ThirdParty"
-                    
-                    logging.info(f"Selected: {selected_insurer}, Type: {insurance_type}, Price: {selected_price}")
-                    
-                    # Check if broker already assigned (for multiple quotes from same lead)
-                    assigned_broker_id = current_lead.get("assigned_broker_id")
-                    
-                    # Only assign new broker if not already assigned
-                    if not assigned_broker_id:
-                        try:
-                            assigned_broker_id = await assign_broker_to_lead(current_lead["id"])
-                            logging.info(f"NEW broker assigned to lead {current_lead['id']}: {assigned_broker_id}")
-                        except Exception as e:
-                            logging.error(f"Error assigning broker: {e}")
-                    else:
-                        logging.info(f"Lead already has broker {assigned_broker_id}, maintaining assignment")
-                    
-                    # Update lead with selection AND broker assignment
-                    update_data = {
-                        "selected_insurer": selected_insurer,
-                        "selected_insurance_type": insurance_type,
-                        "selected_quote_price": selected_price,
-                        "status": LeadStatus.ASSIGNED_TO_BROKER,
-                        "broker_status": BrokerLeadStatus.INTERESTED,
-                        "updated_at": datetime.now(GUATEMALA_TZ)
-                    }
-                    
-                    if assigned_broker_id:
-                        update_data["assigned_broker_id"] = assigned_broker_id
-                    
-                    # Actualizar también la última cotización en el historial
-                    quotations = current_lead.get("quotations", [])
-                    if quotations:
-                        # Actualizar la última cotización con la selección
-                        quotations[-1]["selected_insurer"] = selected_insurer
-                        quotations[-1]["selected_type"] = insurance_type
-                        quotations[-1]["selected_price"] = selected_price
-                        quotations[-1]["selected_at"] = datetime.now(GUATEMALA_TZ).isoformat()
-                        update_data["quotations"] = quotations
-                    
-                    update_result = await db.leads.update_one(
-                        {"id": current_lead["id"]},
-                        {"$set": update_data}
-                    )
-                    
-                    logging.info(f"Lead update result: {update_result.modified_count}")
-                    
-                    # Get updated lead and broker data
-                    updated_lead = await db.leads.find_one({"id": current_lead["id"]})
-                    broker_data = {}
-                    broker_name = "tu corredor asignado"
-                    broker_credential = ""
-                    
-                    if updated_lead and updated_lead.get("assigned_broker_id"):
-                        broker = await db.brokers.find_one({"id": updated_lead["assigned_broker_id"]})
-                        if broker:
-                            broker_data = broker
-                            broker_name = broker.get("name", "tu corredor")
-                            broker_credential = broker.get("credential_id", "")
-                            logging.info(f"Found assigned broker: {broker_name} (Credential: {broker_credential})")
-                        else:
-                            logging.warning(f"Broker not found for ID: {updated_lead['assigned_broker_id']}")
-                    else:
-                        logging.warning("No broker was assigned to lead")
-                    
-                    # Mensaje con información del broker
-                    broker_info = f"👤 {broker_name}"
-                    if broker_credential:
-                        broker_info += f"\n🪪 Agente Autorizado: {broker_credential}"
-                    
-                    # Generate PDF
-                    logging.info("Generating PDF...")
-                    pdf_path = await generate_quote_pdf(updated_lead, broker_data)
-                    
-                    if pdf_path:
-                        logging.info(f"PDF generated at: {pdf_path}")
-                        
-                        # Send PDF via WhatsApp
-                        caption = f"📄 ¡Tu cotización está lista!\n\n🏢 {selected_insurer}\n💰 Q{selected_price:,.2f}/mes\n📋 {'Seguro Completo' if insurance_type == 'FullCoverage' else 'Responsabilidad Civil'}\n\n{broker_info}\n\n¡Tu corredor se pondrá en contacto contigo pronto!"
-                        
-                        logging.info(f"Sending PDF to {phone_number}")
-                        pdf_sent = await send_whatsapp_pdf(phone_number, pdf_path, caption)
-                        
-                        if pdf_sent:
-                            await db.leads.update_one(
-                                {"id": current_lead["id"]},
-                                {"$set": {"pdf_sent": True, "updated_at": datetime.now(GUATEMALA_TZ)}}
-                            )
-                            
-                            logging.info("PDF sent successfully and lead updated")
-                            response = f"¡Perfecto! 🎉\n\nHe enviado tu cotización en PDF con todos los detalles:\n\n🏢 {selected_insurer}\n💰 Q{selected_price:,.2f} mensual\n📋 {'Seguro Completo' if insurance_type == 'FullCoverage' else 'Responsabilidad Civil'}\n\n📞 Tu corredor asignado:\n{broker_info}\n\nSe pondrá en contacto contigo en las próximas horas.\n\n✅ ¡Gracias por elegir ProtegeYa!"
-                        else:
-                            logging.error("Failed to send PDF")
-                            response = f"Tu selección ha sido registrada:\n\n🏢 {selected_insurer}\n💰 Q{selected_price:,.2f}/mes\n\n📞 Tu corredor asignado:\n{broker_info}\n\nSe pondrá en contacto contigo pronto con toda la información."
-                    else:
-                        logging.error("Failed to generate PDF")
-                        response = f"Tu selección ha sido registrada:\n\n🏢 {selected_insurer}\n💰 Q{selected_price:,.2f}/mes\n\n📞 Tu corredor asignado:\n{broker_info}\n\nSe pondrá en contacto contigo pronto para completar el proceso."
+                if current_lead:
+                    response, reply_sent = await run_selection_pipeline(current_lead, action, phone_number)
                 else:
-                    logging.error(f"Invalid selection format. Parts count: {len(parts)}, Current lead: {current_lead is not None}")
+                    logging.error(f"Insurer selection without an active lead for {phone_number}")
                     response = "No pude procesar tu selección. Por favor indica claramente qué aseguradora y tipo de seguro te interesa."
                         
             except Exception as e:
                 logging.error(f"Error processing insurer selection: {e}")
-                logging.error(f"Selection raw data: {response}")
+                logging.error(f"Selection args: {action.dict()}")
                 response = "Tu selección ha sido registrada. Un corredor se pondrá en contacto contigo pronto."
         
-        # Check if user is trying to select an insurer in natural language
-        elif current_lead and current_lead.get("quote_generated") and any(word in message.lower() for word in ["me interesa", "quiero", "elijo", "escojo", "prefiero"]):
-            try:
-                # Try to extract insurer and type from natural language
-                insurers = ["El Roble", "Seguros Universal", "Aseguradora Rural", "Bantrab"]
-                types = ["completo", "responsabilidad", "civil", "basico"]
-                
-                selected_insurer = None
-                selected_type = "completo"  # default
-                
-                for insurer in insurers:
-                    if insurer.lower() in message.lower():
-                        selected_insurer = insurer
-                        break
-                
-                for tipo in types:
-                    if tipo.lower() in message.lower():
-                        selected_type = tipo
-                        break
-                
-                if selected_insurer:
-                    # Try to find the price from the last quotes generated
-                    quotes = current_lead.get("quotes", [])
-                    selected_price = 1000.0  # default fallback
-                    
-                    for quote in quotes:
-                        if quote.get("insurer_name", "").lower() in selected_insurer.lower():
-                            selected_price = quote.get("monthly_premium", 1000.0)
-                            break
-                    
-                    logging.info(f"Natural language selection: {selected_insurer}, {selected_type}, {selected_price}")
-                    
-                    # Process as if it were a structured selection
-                    selection_string = f"SELECCIONAR_ASEGURADORA:{selected_insurer},{selected_type},{selected_price}"
-                    response = selection_string + "\n" + response
-                    
-                    logging.info(f"Generated selection string: {selection_string}")
-                    
-            except Exception as e:
-                logging.error(f"Error processing natural language selection: {e}")
-        
-        # Log interaction
-        interaction = LeadInteraction(
-            lead_id=current_lead["id"] if current_lead else "none",
-            interaction_type="whatsapp_message",
-            content=message,
-            metadata={
-                "response": response,
-                "phone_number": phone_number,
-                "user_id": user.id,
-                "timestamp": datetime.now(GUATEMALA_TZ).isoformat()
-            }
-        )
-        interaction_dict = prepare_for_mongo(interaction.dict())
-        interaction_dict["created_at"] = datetime.now(GUATEMALA_TZ)
-        await db.interactions.insert_one(interaction_dict)
+        if not response:
+            response = "Disculpa, no logré entender tu mensaje. ¿Me lo puedes repetir con un poco más de detalle?"
         
-        return response
+        await store_interaction(current_lead, user.id, phone_number, message, response, ai_usage)
+        
+        if current_lead:
+            spawn_background(roll_conversation_summary(current_lead["id"], phone_number))
+        
+        # None = la respuesta ya se envió desde el pipeline de selección
+        return None if reply_sent else response
         
     except Exception as e:
         logging.error(f"Error processing WhatsApp message: {e}")
@@ -1853,6 +3527,7 @@ async def toggle_user_status(user_id: str, current_admin: UserResponse = Depends
             {"user_id": user_id},
             {"$set": {"subscription_status": broker_status}}
         )
+        await broker_availability.refresh(user_id=user_id)
     
     return {"success": True, "active": new_status}
 
@@ -1953,6 +3628,7 @@ async def delete_user(user_id: str, current_admin: UserResponse = Depends(requir
             
             # Delete broker profile
             await db.brokers.delete_one({"id": broker_id})
+            broker_availability.discard(broker_id)
     
     # Delete auth user
     await db.auth_users.delete_one({"id": user_id})
@@ -2079,6 +3755,9 @@ async def handle_whatsapp_message_async(phone_number: str, message: str):
             return
         
         response = await process_whatsapp_message(phone_number, message)
+        if response is None:
+            logging.info(f"Reply already delivered by the selection pipeline to {phone_number}")
+            return
         
         # Log if response is empty
         if not response or response.strip() == "":
@@ -2155,21 +3834,25 @@ async def send_whatsapp_message(phone_number: str, message: str) -> bool:
         logging.error(f"Error sending WhatsApp message: {e}")
         return False
 
+def format_broker_phone(broker_data: dict) -> Optional[str]:
+    """Broker WhatsApp number cleaned and prefixed with 502 when it is a local 8-digit number"""
+    broker_whatsapp = broker_data.get("whatsapp_number") or broker_data.get("phone_number")
+    if not broker_whatsapp:
+        return None
+    
+    broker_phone = broker_whatsapp.replace("+", "").replace("-", "").replace(" ", "")
+    if not broker_phone.startswith("502") and len(broker_phone) == 8:
+        broker_phone = f"502{broker_phone}"
+    return broker_phone
+
 async def send_broker_lead_notification(broker_data: dict, lead_data: dict) -> bool:
     """Send WhatsApp notification to broker about new lead assignment"""
     try:
-        # Get broker's WhatsApp number
-        broker_whatsapp = broker_data.get("whatsapp_number") or broker_data.get("phone_number")
-        
-        if not broker_whatsapp:
+        broker_phone = format_broker_phone(broker_data)
+        if not broker_phone:
             logging.warning(f"No WhatsApp number found for broker {broker_data.get('name', 'Unknown')}")
             return False
         
-        # Clean and format phone number
-        broker_phone = broker_whatsapp.replace("+", "").replace("-", "").replace(" ", "")
-        if not broker_phone.startswith("502") and len(broker_phone) == 8:
-            broker_phone = f"502{broker_phone}"
-        
         # Get lead details
         client_name = lead_data.get("name", "Cliente")
         client_phone = lead_data.get("phone_number", "No especificado")
@@ -2196,32 +3879,468 @@ async def send_broker_lead_notification(broker_data: dict, lead_data: dict) -> b
         # Create notification message
         notification_message = f"""🔔 *Nuevo Lead Asignado - ProtegeYa*
 
-👤 *Cliente:* {client_name}
-📱 *Teléfono:* {client_phone}{vehicle_info}{insurer_info}
+👤 *Cliente:* {client_name}
+📱 *Teléfono:* {client_phone}{vehicle_info}{insurer_info}
+
+⏰ *Plazo de contacto:* 2 horas
+🎯 *Estado:* Interesado en cotización
+
+¡Contacta al cliente lo antes posible para cerrar la venta!
+
+_Mensaje automático de ProtegeYa_"""
+
+        # Send notification
+        success = await send_whatsapp_message(broker_phone, notification_message)
+        
+        if success:
+            logging.info(f"Lead notification sent successfully to broker {broker_data.get('name', 'Unknown')} at {broker_phone}")
+        else:
+            logging.error(f"Failed to send lead notification to broker {broker_data.get('name', 'Unknown')}")
+        
+        return success
+        
+    except Exception as e:
+        logging.error(f"Error sending broker notification: {e}")
+        return False
+
+# ========== LEAD NOTIFICATIONS ==========
+
+NOTIFICATION_MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_MAX_ATTEMPTS', '5'))
+NOTIFICATION_RETRY_BASE_SECONDS = int(os.environ.get('NOTIFICATION_RETRY_BASE_SECONDS', '30'))  # 30s, 60s, 120s...
+NOTIFICATION_LOCK_SECONDS = 120  # Tiempo que un worker retiene un evento antes de que otro pueda reintentarlo
+NOTIFICATION_SWEEP_BATCH = 100
+
+LEAD_NOTIFICATION_FIELDS = [
+    "id", "name", "phone_number", "vehicle_make", "vehicle_model", "vehicle_year", "vehicle_value",
+    "selected_insurer", "selected_insurance_type", "selected_quote_price"
+]
+BROKER_NOTIFICATION_FIELDS = ["id", "name", "whatsapp_number", "phone_number"]
+
+async def emit_lead_assigned(lead: dict, broker: dict) -> str:
+    """Record a lead_assigned event and hand it to the notification worker; returns the event id"""
+    event = NotificationEvent(
+        event_type="lead_assigned",
+        lead_id=lead["id"],
+        broker_id=broker["id"],
+        payload={
+            "lead": {field: lead.get(field) for field in LEAD_NOTIFICATION_FIELDS},
+            "broker": {field: broker.get(field) for field in BROKER_NOTIFICATION_FIELDS}
+        }
+    )
+    await db.notification_events.insert_one(prepare_for_mongo(event.dict()))
+    spawn_background(process_notification_event(event.id))
+    return event.id
+
+async def claim_notification_event(event_id: Optional[str] = None) -> Optional[dict]:
+    """Atomically take a due event (pending, or stuck in sending past its lock) and mark it as sending"""
+    now = datetime.now(GUATEMALA_TZ)
+    query = {"$or": [
+        {"status": NotificationStatus.PENDING, "next_attempt_at": {"$lte": now.isoformat()}},
+        {"status": NotificationStatus.SENDING, "locked_until": {"$lte": now.isoformat()}}
+    ]}
+    if event_id:
+        query["id"] = event_id
+    return await db.notification_events.find_one_and_update(
+        query,
+        {
+            "$set": {"status": NotificationStatus.SENDING, "locked_until": (now + timedelta(seconds=NOTIFICATION_LOCK_SECONDS)).isoformat()},
+            "$inc": {"attempts": 1}
+        },
+        return_document=ReturnDocument.AFTER
+    )
+
+async def deliver_notification_event(event: dict) -> bool:
+    """Send a claimed event and record the outcome (sent, retry with backoff, or failed)"""
+    broker = event["payload"].get("broker", {})
+    error = None
+    delivered = False
+    if not (broker.get("whatsapp_number") or broker.get("phone_number")):
+        error = "Broker has no WhatsApp number"
+    else:
+        try:
+            if event["event_type"] == "lead_assigned":
+                delivered = await send_broker_lead_notification(broker, event["payload"].get("lead", {}))
+            else:
+                delivered = await send_whatsapp_message(format_broker_phone(broker), render_broker_digest(event))
+            if not delivered:
+                error = "UltraMSG did not accept the message"
+        except Exception as e:
+            error = str(e)
+    
+    now = datetime.now(GUATEMALA_TZ)
+    if delivered:
+        update = {"status": NotificationStatus.SENT, "sent_at": now.isoformat(), "locked_until": None, "last_error": None}
+    elif event["attempts"] >= NOTIFICATION_MAX_ATTEMPTS or not (broker.get("whatsapp_number") or broker.get("phone_number")):
+        update = {"status": NotificationStatus.FAILED, "locked_until": None, "last_error": error}
+        logging.error(f"Notification {event['id']} ({event['event_type']}) failed after {event['attempts']} attempts: {error}")
+    else:
+        retry_at = now + timedelta(seconds=NOTIFICATION_RETRY_BASE_SECONDS * 2 ** (event["attempts"] - 1))
+        update = {"status": NotificationStatus.PENDING, "next_attempt_at": retry_at.isoformat(), "locked_until": None, "last_error": error}
+        logging.warning(f"Notification {event['id']} attempt {event['attempts']} failed ({error}), retrying at {retry_at.isoformat()}")
+    
+    await db.notification_events.update_one({"id": event["id"]}, {"$set": update})
+    return delivered
+
+async def process_notification_event(event_id: str) -> None:
+    """Immediate delivery attempt right after the event is emitted"""
+    try:
+        event = await claim_notification_event(event_id)
+        if event:
+            await deliver_notification_event(event)
+    except Exception as e:
+        logging.error(f"Error processing notification event {event_id}: {e}")
 
-⏰ *Plazo de contacto:* 2 horas
-🎯 *Estado:* Interesado en cotización
+async def process_pending_notifications() -> int:
+    """Scheduled sweep: retries due events and recovers ones left in sending by a crashed worker"""
+    processed = 0
+    try:
+        while processed < NOTIFICATION_SWEEP_BATCH:
+            event = await claim_notification_event()
+            if not event:
+                break
+            await deliver_notification_event(event)
+            processed += 1
+        if processed:
+            logging.info(f"Notification sweep processed {processed} events")
+    except Exception as e:
+        logging.error(f"Error in notification sweep: {e}")
+    return processed
 
-¡Contacta al cliente lo antes posible para cerrar la venta!
+def render_broker_digest(event: dict) -> str:
+    """Consolidated WhatsApp message for a broker covering several leads"""
+    leads = event["payload"].get("leads", [])
+    lines = []
+    for lead in leads:
+        vehicle = " ".join(str(part) for part in [lead.get("vehicle_make"), lead.get("vehicle_model"), lead.get("vehicle_year")] if part)
+        lines.append(f"• {lead.get('name') or 'Cliente'} - {lead.get('phone_number', '')}" + (f" - {vehicle}" if vehicle else ""))
+    lead_list = "\n".join(lines)
+    
+    if event["event_type"] == "leads_reassigned":
+        return f"""🔁 *Leads reasignados a ti - ProtegeYa*
+
+Se te asignaron {len(leads)} leads que no fueron contactados a tiempo por otro corredor:
+
+{lead_list}
+
+⏰ *Plazo de contacto:* {SLA_FIRST_CONTACT_HOURS} horas
 
 _Mensaje automático de ProtegeYa_"""
+    if event["event_type"] == "leads_revoked":
+        return f"""⚠️ *Leads reasignados - ProtegeYa*
 
-        # Send notification
-        success = await send_whatsapp_message(broker_phone, notification_message)
+Estos {len(leads)} leads fueron reasignados porque no se registró contacto dentro de {SLA_REASSIGNMENT_HOURS} horas:
+
+{lead_list}
+
+_Mensaje automático de ProtegeYa_"""
+    return f"""⏰ *Recordatorio de contacto - ProtegeYa*
+
+Tienes {len(leads)} leads pendientes de primer contacto:
+
+{lead_list}
+
+Si no registras el contacto, serán reasignados a otro corredor.
+
+_Mensaje automático de ProtegeYa_"""
+
+async def emit_broker_digests(event_type: str, leads_by_broker: Dict[str, List[dict]]):
+    """Queue one consolidated notification per broker"""
+    if not leads_by_broker:
+        return
+    brokers = await db.brokers.find(
+        {"id": {"$in": list(leads_by_broker)}},
+        {"_id": 0, **{field: 1 for field in BROKER_NOTIFICATION_FIELDS}}
+    ).to_list(length=None)
+    events = [
+        NotificationEvent(
+            event_type=event_type,
+            broker_id=broker["id"],
+            payload={
+                "broker": {field: broker.get(field) for field in BROKER_NOTIFICATION_FIELDS},
+                "leads": [{field: lead.get(field) for field in LEAD_NOTIFICATION_FIELDS} for lead in leads_by_broker[broker["id"]]]
+            }
+        )
+        for broker in brokers
+    ]
+    if not events:
+        return
+    await db.notification_events.insert_many([prepare_for_mongo(event.dict()) for event in events])
+    for event in events:
+        spawn_background(process_notification_event(event.id))
+
+# ========== LEAD SLA ENFORCEMENT ==========
+
+SLA_FIRST_CONTACT_HOURS = 2
+SLA_REASSIGNMENT_HOURS = 4
+SLA_CHECK_MINUTES = int(os.environ.get('SLA_CHECK_MINUTES', '5'))
+SLA_BATCH_SIZE = int(os.environ.get('SLA_BATCH_SIZE', '200'))
+SLA_MAX_BATCHES_PER_RUN = 50  # Tope por corrida; lo que quede se procesa en la siguiente
+SLA_RETRY_MINUTES = 30  # Sin brokers disponibles: volver a intentar la reasignación más tarde
+SLA_JOB_LOCK_SECONDS = 600
+
+# Estados en los que el broker todavía no registra contacto con el cliente
+SLA_PENDING_BROKER_STATUSES = [BrokerLeadStatus.NEW, BrokerLeadStatus.INTERESTED]
+SLA_LEAD_FIELDS = {
+    "_id": 0, "assigned_broker_id": 1, "municipality": 1,
+    **{field: 1 for field in LEAD_NOTIFICATION_FIELDS}
+}
+
+sla_stats = {"runs": 0, "skipped_locked": 0, "reminded": 0, "reassigned": 0, "no_broker": 0, "lost_races": 0}
+
+WORKER_ID = f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+async def acquire_job_lock(name: str, seconds: int) -> bool:
+    """Take a named lock shared by all workers; expired locks can be taken over"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_locks.find_one_and_update(
+            {"name": name, "$or": [{"locked_until": {"$lte": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "locked_until": now + timedelta(seconds=seconds), "acquired_at": now}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Otro worker tiene el candado vigente (el upsert chocó con el índice único de name)
+        return False
+
+async def release_job_lock(name: str):
+    await db.job_locks.update_one(
+        {"name": name, "owner": WORKER_ID},
+        {"$set": {"locked_until": datetime.now(timezone.utc)}}
+    )
+
+def sla_deadlines(now: datetime) -> dict:
+    """Fresh SLA fields for a lead that was just (re)assigned"""
+    return {
+        "assigned_at": now,
+        "sla_first_contact_deadline": now + timedelta(hours=SLA_FIRST_CONTACT_HOURS),
+        "sla_reassignment_deadline": now + timedelta(hours=SLA_REASSIGNMENT_HOURS),
+        "sla_first_contact_reminded": False
+    }
+
+async def remind_first_contact_overdue(now: datetime) -> int:
+    """One reminder per broker listing its leads past the first-contact deadline"""
+    reminded = 0
+    leads_by_broker: Dict[str, List[dict]] = {}
+    for _ in range(SLA_MAX_BATCHES_PER_RUN):
+        leads = await db.leads.find(
+            {
+                "status": LeadStatus.ASSIGNED_TO_BROKER,
+                "broker_status": {"$in": SLA_PENDING_BROKER_STATUSES},
+                "sla_first_contact_deadline": {"$lte": now},
+                "sla_first_contact_reminded": {"$ne": True}
+            },
+            SLA_LEAD_FIELDS
+        ).sort("sla_first_contact_deadline", 1).limit(SLA_BATCH_SIZE).to_list(length=None)
+        if not leads:
+            break
         
-        if success:
-            logging.info(f"Lead notification sent successfully to broker {broker_data.get('name', 'Unknown')} at {broker_phone}")
-        else:
-            logging.error(f"Failed to send lead notification to broker {broker_data.get('name', 'Unknown')}")
+        await db.leads.update_many(
+            {"id": {"$in": [lead["id"] for lead in leads]}},
+            {"$set": {"sla_first_contact_reminded": True}}
+        )
+        for lead in leads:
+            if lead.get("assigned_broker_id"):
+                leads_by_broker.setdefault(lead["assigned_broker_id"], []).append(lead)
+        reminded += len(leads)
+    
+    await emit_broker_digests("sla_reminder", leads_by_broker)
+    return reminded
+
+async def reassign_overdue_leads(now: datetime) -> dict:
+    """
+    Move leads past the reassignment deadline to another broker, one page at a time
+    Each page is read through the (status, broker_status, sla_reassignment_deadline) index and written with one
+    bulk_write; the update is guarded on the previous broker and status, so a lead the broker contacted meanwhile
+    is left alone and its reserved slot is released
+    """
+    result = {"reassigned": 0, "no_broker": 0, "lost_races": 0}
+    # Un solo mensaje por broker en toda la corrida, aunque sus leads caigan en varias páginas
+    gained: Dict[str, List[dict]] = {}
+    revoked: Dict[str, List[dict]] = {}
+    for _ in range(SLA_MAX_BATCHES_PER_RUN):
+        leads = await db.leads.find(
+            {
+                "status": LeadStatus.ASSIGNED_TO_BROKER,
+                "broker_status": {"$in": SLA_PENDING_BROKER_STATUSES},
+                "sla_reassignment_deadline": {"$lte": now}
+            },
+            SLA_LEAD_FIELDS
+        ).sort("sla_reassignment_deadline", 1).limit(SLA_BATCH_SIZE).to_list(length=None)
+        if not leads:
+            break
         
-        return success
+        operations = []
+        moves = []  # (lead, broker anterior, broker nuevo)
+        for lead in leads:
+            previous_id = lead.get("assigned_broker_id")
+            guard = {"id": lead["id"], "assigned_broker_id": previous_id, "broker_status": {"$in": SLA_PENDING_BROKER_STATUSES}}
+            new_broker = await broker_availability.claim(lead.get("municipality"), exclude={previous_id} if previous_id else None)
+            if not new_broker:
+                operations.append(UpdateOne(guard, {"$set": {"sla_reassignment_deadline": now + timedelta(minutes=SLA_RETRY_MINUTES)}}))
+                result["no_broker"] += 1
+                continue
+            operations.append(UpdateOne(guard, {
+                "$set": {"assigned_broker_id": new_broker["id"], "updated_at": now, **sla_deadlines(now)},
+                "$push": {"reassignments": {"from_broker_id": previous_id, "to_broker_id": new_broker["id"], "reason": "sla_expired", "at": now}}
+            }))
+            moves.append((lead, previous_id, new_broker["id"]))
+        await db.leads.bulk_write(operations, ordered=False)
+        
+        if not moves:
+            continue
+        
+        # Confirmar qué reasignaciones se aplicaron; las que perdieron la carrera devuelven su cupo
+        current = {
+            doc["id"]: doc.get("assigned_broker_id")
+            for doc in await db.leads.find({"id": {"$in": [lead["id"] for lead, _, _ in moves]}}, {"_id": 0, "id": 1, "assigned_broker_id": 1}).to_list(length=None)
+        }
+        page_revoked: Dict[str, int] = {}
+        for lead, previous_id, new_id in moves:
+            if current.get(lead["id"]) != new_id:
+                await release_broker_slot(new_id)
+                result["lost_races"] += 1
+                continue
+            gained.setdefault(new_id, []).append(lead)
+            if previous_id:
+                revoked.setdefault(previous_id, []).append(lead)
+                page_revoked[previous_id] = page_revoked.get(previous_id, 0) + 1
+            result["reassigned"] += 1
+        
+        # El lead deja de contar en la cuota del broker anterior
+        if page_revoked:
+            await db.brokers.bulk_write([
+                UpdateOne({"id": broker_id}, {"$inc": {"current_month_leads": -count}})
+                for broker_id, count in page_revoked.items()
+            ], ordered=False)
+            for broker_id in page_revoked:
+                await broker_availability.refresh(broker_id)
+    
+    await emit_broker_digests("leads_reassigned", gained)
+    await emit_broker_digests("leads_revoked", revoked)
+    return result
+
+async def enforce_lead_slas() -> dict:
+    """Scheduled SLA sweep: first-contact reminders, then reassignment of stale leads (one worker at a time)"""
+    if not await acquire_job_lock("enforce_lead_slas", SLA_JOB_LOCK_SECONDS):
+        sla_stats["skipped_locked"] += 1
+        return {"skipped": True}
+    try:
+        now = datetime.now(GUATEMALA_TZ)
+        result = await reassign_overdue_leads(now)
+        reminded = await remind_first_contact_overdue(now)
+        sla_stats["runs"] += 1
+        sla_stats["reminded"] += reminded
+        for key, value in result.items():
+            sla_stats[key] += value
+        if reminded or any(result.values()):
+            logging.info(f"SLA sweep: {reminded} reminders, {result['reassigned']} reassigned, "
+                         f"{result['no_broker']} without available broker, {result['lost_races']} contacted meanwhile")
+        return {"reminded": reminded, **result}
+    finally:
+        await release_job_lock("enforce_lead_slas")
+
+# ========== BROKER LEAD COUNTERS ==========
+
+RECONCILE_JOB_LOCK_SECONDS = 600
+
+def guatemala_month_start(now: Optional[datetime] = None) -> datetime:
+    """First instant of the current month in Guatemala time"""
+    now = (now or datetime.now(GUATEMALA_TZ)).astimezone(GUATEMALA_TZ)
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+async def reconcile_broker_lead_counters(now: Optional[datetime] = None) -> dict:
+    """
+    Recompute current_month_leads from the leads actually assigned this month (Guatemala time)
+    One $group over leads gives the real counts; every broker whose counter differs is fixed in a single
+    bulk_write. Run right after midnight on the 1st this is the monthly reset, since no lead has been
+    assigned in the new month yet. Each update is guarded on the value that was read, so a slot claimed
+    while the job runs is not overwritten (the next run picks up any remaining drift)
+    """
+    month_start = guatemala_month_start(now)
+    # Sin assigned_at (null o ausente: leads anteriores al campo) se cuenta por created_at, como ISO string o datetime.
+    # updated_at no sirve: cambia con cada cambio de estado y contaría leads viejos como asignaciones del mes
+    counts = await db.leads.aggregate([
+        {"$match": {
+            "assigned_broker_id": {"$ne": None},
+            "$or": [
+                {"assigned_at": {"$gte": month_start}},
+                {"assigned_at": None, "created_at": {"$gte": month_start.isoformat()}},
+                {"assigned_at": None, "created_at": {"$gte": month_start}}
+            ]
+        }},
+        {"$group": {"_id": "$assigned_broker_id", "count": {"$sum": 1}}}
+    ]).to_list(length=None)
+    actual = {item["_id"]: item["count"] for item in counts}
+    
+    brokers = await db.brokers.find({}, {"_id": 0, "id": 1, "name": 1, "current_month_leads": 1}).to_list(length=None)
+    drift = [
+        {"broker_id": broker["id"], "name": broker.get("name", ""), "recorded": broker.get("current_month_leads", 0), "actual": actual.get(broker["id"], 0)}
+        for broker in brokers
+        if broker.get("current_month_leads", 0) != actual.get(broker["id"], 0)
+    ]
+    
+    applied = 0
+    if drift:
+        result = await db.brokers.bulk_write([
+            UpdateOne(
+                {"id": item["broker_id"], "current_month_leads": item["recorded"]},
+                {"$set": {"current_month_leads": item["actual"], "updated_at": datetime.now(GUATEMALA_TZ)}}
+            )
+            for item in drift
+        ], ordered=False)
+        applied = result.modified_count
+        await broker_availability.rebuild()
+        for item in drift:
+            logging.warning(f"Broker {item['broker_id']} lead counter drift: recorded {item['recorded']}, actual {item['actual']}")
+    
+    report = {
+        "month_start": month_start.isoformat(),
+        "brokers_checked": len(brokers),
+        "drift": drift,
+        "corrected": applied,
+        "total_drift": sum(abs(item["recorded"] - item["actual"]) for item in drift)
+    }
+    logging.info(f"Broker lead counters reconciled: {len(drift)} with drift, {applied} corrected")
+    return report
+
+async def reconcile_broker_lead_counters_job() -> dict:
+    """Scheduled wrapper: one worker at a time"""
+    if not await acquire_job_lock("reconcile_broker_lead_counters", RECONCILE_JOB_LOCK_SECONDS):
+        return {"skipped": True}
+    try:
+        return await reconcile_broker_lead_counters()
+    finally:
+        await release_job_lock("reconcile_broker_lead_counters")
+
+async def upload_ultramsg_media(ultramsg_instance_id: str, ultramsg_token: str, pdf_path: str) -> Optional[str]:
+    """Upload a file to UltraMSG media storage and return its reusable URL"""
+    try:
+        with open(pdf_path, 'rb') as pdf_file:
+            files = {'file': ('cotizacion.pdf', pdf_file, 'application/pdf')}
+            async with httpx.AsyncClient(timeout=60.0) as client:
+                response = await client.post(
+                    f"https://api.ultramsg.com/{ultramsg_instance_id}/media/upload",
+                    data={'token': ultramsg_token},
+                    files=files
+                )
         
+        if response.status_code == 200:
+            media_url = response.json().get("success")
+            if isinstance(media_url, str) and media_url.startswith("http"):
+                return media_url
+        
+        logging.warning(f"UltraMSG media upload failed: {response.status_code} - {response.text}")
+        return None
     except Exception as e:
-        logging.error(f"Error sending broker notification: {e}")
-        return False
+        logging.error(f"Error uploading media to UltraMSG: {e}")
+        return None
 
-async def send_whatsapp_pdf(phone_number: str, pdf_path: str, caption: str = "") -> bool:
-    """Send PDF file via UltraMSG"""
+async def send_whatsapp_pdf(phone_number: str, pdf_path: str, caption: str = "", cache_key: Optional[str] = None) -> bool:
+    """
+    Send PDF file via UltraMSG
+    If cache_key points to a cached PDF that was already uploaded, its media URL is reused instead of re-uploading
+    """
     try:
         # PRIORIDAD: Primero intentar BD, luego environment variables
         ultramsg_instance_id = None
@@ -2253,38 +4372,51 @@ async def send_whatsapp_pdf(phone_number: str, pdf_path: str, caption: str = "")
         # UltraMSG document sending endpoint
         ultramsg_url = f"https://api.ultramsg.com/{ultramsg_instance_id}/messages/document"
         
+        data = {
+            'token': ultramsg_token,
+            'to': formatted_phone,
+            'caption': caption or "📄 Tu cotización de ProtegeYa está lista"
+        }
+        
+        # Reutilizar la referencia de media de un PDF idéntico ya subido
+        cached = quote_pdf_cache.get(cache_key) if cache_key else None
+        media_url = cached.get("media_url") if cached else None
+        if ULTRAMSG_PDF_MEDIA_REUSE and cached and not media_url:
+            media_url = await upload_ultramsg_media(ultramsg_instance_id, ultramsg_token, pdf_path)
+            if media_url:
+                cached["media_url"] = media_url
+        
         logging.info(f"Sending PDF to {formatted_phone} via UltraMSG")
         
-        # Prepare file for upload
-        with open(pdf_path, 'rb') as pdf_file:
-            files = {
-                'document': ('cotizacion.pdf', pdf_file, 'application/pdf')
-            }
-            
-            data = {
-                'token': ultramsg_token,
-                'to': formatted_phone,
-                'caption': caption or "📄 Tu cotización de ProtegeYa está lista"
-            }
+        async with httpx.AsyncClient(timeout=60.0) as client:
+            if media_url:
+                logging.info(f"Reusing UltraMSG media reference for PDF: {media_url}")
+                data['document'] = media_url
+                data['filename'] = 'cotizacion.pdf'
+                response = await client.post(ultramsg_url, data=data)
+            else:
+                # Prepare file for upload
+                with open(pdf_path, 'rb') as pdf_file:
+                    files = {
+                        'document': ('cotizacion.pdf', pdf_file, 'application/pdf')
+                    }
+                    response = await client.post(ultramsg_url, data=data, files=files)
             
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(ultramsg_url, data=data, files=files)
+            if response.status_code == 200:
+                response_data = response.json()
+                logging.info(f"PDF sent successfully: {response_data}")
                 
-                if response.status_code == 200:
-                    response_data = response.json()
-                    logging.info(f"PDF sent successfully: {response_data}")
-                    
-                    # Clean up temporary file
-                    try:
-                        os.unlink(pdf_path)
-                        logging.info(f"Temporary PDF file deleted: {pdf_path}")
-                    except:
-                        pass
-                    
-                    return response_data.get("sent", False)
-                else:
-                    logging.error(f"UltraMSG PDF API error: {response.status_code} - {response.text}")
-                    return False
+                # Clean up temporary file
+                try:
+                    os.unlink(pdf_path)
+                    logging.info(f"Temporary PDF file deleted: {pdf_path}")
+                except:
+                    pass
+                
+                return response_data.get("sent", False)
+            else:
+                logging.error(f"UltraMSG PDF API error: {response.status_code} - {response.text}")
+                return False
         
     except Exception as e:
         logging.error(f"Error sending PDF via WhatsApp: {e}")
@@ -2562,6 +4694,76 @@ async def get_leads(
     
     return [Lead(**parse_from_mongo(lead)) for lead in leads]
 
+async def build_export_query(current_user: UserResponse, start_date: Optional[str], end_date: Optional[str], assigned_broker_id: Optional[str]) -> dict:
+    """Build the leads query for a portfolio export (broker sees only assigned, admin sees all)"""
+    query = {}
+    
+    if current_user.role == UserRole.BROKER:
+        broker = await db.brokers.find_one({"user_id": current_user.id})
+        query["assigned_broker_id"] = broker["id"] if broker else "none"
+    elif assigned_broker_id:
+        query["assigned_broker_id"] = assigned_broker_id
+    
+    created_at = {}
+    try:
+        if start_date:
+            created_at["$gte"] = datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=GUATEMALA_TZ).isoformat()
+        if end_date:
+            end = datetime.strptime(end_date, "%Y-%m-%d").replace(tzinfo=GUATEMALA_TZ) + timedelta(days=1)
+            created_at["$lt"] = end.isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must use YYYY-MM-DD format")
+    
+    if created_at:
+        query["created_at"] = created_at
+    
+    return query
+
+@api_router.get("/leads/export.pdf")
+async def export_leads_pdf(
+    current_user: UserResponse = Depends(get_current_user),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    assigned_broker_id: Optional[str] = None
+):
+    """
+    Export quote sheets for leads in a date range as a single PDF (one sheet per lead)
+    Capped at PDF_EXPORT_MAX_LEADS leads (200 by default): the document is fully rendered before the first
+    byte is sent. Larger exports must use /api/leads/export.zip, which streams one PDF per lead
+    """
+    query = await build_export_query(current_user, start_date, end_date, assigned_broker_id)
+    
+    total = await db.leads.count_documents(query)
+    if total > PDF_EXPORT_MAX_LEADS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many leads for a single PDF ({total} > {PDF_EXPORT_MAX_LEADS}). Use /api/leads/export.zip, which streams one PDF per lead"
+        )
+    
+    logging.info(f"User {current_user.email} exporting {total} leads as PDF")
+    return StreamingResponse(
+        stream_leads_pdf(query),
+        media_type="application/pdf",
+        headers={"Content-Disposition": 'attachment; filename="cotizaciones.pdf"'}
+    )
+
+@api_router.get("/leads/export.zip")
+async def export_leads_zip(
+    current_user: UserResponse = Depends(get_current_user),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    assigned_broker_id: Optional[str] = None
+):
+    """Export quote sheets for leads in a date range as a ZIP streamed entry by entry"""
+    query = await build_export_query(current_user, start_date, end_date, assigned_broker_id)
+    
+    logging.info(f"User {current_user.email} exporting leads as ZIP with query: {query}")
+    return StreamingResponse(
+        stream_leads_zip(query),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="cotizaciones.zip"'}
+    )
+
 @api_router.post("/leads/{lead_id}/status")
 async def update_broker_lead_status(lead_id: str, status_update: BrokerLeadStatusUpdate, current_user: UserResponse = Depends(get_current_user)):
     """Update broker lead status"""
@@ -2668,11 +4870,14 @@ async def create_broker(broker_data: BrokerCreate, current_admin: UserResponse =
         broker_credential=broker_data.broker_credential,
         subscription_status=broker_data.subscription_status,
         monthly_lead_quota=broker_data.monthly_lead_quota,
-        commission_percentage=broker_data.commission_percentage
+        commission_percentage=broker_data.commission_percentage,
+        coverage_municipalities=broker_data.coverage_municipalities,
+        routing_weight=broker_data.routing_weight
     )
     
     broker_dict = prepare_for_mongo(broker_profile.dict())
     await db.brokers.insert_one(broker_dict)
+    await broker_availability.refresh(broker_profile.id)
     
     return broker_profile
 
@@ -2687,6 +4892,7 @@ async def create_broker(broker: BrokerProfile, current_admin: UserResponse = Dep
     
     broker_dict = prepare_for_mongo(broker.dict())
     await db.brokers.insert_one(broker_dict)
+    await broker_availability.refresh(broker.id)
     return broker
 
 class BrokerPlanAssignment(BaseModel):
@@ -2721,6 +4927,7 @@ async def assign_plan_to_broker(broker_id: str, assignment: BrokerPlanAssignment
             }
         }
     )
+    await broker_availability.refresh(broker_id)
     
     # Create broker account
     account_id = await create_broker_account(broker_id, assignment.subscription_plan_id)
@@ -2739,6 +4946,7 @@ async def update_broker(broker_id: str, broker_data: Dict[str, Any], current_adm
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Broker not found")
+    await broker_availability.refresh(broker_id)
     return {"success": True}
 
 @api_router.delete("/brokers/{broker_id}")
@@ -2752,6 +4960,7 @@ async def delete_broker(broker_id: str, current_admin: UserResponse = Depends(re
     result = await db.brokers.delete_one({"id": broker_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Broker not found")
+    broker_availability.discard(broker_id)
     
     # Also delete associated auth user if exists
     broker_data = await db.brokers.find_one({"id": broker_id})
@@ -3171,30 +5380,28 @@ async def assign_lead_to_broker(lead_id: str, broker_id: str, current_admin: Use
     if broker["subscription_status"] != BrokerSubscriptionStatus.ACTIVE:
         raise HTTPException(status_code=400, detail="Broker is not active")
     
-    # Check broker quota
-    if broker["current_month_leads"] >= broker["monthly_lead_quota"]:
+    # Check broker quota and take the slot in the same write
+    reserved = await reserve_broker_slot({"id": broker_id})
+    if not reserved:
         raise HTTPException(status_code=400, detail="Broker has reached monthly lead quota")
+    broker_availability.upsert(reserved)
     
     # Update lead
-    await db.leads.update_one(
+    result = await db.leads.update_one(
         {"id": lead_id},
         {
             "$set": {
                 "assigned_broker_id": broker_id,
                 "status": LeadStatus.ASSIGNED_TO_BROKER,
                 "broker_status": BrokerLeadStatus.NEW,
-                "sla_first_contact_deadline": datetime.now(GUATEMALA_TZ) + timedelta(hours=2),
-                "sla_reassignment_deadline": datetime.now(GUATEMALA_TZ) + timedelta(hours=4),
+                **sla_deadlines(datetime.now(GUATEMALA_TZ)),
                 "updated_at": datetime.now(GUATEMALA_TZ)
             }
         }
     )
-    
-    # Update broker lead count
-    await db.brokers.update_one(
-        {"id": broker_id},
-        {"$inc": {"current_month_leads": 1}}
-    )
+    if result.matched_count == 0:
+        await release_broker_slot(broker_id)
+        raise HTTPException(status_code=404, detail="Lead not found")
     
     return {"success": True}
 
@@ -3208,6 +5415,11 @@ async def assign_lead_auto(lead_id: str, current_admin: UserResponse = Depends(r
     
     return {"success": True, "assigned_broker_id": assigned_broker_id}
 
+@api_router.post("/admin/brokers/reconcile-lead-counters")
+async def reconcile_lead_counters_endpoint(current_admin: UserResponse = Depends(require_admin)):
+    """Recompute monthly lead counters from assigned leads and report drift (admin only)"""
+    return await reconcile_broker_lead_counters()
+
 @api_router.post("/admin/sync-broker-users")
 async def sync_broker_users_endpoint(current_admin: UserResponse = Depends(require_admin)):
     """
@@ -3511,6 +5723,7 @@ async def fix_broker_leads_production(current_admin: UserResponse = Depends(requ
                     {"id": orphan["lead_id"]},
                     {"$set": {
                         "assigned_broker_id": first_broker.get('id'),
+                        "assigned_at": datetime.now(GUATEMALA_TZ),
                         "updated_at": datetime.now(GUATEMALA_TZ).isoformat()
                     }}
                 )
@@ -3536,6 +5749,7 @@ async def fix_broker_leads_production(current_admin: UserResponse = Depends(requ
                             {"id": lead.get('id')},
                             {"$set": {
                                 "assigned_broker_id": broker_id,
+                                "assigned_at": datetime.now(GUATEMALA_TZ),
                                 "updated_at": datetime.now(GUATEMALA_TZ).isoformat()
                             }}
                         )
@@ -3701,6 +5915,7 @@ async def update_broker_subscription(broker_id: str, status: BrokerSubscriptionS
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Broker not found")
+    await broker_availability.refresh(broker_id)
     return {"success": True}
 
 @api_router.delete("/brokers/{broker_id}")
@@ -3714,6 +5929,7 @@ async def delete_broker(broker_id: str, current_admin: UserResponse = Depends(re
     result = await db.brokers.delete_one({"id": broker_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Broker not found")
+    broker_availability.discard(broker_id)
     
     # Also delete associated auth user if exists
     broker_data = await db.brokers.find_one({"id": broker_id})
@@ -3803,11 +6019,91 @@ async def get_broker_account(broker_id: str, current_admin: UserResponse = Depen
     
     return BrokerAccount(**parse_from_mongo(account))
 
+TRANSACTIONS_PAGE_DEFAULT = 50
+TRANSACTIONS_PAGE_MAX = 200
+
+def encode_transaction_cursor(transaction: dict) -> str:
+    payload = json.dumps([transaction["created_at"], transaction["id"]])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_transaction_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, transaction_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(created_at), str(transaction_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def paginate_transactions(
+    account_id: str,
+    cursor: Optional[str] = None,
+    limit: int = TRANSACTIONS_PAGE_DEFAULT,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    include_total: bool = False
+) -> dict:
+    """
+    Newest-first page of an account's visible transactions
+    Keyset pagination on (created_at, id) over the (account_id, created_at, id) index, so every page costs
+    the same regardless of history length; the total is only counted when asked for
+    """
+    query = {"account_id": account_id, **VISIBLE_TRANSACTIONS}
+    if from_date or to_date:
+        query["created_at"] = {}
+        if from_date:
+            query["created_at"]["$gte"] = ledger_key(from_date)
+        if to_date:
+            query["created_at"]["$lte"] = ledger_key(to_date)
+    
+    page_query = query
+    if cursor:
+        created_at, transaction_id = decode_transaction_cursor(cursor)
+        page_query = {"$and": [query, {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": transaction_id}}
+        ]}]}
+    
+    limit = max(1, min(limit, TRANSACTIONS_PAGE_MAX))
+    items = await db.broker_transactions.find(page_query, {"_id": 0}).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+    
+    page = {
+        "items": items[:limit],
+        "next_cursor": encode_transaction_cursor(items[limit - 1]) if len(items) > limit else None
+    }
+    if include_total:
+        page["total"] = await db.broker_transactions.count_documents(query)
+    return page
+
 @api_router.get("/admin/transactions/{account_id}")
-async def get_account_transactions(account_id: str, current_admin: UserResponse = Depends(require_admin)):
-    """Get transactions for specific account (admin only)"""
-    transactions = await db.broker_transactions.find({"account_id": account_id}).sort([("created_at", -1)]).to_list(length=None)
-    return [BrokerTransaction(**parse_from_mongo(transaction)) for transaction in transactions]
+async def get_account_transactions(
+    account_id: str,
+    cursor: Optional[str] = None,
+    limit: int = TRANSACTIONS_PAGE_DEFAULT,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    include_total: bool = False,
+    current_admin: UserResponse = Depends(require_admin)
+):
+    """Get transactions for specific account, paginated with next_cursor (admin only)"""
+    return await paginate_transactions(account_id, cursor, limit, from_date, to_date, include_total)
+
+@api_router.get("/admin/accounts/{account_id}/balance-at")
+async def get_account_balance_at(account_id: str, at: datetime, current_admin: UserResponse = Depends(require_admin)):
+    """Account balance at a given date, from the nearest ledger snapshot (admin only)"""
+    if not await db.broker_accounts.find_one({"id": account_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Account not found")
+    return await account_balance_at(account_id, at)
+
+@api_router.post("/admin/ledger/reconcile")
+async def reconcile_ledger_endpoint(current_admin: UserResponse = Depends(require_admin)):
+    """Verify every account's current_balance against its ledger (admin only)"""
+    return await reconcile_ledger_balances()
+
+@api_router.post("/admin/ledger/snapshots")
+async def take_ledger_snapshots_endpoint(current_admin: UserResponse = Depends(require_admin)):
+    """Snapshot balances of accounts with activity since the last run (admin only)"""
+    return await take_ledger_snapshots()
 
 class PaymentApplication(BaseModel):
     amount: float
@@ -3827,25 +6123,27 @@ async def apply_payment(broker_id: str, payment: PaymentApplication, current_adm
     
     account_obj = BrokerAccount(**parse_from_mongo(account))
     
-    # Calculate new balance
-    new_balance = account_obj.current_balance + payment.amount
-    
-    # Update account
-    update_data = {
-        "current_balance": new_balance,
-        "updated_at": datetime.now(GUATEMALA_TZ)
-    }
+    # Apply the payment atomically; the returned document has the new balance
+    updated = await db.broker_accounts.find_one_and_update(
+        {"id": account_obj.id},
+        {"$inc": {"current_balance": payment.amount}, "$set": {"updated_at": datetime.now(GUATEMALA_TZ)}},
+        return_document=ReturnDocument.AFTER
+    )
+    new_balance = updated["current_balance"]
     
     # If payment covers debt, reactivate account
-    if account_obj.current_balance < 0 and new_balance >= 0:
-        update_data["account_status"] = AccountStatus.ACTIVE
-        update_data["grace_period_end"] = None
+    if new_balance - payment.amount < 0 and new_balance >= 0:
+        await db.broker_accounts.update_one(
+            {"id": account_obj.id},
+            {"$set": {"account_status": AccountStatus.ACTIVE, "grace_period_end": None}}
+        )
         
         # Reactivate broker
         await db.brokers.update_one(
             {"id": broker_id},
             {"$set": {"subscription_status": BrokerSubscriptionStatus.ACTIVE}}
         )
+        await broker_availability.refresh(broker_id)
         
         # Reactivate user
         broker = await db.brokers.find_one({"id": broker_id})
@@ -3855,11 +6153,6 @@ async def apply_payment(broker_id: str, payment: PaymentApplication, current_adm
                 {"$set": {"active": True}}
             )
     
-    await db.broker_accounts.update_one(
-        {"broker_id": broker_id},
-        {"$set": update_data}
-    )
-    
     # Create payment transaction
     transaction = BrokerTransaction(
         account_id=account_obj.id,
@@ -3897,16 +6190,18 @@ Referencia: {payment.reference_number or 'N/A'}
     return {"success": True, "new_balance": new_balance}
 
 @api_router.post("/admin/accounts/generate-charges")
-async def manual_generate_charges(current_admin: UserResponse = Depends(require_admin)):
-    """Manually generate monthly charges (admin only)"""
-    await generate_monthly_charges(force_manual=True)
-    return {"success": True, "message": "Monthly charges generated"}
+async def manual_generate_charges(dry_run: bool = False, current_admin: UserResponse = Depends(require_admin)):
+    """Manually generate monthly charges; dry_run=true previews them without writing (admin only)"""
+    summary = await generate_monthly_charges(force_manual=True, dry_run=dry_run)
+    message = "Monthly charges previewed (dry run)" if dry_run else "Monthly charges generated"
+    return {"success": True, "message": message, "summary": summary}
 
 @api_router.post("/admin/accounts/check-overdue")
-async def manual_check_overdue(current_admin: UserResponse = Depends(require_admin)):
-    """Manually check overdue accounts (admin only)"""
-    await check_overdue_accounts()
-    return {"success": True, "message": "Overdue accounts checked"}
+async def manual_check_overdue(dry_run: bool = False, current_admin: UserResponse = Depends(require_admin)):
+    """Manually check overdue accounts; dry_run=true previews transitions and notices (admin only)"""
+    summary = await check_overdue_accounts(dry_run=dry_run)
+    message = "Overdue accounts previewed (dry run)" if dry_run else "Overdue accounts checked"
+    return {"success": True, "message": message, "summary": summary}
 
 @api_router.delete("/admin/transactions/{transaction_id}")
 async def delete_transaction(transaction_id: str, deletion_data: PaymentDeletion, current_admin: UserResponse = Depends(require_admin)):
@@ -3917,7 +6212,7 @@ async def delete_transaction(transaction_id: str, deletion_data: PaymentDeletion
         raise HTTPException(status_code=403, detail="Código de autorización incorrecto")
     
     # Get transaction
-    transaction = await db.broker_transactions.find_one({"id": transaction_id})
+    transaction = await db.broker_transactions.find_one({"id": transaction_id, **VISIBLE_TRANSACTIONS})
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
     
@@ -3926,44 +6221,45 @@ async def delete_transaction(transaction_id: str, deletion_data: PaymentDeletion
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
     
-    # Calculate new balance by reversing the transaction
+    # The ledger is append-only: void the transaction (only once) and append its reversal
+    now = datetime.now(GUATEMALA_TZ)
+    voided = await db.broker_transactions.update_one(
+        {"id": transaction_id, "voided_at": None},
+        {"$set": {"voided_at": now.isoformat(), "voided_by": current_admin.id}}
+    )
+    if voided.modified_count == 0:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    
+    # Reverse the transaction on the balance
     transaction_amount = transaction["amount"]  # Positive for payments, negative for charges
-    new_balance = account["current_balance"] - transaction_amount
+    updated = await db.broker_accounts.find_one_and_update(
+        {"id": account["id"]},
+        {"$inc": {"current_balance": -transaction_amount}, "$set": {"updated_at": now}},
+        return_document=ReturnDocument.AFTER
+    )
+    new_balance = updated["current_balance"]
+    
+    reversal = BrokerTransaction(
+        account_id=account["id"],
+        broker_id=transaction["broker_id"],
+        transaction_type=TransactionType.ADJUSTMENT,
+        amount=-transaction_amount,
+        description=f"Anulación de transacción {transaction_id}",
+        reference_number=transaction.get("reference_number"),
+        balance_after=new_balance,
+        reverses_transaction_id=transaction_id,
+        created_by=current_admin.id
+    )
+    await db.broker_transactions.insert_one(prepare_for_mongo(reversal.dict()))
     
     # Check if account needs to be suspended after removing transaction
-    account_status = account["account_status"]
-    if new_balance < 0 and account_status == AccountStatus.ACTIVE:
+    if new_balance < 0 and updated["account_status"] == AccountStatus.ACTIVE:
         # If balance becomes negative, put in grace period
-        grace_end = datetime.now(GUATEMALA_TZ) + timedelta(days=5)
-        account_status = AccountStatus.GRACE_PERIOD
-        
-        # Update account with new status
-        await db.broker_accounts.update_one(
-            {"id": account["id"]},
-            {
-                "$set": {
-                    "current_balance": new_balance,
-                    "account_status": account_status,
-                    "grace_period_end": grace_end,
-                    "updated_at": datetime.now(GUATEMALA_TZ)
-                }
-            }
-        )
-    else:
-        # Just update balance
         await db.broker_accounts.update_one(
-            {"id": account["id"]},
-            {
-                "$set": {
-                    "current_balance": new_balance,
-                    "updated_at": datetime.now(GUATEMALA_TZ)
-                }
-            }
+            {"id": account["id"], "account_status": AccountStatus.ACTIVE},
+            {"$set": {"account_status": AccountStatus.GRACE_PERIOD, "grace_period_end": now + timedelta(days=5)}}
         )
     
-    # Delete the transaction
-    await db.broker_transactions.delete_one({"id": transaction_id})
-    
     # Get broker info for notification
     broker = await db.brokers.find_one({"id": transaction["broker_id"]})
     
@@ -4018,8 +6314,15 @@ async def get_my_account(current_user: UserResponse = Depends(get_current_user))
     return BrokerAccount(**parse_from_mongo(account))
 
 @api_router.get("/my-transactions")
-async def get_my_transactions(current_user: UserResponse = Depends(get_current_user)):
-    """Get current user's transaction history"""
+async def get_my_transactions(
+    cursor: Optional[str] = None,
+    limit: int = TRANSACTIONS_PAGE_DEFAULT,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    include_total: bool = False,
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """Get current user's transaction history, paginated with next_cursor"""
     if current_user.role != UserRole.BROKER:
         raise HTTPException(status_code=403, detail="Only brokers can access transaction information")
     
@@ -4029,13 +6332,11 @@ async def get_my_transactions(current_user: UserResponse = Depends(get_current_u
         raise HTTPException(status_code=404, detail="Broker profile not found")
     
     # Get account
-    account = await db.broker_accounts.find_one({"broker_id": broker["id"]})
+    account = await db.broker_accounts.find_one({"broker_id": broker["id"]}, {"_id": 0, "id": 1})
     if not account:
-        return []
+        return {"items": [], "next_cursor": None, **({"total": 0} if include_total else {})}
     
-    # Get transactions
-    transactions = await db.broker_transactions.find({"account_id": account["id"]}).sort([("created_at", -1)]).to_list(length=None)
-    return [BrokerTransaction(**parse_from_mongo(transaction)) for transaction in transactions]
+    return await paginate_transactions(account["id"], cursor, limit, from_date, to_date, include_total)
 
 # Configuration Routes
 @api_router.get("/admin/configuration")
@@ -4058,6 +6359,12 @@ async def update_configuration(config_update: ConfigurationUpdate, current_admin
     update_data = {k: v for k, v in config_update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.now(GUATEMALA_TZ)
     
+    for key, route in (update_data.get("ai_model_routes") or {}).items():
+        try:
+            AIModelRoute(**route)
+        except (ValidationError, TypeError) as e:
+            raise HTTPException(status_code=400, detail=f"Ruta de modelo inválida '{key}': {e}")
+    
     config_dict = prepare_for_mongo(update_data)
     
     result = await db.system_config.update_one(
@@ -4065,8 +6372,124 @@ async def update_configuration(config_update: ConfigurationUpdate, current_admin
         {"$set": config_dict},
         upsert=True
     )
+    
+    if "ai_chat_prompt" in update_data:
+        purge_response_cache()
+        legacy_commands = legacy_prompt_commands(update_data["ai_chat_prompt"])
+        if legacy_commands:
+            logging.warning(f"ai_chat_prompt still asks for legacy text commands: {legacy_commands}")
+            return {
+                "success": True,
+                "warnings": [
+                    f"El prompt pide escribir comandos en el texto ({', '.join(legacy_commands)}). Siguen funcionando, "
+                    "pero reemplázalos por instrucciones como 'llama CAPTURAR_NOMBRE': la IA ahora usa herramientas."
+                ]
+            }
     return {"success": True}
 
+@api_router.get("/admin/ai/metrics")
+async def get_ai_metrics(current_admin: UserResponse = Depends(require_admin)):
+    """Get AI pipeline metrics for this process (admin only)"""
+    turns = fast_path_stats["turns"]
+    calls = ai_token_stats["calls"]
+    return {
+        "fast_path": {
+            **fast_path_stats,
+            "hit_rate": round(fast_path_stats["hits"] / turns, 3) if turns else 0.0
+        },
+        "llm": {
+            **llm_stats,
+            "backend_mode": LLM_BACKEND_MODE,
+            "breaker_state": llm_breaker.state,
+            "breaker_stale_outcomes": llm_breaker.stale_outcomes,
+            "latency_p50_ms": llm_latency_percentile(0.5),
+            "latency_p95_ms": llm_latency_percentile(0.95)
+        },
+        "routing": model_route_stats,
+        "broker_assignment": {**broker_availability.stats, "heap_size": len(broker_availability)},
+        "sla": sla_stats,
+        "response_cache": {**response_cache_stats, "entries": len(response_cache)},
+        "selection_stages": {
+            stage: {**stats, "avg_ms": round(stats["total_ms"] / (stats["runs"] - stats["errors"]), 1) if stats["runs"] > stats["errors"] else 0.0}
+            for stage, stats in selection_stage_stats.items()
+        },
+        "tokens": {
+            **ai_token_stats,
+            "avg_prompt_tokens": round(ai_token_stats["prompt_tokens"] / calls, 1) if calls else 0.0,
+            "avg_completion_tokens": round(ai_token_stats["completion_tokens"] / calls, 1) if calls else 0.0,
+            "avg_latency_ms": round(ai_token_stats["latency_ms"] / calls, 1) if calls else 0.0
+        },
+        "generated_at": datetime.now(GUATEMALA_TZ).isoformat()
+    }
+
+@api_router.get("/admin/notifications")
+async def get_notification_events(
+    status: Optional[NotificationStatus] = None,
+    lead_id: Optional[str] = None,
+    limit: int = 100,
+    current_admin: UserResponse = Depends(require_admin)
+):
+    """Broker notification delivery tracking (admin only)"""
+    query = {}
+    if status:
+        query["status"] = status
+    if lead_id:
+        query["lead_id"] = lead_id
+    
+    events = await db.notification_events.find(query, {"_id": 0}).sort("created_at", -1).limit(min(limit, 500)).to_list(length=None)
+    counts = await db.notification_events.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(length=None)
+    
+    return {
+        "events": events,
+        "counts": {item["_id"]: item["count"] for item in counts}
+    }
+
+@api_router.get("/admin/scheduler/status")
+async def get_scheduler_status(
+    job: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = 50,
+    current_admin: UserResponse = Depends(require_admin)
+):
+    """Scheduler leader lease and recent job runs across all workers (admin only)"""
+    query = {}
+    if job:
+        query["job"] = job
+    if status:
+        query["status"] = status
+    
+    lease = await db.job_locks.find_one({"name": SCHEDULER_LEASE_NAME}, {"_id": 0})
+    runs = await db.job_runs.find(query, {"_id": 0}).sort("started_at", -1).limit(min(limit, JOB_RUNS_LIMIT_MAX)).to_list(length=None)
+    
+    return {
+        "worker": WORKER_ID,
+        "is_leader": leader_state["is_leader"],
+        "leader_since": leader_state["since"],
+        "lease": lease,
+        "stats": scheduler_stats,
+        "runs": runs
+    }
+
+@api_router.delete("/admin/ai/response-cache")
+async def clear_response_cache(current_admin: UserResponse = Depends(require_admin)):
+    """
+    Purge cached first-contact AI replies on every worker (admin only)
+    Bumps response_cache_generation, which is part of every cache key and is read with the configuration on
+    each message: other workers stop hitting their old entries, which then expire by TTL. This process's
+    entries are dropped right away; "removed" counts only those
+    """
+    config = await db.system_config.find_one_and_update(
+        {},
+        {"$inc": {"response_cache_generation": 1}, "$set": {"updated_at": datetime.now(GUATEMALA_TZ)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    removed = purge_response_cache()
+    logging.info(f"Response cache purged by {current_admin.email}: generation {config['response_cache_generation']}, {removed} local entries")
+    return {"success": True, "removed": removed, "generation": config["response_cache_generation"], "worker_id": WORKER_ID}
+
 # Reports and Analytics
 @api_router.get("/reports/kpi")
 async def get_kpi_report(current_user: UserResponse = Depends(get_current_user)):
@@ -4125,6 +6548,7 @@ async def get_kpi_report(current_user: UserResponse = Depends(get_current_user))
             {
                 "$match": {
                     "transaction_type": "payment",
+                    "voided_at": None,
                     "created_at": {"$gte": start_of_month.isoformat()}
                 }
             },
@@ -4143,6 +6567,7 @@ async def get_kpi_report(current_user: UserResponse = Depends(get_current_user))
             {
                 "$match": {
                     "transaction_type": "charge",
+                    "voided_at": None,
                     "created_at": {"$gte": start_of_month.isoformat()}
                 }
             },
@@ -4281,6 +6706,7 @@ async def debug_broker_leads(current_user: UserResponse = Depends(get_current_us
     # Since created_at is stored as ISO string, we need to convert it first
     monthly_charges = await db.broker_transactions.find({
         "transaction_type": TransactionType.CHARGE,
+        "voided_at": None,
         "$expr": {
             "$and": [
                 {"$eq": [{"$month": {"$dateFromString": {"dateString": "$created_at"}}}, current_month]},
@@ -4298,6 +6724,7 @@ async def debug_broker_leads(current_user: UserResponse = Depends(get_current_us
     # Since created_at is stored as ISO string, we need to convert it first
     monthly_payments = await db.broker_transactions.find({
         "transaction_type": TransactionType.PAYMENT,
+        "voided_at": None,
         "$expr": {
             "$and": [
                 {"$eq": [{"$month": {"$dateFromString": {"dateString": "$created_at"}}}, current_month]},
@@ -4343,12 +6770,132 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 import asyncio
+import time
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
 # Initialize scheduler
 scheduler = AsyncIOScheduler()
 
+# ========== SCHEDULER LEADERSHIP ==========
+
+# Cada worker de uvicorn/gunicorn arranca su propio scheduler; solo el que tiene el lease ejecuta los
+# jobs compartidos. El lease es un documento de job_locks renovado por heartbeat: si el líder muere,
+# deja de renovarse y otro worker lo toma al vencer (el índice TTL limpia los leases abandonados)
+SCHEDULER_LEASE_NAME = "scheduler_leader"
+LEADER_LEASE_SECONDS = int(os.environ.get('LEADER_LEASE_SECONDS', '30'))
+LEADER_HEARTBEAT_SECONDS = int(os.environ.get('LEADER_HEARTBEAT_SECONDS', '10'))
+JOB_RUNS_LIMIT_MAX = 500
+
+leader_state = {"is_leader": False, "since": None, "last_heartbeat": None, "task": None}
+scheduler_stats = {"runs": 0, "failed": 0, "skipped_not_leader": 0, "leadership_changes": 0}
+
+async def renew_scheduler_lease() -> bool:
+    """Take or extend the leader lease; returns whether this worker is the leader"""
+    try:
+        is_leader = await acquire_job_lock(SCHEDULER_LEASE_NAME, LEADER_LEASE_SECONDS)
+    except Exception as e:
+        # Sin Mongo no se puede probar el lease; ante la duda no se ejecuta nada
+        logging.error(f"Could not renew scheduler lease: {e}")
+        is_leader = False
+    
+    now = datetime.now(timezone.utc)
+    if is_leader != leader_state["is_leader"]:
+        scheduler_stats["leadership_changes"] += 1
+        leader_state["since"] = now if is_leader else None
+        logging.info(f"Worker {WORKER_ID} {'acquired' if is_leader else 'lost'} scheduler leadership")
+    leader_state["is_leader"] = is_leader
+    if is_leader:
+        leader_state["last_heartbeat"] = now
+    return is_leader
+
+async def scheduler_heartbeat_loop():
+    while True:
+        await renew_scheduler_lease()
+        await asyncio.sleep(LEADER_HEARTBEAT_SECONDS)
+
+async def release_scheduler_lease():
+    """Hand the lease over on shutdown instead of making the next leader wait for it to expire"""
+    task = leader_state["task"]
+    if task:
+        task.cancel()
+    if leader_state["is_leader"]:
+        await release_job_lock(SCHEDULER_LEASE_NAME)
+        leader_state.update(is_leader=False, since=None)
+
+async def run_recorded_job(name: str, job, count_items=None) -> Optional[dict]:
+    """Run a job and leave a job_runs record with its duration, item count, summary and failure"""
+    started_at = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    run = {"id": str(uuid.uuid4()), "job": name, "worker": WORKER_ID, "status": "running", "started_at": started_at}
+    await db.job_runs.insert_one(dict(run))
+    
+    summary = None
+    update = {}
+    try:
+        summary = await job()
+        skipped = isinstance(summary, dict) and summary.get("skipped")
+        update["status"] = "skipped" if skipped else "success"
+        update["summary"] = summary if isinstance(summary, dict) else None
+        update["items"] = count_items(summary) if count_items and not skipped else None
+    except Exception as e:
+        scheduler_stats["failed"] += 1
+        update["status"] = "failed"
+        update["error"] = f"{type(e).__name__}: {e}"
+        logging.error(f"Scheduled job {name} failed: {e}")
+    
+    scheduler_stats["runs"] += 1
+    update["finished_at"] = datetime.now(timezone.utc)
+    update["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    await db.job_runs.update_one({"id": run["id"]}, {"$set": update})
+    return summary
+
+def leader_job(name: str, job, count_items=None):
+    """Scheduler entry point for a job that must run on exactly one worker"""
+    async def run():
+        # Se renueva el lease justo antes de ejecutar: el heartbeat pudo haberse atrasado
+        if not await renew_scheduler_lease():
+            scheduler_stats["skipped_not_leader"] += 1
+            return
+        await run_recorded_job(name, job, count_items)
+    run.__name__ = name
+    return run
+
+async def ensure_indexes():
+    """Create the indexes the background workers query on (idempotent)"""
+    await db.notification_events.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.notification_events.create_index("id", unique=True)
+    await db.notification_events.create_index("lead_id")
+    # Asignación de brokers: igualdad por estado + orden por carga para el claim atómico
+    await db.brokers.create_index([("subscription_status", 1), ("current_month_leads", 1), ("last_assigned_at", 1)])
+    await db.brokers.create_index("id")
+    # Barrido de SLA: igualdad por estado + rango por fecha límite
+    await db.leads.create_index([("status", 1), ("broker_status", 1), ("sla_reassignment_deadline", 1)])
+    await db.leads.create_index([("status", 1), ("broker_status", 1), ("sla_first_contact_deadline", 1)])
+    await db.job_locks.create_index("name", unique=True)
+    await db.leads.create_index([("assigned_at", 1), ("assigned_broker_id", 1)])
+    # Facturación: joins por id y un cargo mensual por cuenta
+    await db.subscription_plans.create_index("id")
+    await db.broker_accounts.create_index([("account_status", 1), ("last_charge_period", 1)])
+    await db.broker_transactions.create_index(
+        "idempotency_key", unique=True, partialFilterExpression={"idempotency_key": {"$type": "string"}}
+    )
+    try:
+        await db.broker_accounts.create_index("account_number", unique=True)
+    except Exception as e:
+        # Duplicados creados por el antiguo sort-and-increment; hay que corregirlos a mano
+        logging.error(f"Could not create unique index on broker_accounts.account_number: {e}")
+    await sync_account_number_counter()
+    # Ledger: historial por cuenta, saldos a una fecha y snapshots
+    await db.broker_transactions.create_index([("account_id", 1), ("created_at", -1), ("id", -1)])
+    await db.broker_transactions.create_index("created_at")
+    await db.ledger_snapshots.create_index([("account_id", 1), ("as_of", -1)])
+    await db.ledger_snapshot_runs.create_index("as_of")
+    # Leases vencidos (incluido el del líder) se borran solos; historial de ejecuciones por job
+    await db.job_locks.create_index("locked_until", expireAfterSeconds=0)
+    await db.job_runs.create_index([("job", 1), ("started_at", -1)])
+    await db.job_runs.create_index("started_at")
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize services, configuration, and database on startup"""
@@ -4356,6 +6903,8 @@ async def startup_event():
         # Initialize UltraMSG configuration from environment
         await initialize_ultramsg_config()
         
+        await ensure_indexes()
+        
         # Check if admin user exists
         admin_exists = await db.auth_users.find_one({"role": UserRole.ADMIN})
         
@@ -4492,20 +7041,67 @@ async def startup_event():
         
         # Schedule automated tasks
         # Generate monthly charges on 1st of each month at 2:00 AM
+        # Jobs compartidos envueltos en leader_job: corren solo en el worker que tiene el lease
         scheduler.add_job(
-            generate_monthly_charges,
+            leader_job("generate_monthly_charges", generate_monthly_charges, lambda summary: summary["charged"]),
             CronTrigger(day=1, hour=2, minute=0),
             id="generate_monthly_charges"
         )
         
         # Check overdue accounts daily at 9:00 AM
         scheduler.add_job(
-            check_overdue_accounts,
+            leader_job("check_overdue_accounts", check_overdue_accounts, lambda summary: summary["checked"]),
             CronTrigger(hour=9, minute=0),
             id="check_overdue_accounts"
         )
         
-        # Start scheduler
+        # Monthly quota reset right after midnight on the 1st (Guatemala time), plus a nightly drift check
+        scheduler.add_job(
+            leader_job("reset_broker_lead_counters", reconcile_broker_lead_counters_job, lambda report: report["brokers_checked"]),
+            CronTrigger(day=1, hour=0, minute=1, timezone=GUATEMALA_TZ),
+            id="reset_broker_lead_counters"
+        )
+        scheduler.add_job(
+            leader_job("reconcile_broker_lead_counters", reconcile_broker_lead_counters_job, lambda report: report["brokers_checked"]),
+            CronTrigger(hour=3, minute=30, timezone=GUATEMALA_TZ),
+            id="reconcile_broker_lead_counters"
+        )
+        
+        # Nightly ledger snapshots + balance reconciliation
+        scheduler.add_job(
+            leader_job("ledger_maintenance", ledger_maintenance_job, lambda summary: summary["accounts_checked"]),
+            CronTrigger(hour=1, minute=0, timezone=GUATEMALA_TZ),
+            id="ledger_maintenance"
+        )
+        
+        # Rebuild the broker heap periodically so it reflects assignments made by other workers
+        # (the heap lives in each process, so this one runs on every worker)
+        scheduler.add_job(
+            broker_availability.rebuild,
+            CronTrigger(minute=f"*/{BROKER_HEAP_REBUILD_MINUTES}"),
+            id="rebuild_broker_availability"
+        )
+        
+        # Enforce lead SLAs (reminders and reassignment)
+        scheduler.add_job(
+            leader_job("enforce_lead_slas", enforce_lead_slas, lambda result: result["reminded"] + result["reassigned"]),
+            CronTrigger(minute=f"*/{SLA_CHECK_MINUTES}"),
+            id="enforce_lead_slas"
+        )
+        
+        # Retry pending broker notifications every minute; events are claimed one by one, so every worker helps
+        scheduler.add_job(
+            process_pending_notifications,
+            CronTrigger(minute="*"),
+            id="process_pending_notifications"
+        )
+        
+        # Brokers are synced above; load the routing heap before taking traffic
+        await broker_availability.rebuild()
+        
+        # Start scheduler; the heartbeat decides which worker runs the shared jobs
+        await renew_scheduler_lease()
+        leader_state["task"] = asyncio.create_task(scheduler_heartbeat_loop())
         scheduler.start()
         print("✅ Automated billing tasks scheduled")
         print("✅ UltraMSG integration ready")
@@ -4534,4 +7130,5 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await release_scheduler_lease()
     client.close()
@@ -0,0 +1,35 @@
+"""
+Fixtures compartidos: server.py se importa contra una base Mongo en memoria (mongomock-motor)
+Correr desde backend/: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# server.py lee estas variables al importarse; ninguna prueba se conecta a un Mongo real
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'protegeya_test')
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Fresh in-memory database patched into server for one test"""
+    database = mongomock_motor.AsyncMongoMockClient()["protegeya_test"]
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine to completion on a loop owned by the test"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
@@ -0,0 +1,63 @@
+"""Broker availability heap: coverage areas are respected by every claim path, including the fallbacks"""
+import pytest
+
+from server import BrokerAvailabilityHeap
+
+
+def broker(broker_id, coverage=None, leads=0, quota=10):
+    return {
+        "id": broker_id, "user_id": f"{broker_id}-user", "name": broker_id, "subscription_status": "Active",
+        "current_month_leads": leads, "monthly_lead_quota": quota,
+        "coverage_municipalities": coverage or [], "routing_weight": 1.0
+    }
+
+
+@pytest.fixture
+def heap():
+    return BrokerAvailabilityHeap()
+
+
+def test_lead_goes_to_broker_covering_its_municipality(db, run, heap):
+    run(db.brokers.insert_many([broker("mixco", ["Mixco"]), broker("national", leads=5)]))
+    run(heap.rebuild())
+    assert run(heap.claim("mixco"))["id"] == "mixco"
+
+
+def test_heap_fallback_skips_brokers_restricted_to_other_areas(db, run, heap):
+    run(db.brokers.insert_many([broker("mixco", ["Mixco"]), broker("national", leads=5)]))
+    run(heap.rebuild())
+    assert run(heap.claim("Villa Nueva"))["id"] == "national"
+    # El broker restringido vuelve al heap para los leads de su zona
+    assert run(heap.claim("Mixco"))["id"] == "mixco"
+
+
+def test_lead_stays_unassigned_when_only_out_of_area_brokers_have_quota(db, run, heap):
+    run(db.brokers.insert_many([broker("mixco", ["Mixco"]), broker("national", leads=10)]))
+    run(heap.rebuild())
+    assert run(heap.claim("Villa Nueva")) is None
+    assert run(db.brokers.find_one({"id": "mixco"}))["current_month_leads"] == 0
+
+
+def test_mongo_fallback_applies_the_same_coverage_filter(db, run, heap):
+    run(db.brokers.insert_many([broker("mixco", ["Mixco"]), broker("antigua", ["Antigua Guatemala"])]))
+    # Sin heap cargado (arranque) solo queda el claim ordenado de Mongo
+    assert run(heap.claim("Villa Nueva")) is None
+    assert run(heap.claim("Mixco"))["id"] == "mixco"
+    run(db.brokers.insert_one(broker("national")))
+    assert run(heap.claim("Villa Nueva"))["id"] == "national"
+
+
+def test_excluded_broker_never_receives_the_lead(db, run, heap):
+    run(db.brokers.insert_many([broker("a"), broker("b", leads=3)]))
+    run(heap.rebuild())
+    assert run(heap.claim("Mixco", exclude={"a"}))["id"] == "b"
+    assert len(heap) == 2
+
+
+def test_legacy_broker_without_routing_weight_gets_the_default_weight(db, run, heap):
+    legacy = broker("legacy", ["Mixco"], leads=5)
+    del legacy["routing_weight"]
+    # El nacional va primero en el heap: solo la ruta por cobertura elige al legacy
+    run(db.brokers.insert_many([legacy, broker("national")]))
+    run(heap.rebuild())
+    assert run(heap.claim("Mixco"))["id"] == "legacy"
@@ -0,0 +1,86 @@
+"""Deterministic fast-path parser: what it may answer alone and what must fall through to the LLM"""
+import re
+
+import pytest
+
+import server
+from server import parse_name_turn, parse_selection_turn, parse_vehicle_turn
+
+QUOTES = [
+    {"insurer_name": "BAM", "insurance_type": "FullCoverage", "monthly_premium": 450.0},
+    {"insurer_name": "BAM", "insurance_type": "ThirdParty", "monthly_premium": 100.0},
+    {"insurer_name": "Bantrab", "insurance_type": "FullCoverage", "monthly_premium": 500.0},
+    {"insurer_name": "Bantrab", "insurance_type": "ThirdParty", "monthly_premium": 90.0},
+]
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("Juan Pérez", "Juan Pérez"),
+    ("me llamo ana lópez", "Ana López"),
+    ("Mi nombre es María José Castillo", "María José Castillo"),
+    ("soy Pedro Ramírez", "Pedro Ramírez"),
+])
+def test_name_turn_accepts_plain_names(message, expected):
+    assert parse_name_turn(message) == expected
+
+
+@pytest.mark.parametrize("message", [
+    "Si Claro", "Está Bien", "Claro Que Si", "Ok Gracias", "Buenas Tardes",
+    "soy de Mixco", "soy el dueño", "me llamo de nuevo", "Toyota Corolla", "juan pérez",
+])
+def test_name_turn_rejects_affirmations_and_places(message):
+    assert parse_name_turn(message) is None
+
+
+def test_vehicle_turn_with_known_municipality():
+    parsed = parse_vehicle_turn("Toyota Corolla 2020 Q150000 en villa nueva")
+    assert parsed == {"make": "Toyota", "model": "Corolla", "year": 2020, "value": 150000.0, "municipality": "Villa Nueva"}
+
+
+def test_vehicle_turn_defaults_to_guatemala_without_municipality():
+    assert parse_vehicle_turn("Honda Civic 2018 95000")["municipality"] == "Guatemala"
+
+
+@pytest.mark.parametrize("message", [
+    "Kia Rio 2015 Q50000 quiero cotizar",
+    "Mazda 3 2021 180000 gracias",
+    "Nissan Sentra 2019 Q90000 lo antes posible",
+])
+def test_vehicle_turn_free_text_after_value_goes_to_llm(message):
+    assert parse_vehicle_turn(message) is None
+
+
+def test_vehicle_turn_accepts_broker_coverage_area(monkeypatch):
+    monkeypatch.setattr(server.broker_availability, "_coverage", {"aldea el zapote": {"b1"}})
+    assert parse_vehicle_turn("Kia Rio 2015 Q50000 Aldea El Zapote")["municipality"] == "Aldea El Zapote"
+
+
+@pytest.mark.parametrize("message", ["Completo", "RC", "quiero el completo", "el rc por favor"])
+def test_selection_without_insurer_is_ambiguous_with_several_quotes(message):
+    assert parse_selection_turn(message, QUOTES) is None
+
+
+def test_selection_with_named_insurer():
+    assert parse_selection_turn("el completo de BAM", QUOTES) == {
+        "insurer": "BAM", "insurance_type": "FullCoverage", "price": 450.0
+    }
+
+
+def test_selection_resolves_when_only_one_insurer_offers_the_type():
+    quotes = [QUOTES[0], QUOTES[1], QUOTES[3]]
+    assert parse_selection_turn("Completo", quotes)["insurer"] == "BAM"
+
+
+@pytest.mark.parametrize("message", ["BAM y Bantrab completo", "completo pero más barato"])
+def test_selection_with_extra_information_goes_to_llm(message):
+    assert parse_selection_turn(message, QUOTES) is None
+
+
+def test_degraded_selection_prompt_round_trips_through_the_fast_path():
+    lead = {"name": "Ana López", "status": server.LeadStatus.QUOTED_NO_PREFERENCE, "quotes": QUOTES}
+    reply = server.degraded_reply(lead)
+    examples = re.findall(r"'([^']+)'", reply)
+
+    assert examples
+    for example in examples:
+        assert isinstance(server.parse_structured_turn(example, lead), server.SeleccionarAseguradoraArgs)
@@ -0,0 +1,27 @@
+"""Monthly broker lead counters rebuilt from the leads actually assigned in the month"""
+from datetime import datetime, timedelta
+
+from server import GUATEMALA_TZ, reconcile_broker_lead_counters
+
+
+def test_leads_without_assigned_at_are_counted_by_creation_date(db, run):
+    now = datetime(2026, 10, 15, 12, 0, tzinfo=GUATEMALA_TZ)
+    this_month = now - timedelta(days=3)
+    last_month = now - timedelta(days=40)
+    run(db.brokers.insert_one({"id": "b1", "name": "Broker", "current_month_leads": 0}))
+    run(db.leads.insert_many([
+        {"id": "new", "assigned_broker_id": "b1", "assigned_at": this_month},
+        {"id": "legacy-this-month", "assigned_broker_id": "b1", "assigned_at": None,
+         "created_at": this_month.isoformat(), "updated_at": this_month.isoformat()},
+        {"id": "old-field-missing", "assigned_broker_id": "b1", "created_at": this_month},
+        # Lead del mes pasado que solo cambió de estado este mes: no es una asignación del mes
+        {"id": "last-month-touched", "assigned_broker_id": "b1", "assigned_at": None,
+         "created_at": last_month.isoformat(), "updated_at": this_month.isoformat()},
+        {"id": "reassigned-last-month", "assigned_broker_id": "b1", "assigned_at": last_month,
+         "created_at": last_month.isoformat(), "updated_at": this_month},
+    ]))
+
+    report = run(reconcile_broker_lead_counters(now))
+
+    assert report["drift"] == [{"broker_id": "b1", "name": "Broker", "recorded": 0, "actual": 3}]
+    assert run(db.brokers.find_one({"id": "b1"}))["current_month_leads"] == 3
@@ -0,0 +1,31 @@
+"""Lead exports: the single PDF is capped and points large exports to the streamed ZIP"""
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import GUATEMALA_TZ, UserResponse, UserRole, export_leads_pdf
+
+ADMIN = UserResponse(id="admin", email="admin@protegeya.com", name="Admin", role=UserRole.ADMIN,
+                     created_at=datetime.now(GUATEMALA_TZ))
+
+
+def test_single_pdf_over_the_cap_points_to_the_zip(db, run, monkeypatch):
+    monkeypatch.setattr(server, "PDF_EXPORT_MAX_LEADS", 2)
+    run(db.leads.insert_many([{"id": f"L{i}", "name": "Cliente", "created_at": "2026-10-01"} for i in range(3)]))
+
+    with pytest.raises(HTTPException) as error:
+        run(export_leads_pdf(current_user=ADMIN))
+
+    assert error.value.status_code == 400
+    assert "/api/leads/export.zip" in error.value.detail
+
+
+def test_single_pdf_within_the_cap_is_streamed(db, run, monkeypatch):
+    monkeypatch.setattr(server, "PDF_EXPORT_MAX_LEADS", 2)
+    run(db.leads.insert_many([{"id": f"L{i}", "name": "Cliente", "created_at": "2026-10-01"} for i in range(2)]))
+
+    response = run(export_leads_pdf(current_user=ADMIN))
+
+    assert response.media_type == "application/pdf"
@@ -0,0 +1,114 @@
+"""Append-only broker ledger: voids append reversals, snapshots are incremental, reconciliation flags drift"""
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import (
+    GUATEMALA_TZ, BrokerTransaction, PaymentApplication, PaymentDeletion, TransactionType, UserResponse, UserRole,
+    account_balance_at, apply_payment, create_broker_account, delete_transaction, prepare_for_mongo,
+    reconcile_ledger_balances, take_ledger_snapshots
+)
+
+ADMIN = UserResponse(id="admin", email="admin@protegeya.com", name="Admin", role=UserRole.ADMIN,
+                     created_at=datetime.now(GUATEMALA_TZ))
+DAY = datetime(2026, 9, 1, 12, 0, tzinfo=GUATEMALA_TZ)
+
+
+@pytest.fixture(autouse=True)
+def no_whatsapp(monkeypatch):
+    async def fake_send(phone, text):
+        return True
+    monkeypatch.setattr(server, "send_whatsapp_message", fake_send)
+
+
+@pytest.fixture
+def account_id(db, run):
+    run(db.subscription_plans.insert_one({"id": "plan", "name": "Plan Básico", "amount": 500.0}))
+    run(db.brokers.insert_one({"id": "b1", "user_id": "u1", "name": "Broker", "whatsapp_number": "50255550000",
+                               "subscription_status": "Active"}))
+    return run(create_broker_account("b1", "plan"))
+
+
+def entry(account_id, amount, created_at):
+    return prepare_for_mongo(BrokerTransaction(
+        account_id=account_id, broker_id="b1", transaction_type=TransactionType.ADJUSTMENT,
+        amount=amount, description="ajuste", balance_after=0.0, created_at=created_at
+    ).dict())
+
+
+def ledger_sum(db, run, account_id):
+    return sum(t["amount"] for t in run(db.broker_transactions.find({"account_id": account_id}).to_list(None)))
+
+
+def test_void_appends_a_reversal_instead_of_deleting(db, run, account_id):
+    run(apply_payment("b1", PaymentApplication(amount=500.0, reference_number="REF-1"), ADMIN))
+    payment = run(db.broker_transactions.find_one({"reference_number": "REF-1", "transaction_type": TransactionType.PAYMENT}))
+
+    result = run(delete_transaction(payment["id"], PaymentDeletion(authorization_code="ProtegeYa123#"), ADMIN))
+
+    assert result["new_balance"] == -500.0
+    transactions = run(db.broker_transactions.find({"account_id": account_id}).to_list(None))
+    assert len(transactions) == 3  # cargo inicial, pago anulado y su reversión
+    voided = next(t for t in transactions if t["id"] == payment["id"])
+    reversal = next(t for t in transactions if t.get("reverses_transaction_id") == payment["id"])
+    assert voided["voided_at"] and voided["voided_by"] == "admin"
+    assert reversal["amount"] == -500.0
+    assert ledger_sum(db, run, account_id) == run(db.broker_accounts.find_one({"id": account_id}))["current_balance"]
+
+
+def test_a_transaction_can_only_be_voided_once(db, run, account_id):
+    run(apply_payment("b1", PaymentApplication(amount=200.0, reference_number="REF-2"), ADMIN))
+    payment = run(db.broker_transactions.find_one({"reference_number": "REF-2", "transaction_type": TransactionType.PAYMENT}))
+    run(delete_transaction(payment["id"], PaymentDeletion(authorization_code="ProtegeYa123#"), ADMIN))
+
+    with pytest.raises(HTTPException) as error:
+        run(delete_transaction(payment["id"], PaymentDeletion(authorization_code="ProtegeYa123#"), ADMIN))
+    assert error.value.status_code == 404
+    assert run(db.broker_accounts.find_one({"id": account_id}))["current_balance"] == -500.0
+
+
+def test_incremental_snapshots_and_balance_at(db, run):
+    run(db.broker_transactions.insert_many([
+        entry("acc", -500.0, DAY),
+        entry("acc", 200.0, DAY + timedelta(days=4)),
+        entry("acc", 100.0, DAY + timedelta(days=6)),
+        entry("other", -50.0, DAY),
+    ]))
+
+    assert run(take_ledger_snapshots(DAY + timedelta(days=2)))["snapshots"] == 2
+    # Solo "acc" tuvo movimientos desde el corte anterior
+    assert run(take_ledger_snapshots(DAY + timedelta(days=5)))["snapshots"] == 1
+    assert run(take_ledger_snapshots(DAY + timedelta(days=5)))["snapshots"] == 0
+
+    at_day_3 = run(account_balance_at("acc", DAY + timedelta(days=3)))
+    assert at_day_3["balance"] == -500.0
+    assert at_day_3["entries_after_snapshot"] == 0
+    at_day_7 = run(account_balance_at("acc", DAY + timedelta(days=7)))
+    assert at_day_7["balance"] == -200.0
+    assert at_day_7["entries_after_snapshot"] == 1
+    assert run(account_balance_at("other", DAY + timedelta(days=7)))["balance"] == -50.0
+
+
+def test_reconciliation_flags_balances_that_disagree_with_the_ledger(db, run, account_id):
+    run(apply_payment("b1", PaymentApplication(amount=100.0), ADMIN))
+    assert run(reconcile_ledger_balances())["mismatches"] == []
+
+    run(db.broker_accounts.update_one({"id": account_id}, {"$inc": {"current_balance": 25.0}}))
+    report = run(reconcile_ledger_balances())
+
+    assert [(m["account_id"], m["ledger_balance"], m["difference"]) for m in report["mismatches"]] == [(account_id, -400.0, 25.0)]
+    assert run(db.ledger_reconciliations.count_documents({})) == 2
+
+
+def test_reconciliation_flags_a_balance_with_no_ledger_entries(db, run, account_id):
+    # Transacciones borradas físicamente antes de que el ledger fuera append-only
+    run(db.broker_transactions.delete_many({"account_id": account_id}))
+
+    report = run(reconcile_ledger_balances())
+
+    assert report["accounts_checked"] == 1
+    assert [(m["account_id"], m["ledger_balance"], m["entries"], m["difference"]) for m in report["mismatches"]] == [
+        (account_id, 0, 0, -500.0)
+    ]
@@ -0,0 +1,129 @@
+"""LLM circuit breaker: open/half-open/closed transitions and outcomes that arrive after a transition"""
+import asyncio
+
+import pytest
+
+import server
+from server import LLMCircuitBreaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", fake)
+    return fake
+
+
+def tripped_breaker(clock) -> LLMCircuitBreaker:
+    breaker = LLMCircuitBreaker(window=4, min_calls=4, error_rate=0.5, cooldown=30)
+    for ok in (True, True, False, False):
+        breaker.record(breaker.allow(), ok)
+    assert breaker.state == "open"
+    return breaker
+
+
+def test_opens_once_error_rate_is_reached(clock):
+    breaker = LLMCircuitBreaker(window=4, min_calls=4, error_rate=0.5, cooldown=30)
+    for ok in (True, True, True, False):
+        breaker.record(breaker.allow(), ok)
+    assert breaker.state == "closed"
+    breaker.record(breaker.allow(), False)
+    assert breaker.state == "open"
+    assert breaker.allow() is None
+
+
+def test_single_trial_after_cooldown_closes_on_success(clock):
+    breaker = tripped_breaker(clock)
+    clock.now += 31
+    assert breaker.state == "half_open"
+    trial = breaker.allow()
+    assert trial is not None
+    assert breaker.allow() is None  # Solo una llamada de prueba a la vez
+    breaker.record(trial, True)
+    assert breaker.state == "closed"
+    assert not breaker.outcomes
+
+
+def test_failed_trial_reopens(clock):
+    breaker = tripped_breaker(clock)
+    clock.now += 31
+    breaker.record(breaker.allow(), False)
+    assert breaker.state == "open"
+    clock.now += 31
+    assert breaker.allow() is not None
+
+
+def test_late_success_from_before_the_trip_does_not_close(clock):
+    breaker = LLMCircuitBreaker(window=4, min_calls=4, error_rate=0.5, cooldown=30)
+    in_flight = breaker.allow()
+    for ok in (True, True, False, False):
+        breaker.record(breaker.allow(), ok)
+    clock.now += 31
+    breaker.record(in_flight, True)
+    assert breaker.state == "half_open"
+    assert breaker.stale_outcomes == 1
+
+
+def test_late_failure_does_not_rearm_or_steal_the_trial(clock):
+    breaker = LLMCircuitBreaker(window=4, min_calls=4, error_rate=0.5, cooldown=30)
+    in_flight = breaker.allow()
+    for ok in (True, True, False, False):
+        breaker.record(breaker.allow(), ok)
+    opened_at = breaker.opened_at
+    clock.now += 31
+    trial = breaker.allow()
+    breaker.record(in_flight, False)
+    assert breaker.opened_at == opened_at
+    assert breaker.trial_in_flight
+    breaker.record(trial, True)
+    assert breaker.state == "closed"
+
+
+def test_outcomes_from_before_close_do_not_pollute_the_new_window(clock):
+    breaker = tripped_breaker(clock)
+    clock.now += 31
+    trial = breaker.allow()
+    breaker.record(trial, True)
+    breaker.record(trial, False)  # Ticket de la época anterior
+    assert list(breaker.outcomes) == []
+    assert breaker.stale_outcomes == 1
+
+
+def test_released_trial_frees_the_slot(clock):
+    breaker = tripped_breaker(clock)
+    clock.now += 31
+    trial = breaker.allow()
+    breaker.release(trial)
+    assert breaker.allow() is not None
+
+
+def test_in_flight_counter_tracks_guarded_calls(run, monkeypatch):
+    started = asyncio.Event()
+    finish = asyncio.Event()
+
+    class SlowBackend:
+        async def create(self, **kwargs):
+            started.set()
+            await finish.wait()
+            return "done"
+
+    monkeypatch.setattr(server, "llm_backend", SlowBackend())
+    monkeypatch.setitem(server.llm_stats, "in_flight", 0)
+
+    async def scenario():
+        call = asyncio.ensure_future(server._limited_completion({}))
+        await started.wait()
+        during = server.llm_stats["in_flight"]
+        finish.set()
+        await call
+        return during, server.llm_stats["in_flight"]
+
+    assert run(scenario()) == (1, 0)
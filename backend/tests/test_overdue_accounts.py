@@ -0,0 +1,81 @@
+"""Daily overdue check: only transitions that actually applied suspend brokers or send notices"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+from server import GUATEMALA_TZ, AccountStatus, check_overdue_accounts
+
+
+class RacingCollection:
+    """broker_accounts whose bulk_write first lets a payment reactivate one account"""
+
+    def __init__(self, collection, paid_account_id):
+        self._collection = collection
+        self._paid_account_id = paid_account_id
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def bulk_write(self, operations, **kwargs):
+        await self._collection.update_one(
+            {"id": self._paid_account_id},
+            {"$set": {"account_status": AccountStatus.ACTIVE, "current_balance": 0.0}}
+        )
+        return await self._collection.bulk_write(operations, **kwargs)
+
+
+class RacingDatabase:
+    def __init__(self, database, paid_account_id):
+        self._database = database
+        self.broker_accounts = RacingCollection(database.broker_accounts, paid_account_id)
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    messages = []
+
+    async def fake_send(phone, text):
+        messages.append(phone)
+        return True
+
+    monkeypatch.setattr(server, "send_whatsapp_message", fake_send)
+    return messages
+
+
+def seed_expired_grace(db, run, count):
+    now = datetime.now(GUATEMALA_TZ)
+    for index in range(count):
+        run(db.brokers.insert_one({
+            "id": f"b{index}", "user_id": f"u{index}", "name": f"Broker {index}",
+            "whatsapp_number": f"5020000{index}", "subscription_status": "Active"
+        }))
+        run(db.broker_accounts.insert_one({
+            "id": f"a{index}", "broker_id": f"b{index}", "account_status": AccountStatus.GRACE_PERIOD,
+            "current_balance": -500.0, "next_due_date": now - timedelta(days=10), "grace_period_end": now - timedelta(days=1)
+        }))
+
+
+def test_dry_run_writes_and_sends_nothing(db, run, sent):
+    seed_expired_grace(db, run, 2)
+    summary = run(check_overdue_accounts(dry_run=True))
+    assert summary["suspended"] == 2
+    assert len(summary["notifications"]) == 2
+    assert sent == []
+    assert run(db.broker_accounts.count_documents({"account_status": AccountStatus.SUSPENDED})) == 0
+
+
+def test_broker_not_suspended_when_a_payment_won_the_race(db, run, sent, monkeypatch):
+    seed_expired_grace(db, run, 2)
+    monkeypatch.setattr(server, "db", RacingDatabase(db, paid_account_id="a0"))
+
+    summary = run(check_overdue_accounts())
+
+    assert summary["suspended"] == 1
+    assert summary["lost_races"] == 1
+    assert run(db.brokers.find_one({"id": "b0"}))["subscription_status"] == "Active"
+    assert run(db.brokers.find_one({"id": "b1"}))["subscription_status"] != "Active"
+    assert sent == ["50200001"]
@@ -0,0 +1,109 @@
+"""Scheduler leader lease: one leader at a time, takeover after expiry, recorded job runs"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from server import SCHEDULER_LEASE_NAME, leader_job, release_scheduler_lease, renew_scheduler_lease
+
+
+@pytest.fixture(autouse=True)
+def scheduler_state(db, run, monkeypatch):
+    monkeypatch.setattr(server, "leader_state", {"is_leader": False, "since": None, "last_heartbeat": None, "task": None})
+    monkeypatch.setattr(server, "scheduler_stats", {"runs": 0, "failed": 0, "skipped_not_leader": 0, "leadership_changes": 0})
+    run(db.job_locks.create_index("name", unique=True))
+
+
+def as_worker(monkeypatch, worker_id, is_leader=False):
+    """Switch the process identity; each worker keeps its own idea of whether it leads"""
+    monkeypatch.setattr(server, "WORKER_ID", worker_id)
+    server.leader_state["is_leader"] = is_leader
+
+
+def expire_lease(db, run):
+    run(db.job_locks.update_one(
+        {"name": SCHEDULER_LEASE_NAME},
+        {"$set": {"locked_until": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    ))
+
+
+def test_only_one_worker_holds_the_lease(db, run, monkeypatch):
+    as_worker(monkeypatch, "worker-a")
+    assert run(renew_scheduler_lease())
+    as_worker(monkeypatch, "worker-b")
+    assert not run(renew_scheduler_lease())
+    assert run(db.job_locks.find_one({"name": SCHEDULER_LEASE_NAME}))["owner"] == "worker-a"
+
+
+def test_lease_is_taken_over_after_expiry(db, run, monkeypatch):
+    as_worker(monkeypatch, "worker-a")
+    run(renew_scheduler_lease())
+    expire_lease(db, run)
+
+    as_worker(monkeypatch, "worker-b")
+    assert run(renew_scheduler_lease())
+    assert server.leader_state["since"] is not None
+
+    # El líder anterior se entera en su siguiente heartbeat
+    as_worker(monkeypatch, "worker-a", is_leader=True)
+    assert not run(renew_scheduler_lease())
+    assert not server.leader_state["is_leader"]
+
+
+def test_heartbeat_keeps_the_lease_alive(db, run, monkeypatch):
+    as_worker(monkeypatch, "worker-a")
+    run(renew_scheduler_lease())
+    first_expiry = run(db.job_locks.find_one({"name": SCHEDULER_LEASE_NAME}))["locked_until"]
+    run(renew_scheduler_lease())
+    assert run(db.job_locks.find_one({"name": SCHEDULER_LEASE_NAME}))["locked_until"] >= first_expiry
+
+
+def test_release_hands_over_without_waiting_for_expiry(db, run, monkeypatch):
+    as_worker(monkeypatch, "worker-a")
+    run(renew_scheduler_lease())
+    run(release_scheduler_lease())
+
+    as_worker(monkeypatch, "worker-b")
+    assert run(renew_scheduler_lease())
+
+
+def test_leader_job_runs_once_and_records_the_run(db, run, monkeypatch):
+    calls = []
+
+    async def charge():
+        calls.append(server.WORKER_ID)
+        return {"charged": 7}
+
+    job = leader_job("generate_monthly_charges", charge, lambda summary: summary["charged"])
+    as_worker(monkeypatch, "worker-a")
+    run(job())
+    as_worker(monkeypatch, "worker-b")
+    run(job())
+
+    assert calls == ["worker-a"]
+    assert server.scheduler_stats["skipped_not_leader"] == 1
+    record = run(db.job_runs.find_one({"job": "generate_monthly_charges"}))
+    assert record["worker"] == "worker-a"
+    assert record["status"] == "success"
+    assert record["items"] == 7
+    assert record["duration_ms"] >= 0
+
+
+def test_failed_and_skipped_runs_are_recorded(db, run, monkeypatch):
+    async def broken():
+        raise RuntimeError("mongo down")
+
+    async def locked():
+        return {"skipped": True}
+
+    as_worker(monkeypatch, "worker-a")
+    run(leader_job("ledger_maintenance", broken)())
+    run(leader_job("enforce_lead_slas", locked, lambda summary: summary["reassigned"])())
+
+    failed = run(db.job_runs.find_one({"job": "ledger_maintenance"}))
+    assert failed["status"] == "failed"
+    assert failed["error"] == "RuntimeError: mongo down"
+    skipped = run(db.job_runs.find_one({"job": "enforce_lead_slas"}))
+    assert skipped["status"] == "skipped"
+    assert skipped["items"] is None
+    assert server.scheduler_stats["failed"] == 1
@@ -0,0 +1,111 @@
+"""process_whatsapp_message end to end with the LLM replaced by a scripted reply"""
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import server
+from server import process_whatsapp_message
+
+PHONE = "50255551234"
+ADMIN = server.UserResponse(id="admin", email="admin@protegeya.com", name="Admin", role=server.UserRole.ADMIN,
+                            created_at=datetime.now(server.GUATEMALA_TZ))
+
+
+@pytest.fixture
+def llm_reply(db, monkeypatch):
+    """Script the next LLM turn as (text, tool action); no summaries or outbound messages run"""
+    reply = {"text": "", "action": None}
+
+    async def fake_generate(user, lead, phone_number, message, config):
+        return reply["text"], reply["action"], None
+
+    async def no_cache_key(*args):
+        return None
+
+    monkeypatch.setattr(server, "llm_configured", lambda: True)
+    monkeypatch.setattr(server, "generate_ai_response", fake_generate)
+    monkeypatch.setattr(server, "stateless_cache_key", no_cache_key)
+    monkeypatch.setattr(server, "spawn_background", lambda coro: coro.close())
+    return reply
+
+
+@pytest.mark.parametrize("message", ["Si Claro", "Buenas Tardes", "Quiero Cotizar Seguro"])
+def test_capitalized_words_are_not_stored_as_the_name_without_a_tool_call(db, run, llm_reply, message):
+    llm_reply["text"] = "¡Con gusto! ¿Cuál es tu nombre completo?"
+
+    run(process_whatsapp_message(PHONE, message))
+
+    assert run(db.leads.find_one({"phone_number": PHONE}))["name"] == ""
+    assert not run(db.users.find_one({"phone_number": PHONE})).get("name")
+
+
+def test_every_turn_is_logged_with_a_datetime_created_at(db, run, llm_reply):
+    llm_reply["text"] = "¡Hola! ¿Cuál es tu nombre?"
+    run(process_whatsapp_message(PHONE, "Hola"))
+    # Cotización pedida antes de dar el nombre: sale por la rama que vuelve a pedirlo
+    llm_reply["text"] = ""
+    llm_reply["action"] = server.GenerarCotizacionArgs(make="Toyota", model="Corolla", year=2020, value=150000)
+    reply = run(process_whatsapp_message(PHONE, "Toyota Corolla 2020 150000"))
+
+    assert "Necesito tu nombre completo" in reply
+    interactions = run(db.interactions.find({"metadata.phone_number": PHONE}).sort("created_at", 1).to_list(None))
+    assert len(interactions) == 2
+    assert all(isinstance(interaction["created_at"], datetime) for interaction in interactions)
+    first = interactions[0]["created_at"]
+    assert run(db.interactions.count_documents({"metadata.phone_number": PHONE, "created_at": {"$gt": first}})) == 1
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ("¡Gracias! CAPTURAR_NOMBRE:Juan Carlos Pérez\nAhora dime tu vehículo.",
+     server.CapturarNombreArgs(full_name="Juan Carlos Pérez")),
+    ("Perfecto 'GENERAR_COTIZACION:Toyota,Corolla,2020,Q150000,Mixco'",
+     server.GenerarCotizacionArgs(make="Toyota", model="Corolla", year=2020, value=150000, municipality="Mixco")),
+    ("Registrado.\nSELECCIONAR_ASEGURADORA:BAM,Seguro Completo,Q1,250.00",
+     server.SeleccionarAseguradoraArgs(insurer="BAM", insurance_type="FullCoverage", monthly_price=1250.0)),
+    ("SELECCIONAR_ASEGURADORA:BAM,Seguro Completo,caro", None),
+])
+def test_legacy_prompt_commands_are_parsed_and_never_shown(reply, expected):
+    text, action = server.extract_legacy_commands(reply)
+    assert action == expected
+    assert "_COTIZACION" not in text and "CAPTURAR_NOMBRE" not in text and "SELECCIONAR_ASEGURADORA" not in text
+
+
+def test_custom_prompt_reply_with_a_legacy_command_becomes_the_tool_action(db, run, monkeypatch):
+    async def fake_completion(**kwargs):
+        message = SimpleNamespace(content="¡Mucho gusto! CAPTURAR_NOMBRE:Ana Lucía Gómez", tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    monkeypatch.setattr(server, "llm_chat_completion", fake_completion)
+    user = run(server.get_or_create_user(PHONE))
+    config = {"ai_chat_prompt": "Cuando te dé su nombre escribe CAPTURAR_NOMBRE:{nombre}"}
+
+    text, action, _ = run(server.generate_ai_response(user, None, PHONE, "ana lucia", config))
+
+    assert text == "¡Mucho gusto!"
+    assert action == server.CapturarNombreArgs(full_name="Ana Lucía Gómez")
+
+
+def test_saving_a_prompt_with_legacy_commands_warns_for_migration(db, run):
+    prompt = "Cuando tengas los datos → GENERAR_COTIZACION:{marca},{modelo},{año},{valor},{municipio}"
+
+    result = run(server.update_configuration(server.ConfigurationUpdate(ai_chat_prompt=prompt), ADMIN))
+
+    assert "GENERAR_COTIZACION" in result["warnings"][0]
+    clean = run(server.update_configuration(server.ConfigurationUpdate(ai_chat_prompt="Llama GENERAR_COTIZACION."), ADMIN))
+    assert "warnings" not in clean
+
+
+def test_purging_the_response_cache_invalidates_other_workers_entries(db, run):
+    run(db.system_config.insert_one({"ai_chat_prompt": "Eres María"}))
+    old_key = run(server.stateless_cache_key("Hola", None, PHONE, run(db.system_config.find_one({}))))
+    # Otro worker con la respuesta vieja todavía en su caché en memoria
+    other_worker_cache = {old_key: "respuesta vieja"}
+
+    result = run(server.clear_response_cache(ADMIN))
+
+    new_key = run(server.stateless_cache_key("Hola", None, PHONE, run(db.system_config.find_one({}))))
+    assert result["generation"] == 1
+    assert result["worker_id"] == server.WORKER_ID
+    assert new_key != old_key
+    assert new_key not in other_worker_cache
@@ -14,6 +14,7 @@ const BrokerAccounts = () => {
   const [loading, setLoading] = useState(true);
   const [selectedAccount, setSelectedAccount] = useState(null);
   const [transactions, setTransactions] = useState([]);
+  const [transactionsCursor, setTransactionsCursor] = useState(null);
   const [showPaymentModal, setShowPaymentModal] = useState(false);
   const [showTransactionsModal, setShowTransactionsModal] = useState(false);
   const [showAssignPlanModal, setShowAssignPlanModal] = useState(false);
@@ -72,10 +73,13 @@ const BrokerAccounts = () => {
     }
   };
 
-  const fetchTransactions = async (accountId) => {
+  const fetchTransactions = async (accountId, cursor = null) => {
     try {
-      const response = await axios.get(`${API}/admin/transactions/${accountId}`);
-      setTransactions(response.data);
+      const response = await axios.get(`${API}/admin/transactions/${accountId}`, {
+        params: cursor ? { cursor } : {}
+      });
+      setTransactions(cursor ? [...transactions, ...response.data.items] : response.data.items);
+      setTransactionsCursor(response.data.next_cursor);
     } catch (error) {
       console.error("Error fetching transactions:", error);
     }
@@ -673,6 +677,16 @@ const BrokerAccounts = () => {
                       ))}
                     </tbody>
                   </table>
+                  {transactionsCursor && (
+                    <div className="flex justify-center pt-4">
+                      <button
+                        onClick={() => fetchTransactions(selectedAccount.id, transactionsCursor)}
+                        className="text-blue-600 hover:text-blue-800 text-sm font-semibold"
+                      >
+                        Cargar más movimientos
+                      </button>
+                    </div>
+                  )}
                 </div>
               )}
 
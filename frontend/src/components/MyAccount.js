@@ -10,6 +10,7 @@ const MyAccount = () => {
   const { user, isBroker } = useAuth();
   const [account, setAccount] = useState(null);
   const [transactions, setTransactions] = useState([]);
+  const [transactionsCursor, setTransactionsCursor] = useState(null);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
@@ -30,10 +31,13 @@ const MyAccount = () => {
     }
   };
 
-  const fetchMyTransactions = async () => {
+  const fetchMyTransactions = async (cursor = null) => {
     try {
-      const response = await axios.get(`${API}/my-transactions`);
-      setTransactions(response.data);
+      const response = await axios.get(`${API}/my-transactions`, {
+        params: cursor ? { cursor } : {}
+      });
+      setTransactions(cursor ? [...transactions, ...response.data.items] : response.data.items);
+      setTransactionsCursor(response.data.next_cursor);
     } catch (error) {
       console.error("Error fetching transactions:", error);
     }
@@ -377,6 +381,16 @@ const MyAccount = () => {
                   ))}
                 </tbody>
               </table>
+              {transactionsCursor && (
+                <div className="flex justify-center py-4 border-t border-slate-200">
+                  <button
+                    onClick={() => fetchMyTransactions(transactionsCursor)}
+                    className="text-blue-600 hover:text-blue-800 text-sm font-semibold"
+                  >
+                    Cargar más movimientos
+                  </button>
+                </div>
+              )}
             </div>
           )}
         </div>
@@ -67,8 +67,9 @@ const SystemConfiguration = () => {
     setSaving(true);
     
     try {
-      await axios.put(`${API}/admin/configuration`, formData);
-      showMessage("Configuración actualizada exitosamente", "success");
+      const response = await axios.put(`${API}/admin/configuration`, formData);
+      const warnings = response.data.warnings || [];
+      showMessage(["Configuración actualizada exitosamente", ...warnings].join(" ⚠️ "), "success");
       fetchConfiguration(); // Reload config
     } catch (error) {
       console.error("Error updating configuration:", error);
@@ -508,15 +509,12 @@ Eres María, asistente virtual de ProtegeYa 🇬🇹
 
 PROCESO COMPLETO:
 1. Saludar amigablemente y preguntar por seguro vehicular
-2. Recopilar: marca, modelo, año, valor en GTQ, municipio
-3. CUANDO TENGAS TODOS LOS DATOS → GENERAR_COTIZACION:{marca},{modelo},{año},{valor},{municipio}
-4. Mostrar cotizaciones disponibles con precios mensuales
-5. Preguntar cuál aseguradora y tipo de seguro le interesa
-6. CUANDO SELECCIONEN → SELECCIONAR_ASEGURADORA:{nombre_aseguradora},{tipo_seguro},{precio_mensual}
-
-Ejemplos de respuestas especiales:
-- 'GENERAR_COTIZACION:Toyota,Corolla,2020,150000,Guatemala'
-- 'SELECCIONAR_ASEGURADORA:Seguros El Roble,Seguro Completo,1250.00'
+2. Pedir el nombre completo; cuando lo dé, llama CAPTURAR_NOMBRE
+3. Recopilar: marca, modelo, año, valor en GTQ, municipio
+4. CUANDO TENGAS TODOS LOS DATOS → llama GENERAR_COTIZACION
+5. Mostrar cotizaciones disponibles con precios mensuales
+6. Preguntar cuál aseguradora y tipo de seguro le interesa
+7. CUANDO SELECCIONEN → llama SELECCIONAR_ASEGURADORA con su precio mensual
 
 IMPORTANTE:
 - Sé amigable y usa emojis guatemaltecos 🚗💙🇬🇹
@@ -530,6 +528,11 @@ IMPORTANTE:
                   <p className="text-xs text-blue-600 mt-1">
                     Deja vacío para usar el prompt predeterminado. Máximo 2000 caracteres.
                   </p>
+                  <p className="text-xs text-blue-600 mt-1">
+                    La IA registra nombre, cotización y selección con herramientas: indica "llama GENERAR_COTIZACION" en lugar de
+                    pedirle que escriba "GENERAR_COTIZACION:..." en su respuesta. Los comandos en texto de prompts anteriores se
+                    siguen interpretando, pero al guardar se muestra un aviso para migrarlos.
+                  </p>
                 </div>
 
                 <div className="mt-3 p-3 bg-blue-100 rounded-lg">